@@ -1,2 +1,11 @@
 #!/usr/bin/env python
-__version__ = "2025.9.5"
+__version__ = "2026.10.18"
+
+def __getattr__(name):
+    # Imported on first access so `setup.py` can read __version__ without the dependencies
+    if name in {"KOfamSearcher", "KOfamHit"}:
+        from . import searcher
+        return getattr(searcher, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+__all__ = ["KOfamSearcher", "KOfamHit"]
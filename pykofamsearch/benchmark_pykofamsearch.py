@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+import sys, os, json, time, random, argparse, platform, subprocess, tempfile, shutil
+from tqdm import tqdm
+from . import __version__
+from .pykofamsearch import load_database
+
+__program__ = os.path.split(sys.argv[0])[-1]
+
+# Background amino acid frequencies (UniProtKB/Swiss-Prot) for random sequences
+AMINO_ACID_FREQUENCIES = {
+    "A":8.25, "R":5.53, "N":4.06, "D":5.45, "C":1.37, "Q":3.93, "E":6.75, "G":7.07, "H":2.27, "I":5.96,
+    "L":9.66, "K":5.84, "M":2.42, "F":3.86, "P":4.70, "S":6.56, "T":5.34, "W":1.08, "Y":2.92, "V":6.87,
+}
+
+# Results are compared with the baseline on these keys
+RESULT_KEYS = ["stage", "number_of_sequences", "number_of_kofams", "n_jobs"]
+
+def read_fasta(filepath:str):
+    """
+    Read (id, sequence) records from a fasta file
+    """
+    records = list()
+    with open(filepath, "r") as f:
+        id_record = None
+        sequence = list()
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if id_record is not None:
+                    records.append((id_record, "".join(sequence)))
+                id_record = line[1:].split(" ")[0]
+                sequence = list()
+            elif line:
+                sequence.append(line)
+        if id_record is not None:
+            records.append((id_record, "".join(sequence)))
+    return records
+
+def generate_synthetic_proteome(
+    number_of_sequences:int,
+    source_sequences:list=None,
+    mutation_rate:float=0.1,
+    mean_length:int=300,
+    random_state:int=0,
+    ):
+    """
+    Generate a synthetic proteome
+
+    Sequences are resampled from source_sequences with point mutations at mutation_rate (so the
+    proteome has a realistic number of hits) or are random sequences with background amino acid
+    frequencies and gamma distributed lengths if source_sequences is not provided.
+
+    Returns
+    -------
+    records : list
+        List of (id, sequence)
+    """
+    rng = random.Random(random_state)
+    amino_acids = list(AMINO_ACID_FREQUENCIES)
+    weights = list(AMINO_ACID_FREQUENCIES.values())
+    records = list()
+    for i in range(number_of_sequences):
+        if source_sequences:
+            sequence = list(rng.choice(source_sequences))
+            n_mutations = int(round(len(sequence) * mutation_rate))
+            positions = rng.sample(range(len(sequence)), min(n_mutations, len(sequence)))
+            for position, amino_acid in zip(positions, rng.choices(amino_acids, weights=weights, k=len(positions))):
+                sequence[position] = amino_acid
+            sequence = "".join(sequence)
+        else:
+            length = max(int(rng.gammavariate(2.0, mean_length/2.0)), 30)
+            sequence = "".join(rng.choices(amino_acids, weights=weights, k=length))
+        records.append(("synthetic_{}".format(i), sequence))
+    return records
+
+def write_fasta(records, filepath:str):
+    with open(filepath, "w") as f:
+        for id_record, sequence in records:
+            print(">{}\n{}".format(id_record, sequence), file=f)
+
+def run_command(cmd:list):
+    """
+    Run a command and measure wall time and peak resident memory of the child process
+
+    Returns
+    -------
+    wall_time : float
+        Seconds
+    peak_rss : int
+        Bytes
+    """
+    start_time = time.monotonic()
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr.decode(errors="replace"))
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    return wall_time, peak_rss
+
+def run_benchmarks(
+    database_arguments:list,
+    kofams:list,
+    sequence_sizes:list,
+    kofam_sizes:list,
+    thread_counts:list,
+    source_sequences:list=None,
+    mutation_rate:float=0.1,
+    repeats:int=1,
+    reformat:bool=True,
+    pykofamsearch_arguments:list=None,
+    temporary_directory:str=None,
+    random_state:int=0,
+    ):
+    """
+    Run pykofamsearch (and reformat_pykofamsearch) across input sizes, database subsets, and thread counts.
+    The fastest of the repeats is reported for each configuration.
+
+    Returns
+    -------
+    results : list
+        List of dictionaries with keys RESULT_KEYS and wall_time, peak_rss, sequences_per_second, and hmms_per_second
+    """
+    if pykofamsearch_arguments is None:
+        pykofamsearch_arguments = list()
+    directory = tempfile.mkdtemp(prefix="benchmark_pykofamsearch.", dir=temporary_directory)
+    results = list()
+    try:
+        # Database subsets (random but reproducible)
+        rng = random.Random(random_state)
+        subset_filepaths = dict()
+        for number_of_kofams in kofam_sizes:
+            number_of_kofams = min(number_of_kofams, len(kofams))
+            filepath = os.path.join(directory, "subset_{}.list".format(number_of_kofams))
+            with open(filepath, "w") as f:
+                for id_ko in sorted(rng.sample(kofams, number_of_kofams)):
+                    print(id_ko, file=f)
+            subset_filepaths[number_of_kofams] = filepath
+
+        # Proteomes
+        proteome_filepaths = dict()
+        for number_of_sequences in [1] + sequence_sizes:
+            filepath = os.path.join(directory, "proteome_{}.faa".format(number_of_sequences))
+            write_fasta(generate_synthetic_proteome(number_of_sequences, source_sequences=source_sequences, mutation_rate=mutation_rate, random_state=random_state), filepath)
+            proteome_filepaths[number_of_sequences] = filepath
+
+        configurations = [("startup", 1, number_of_kofams, 1) for number_of_kofams in subset_filepaths]
+        configurations += [("search", number_of_sequences, number_of_kofams, n_jobs) for number_of_sequences in sequence_sizes for number_of_kofams in subset_filepaths for n_jobs in thread_counts]
+        for stage, number_of_sequences, number_of_kofams, n_jobs in tqdm(configurations, desc="Benchmarking"):
+            output_filepath = os.path.join(directory, "output_{}_{}.tsv".format(number_of_sequences, number_of_kofams))
+            cmd = [
+                sys.executable, "-m", "pykofamsearch.pykofamsearch",
+                *database_arguments,
+                "--proteins", proteome_filepaths[number_of_sequences],
+                "--subset", subset_filepaths[number_of_kofams],
+                "--output", output_filepath,
+                "--n_jobs", str(n_jobs),
+                "--verbosity", "0",
+                *pykofamsearch_arguments,
+            ]
+            measurements = [run_command(cmd) for i in range(repeats)]
+            wall_time = min(wall_time for wall_time, peak_rss in measurements)
+            results.append({
+                "stage":stage,
+                "number_of_sequences":number_of_sequences,
+                "number_of_kofams":number_of_kofams,
+                "n_jobs":n_jobs,
+                "wall_time":wall_time,
+                "peak_rss":max(peak_rss for wall_time, peak_rss in measurements),
+                "sequences_per_second":number_of_sequences/wall_time,
+                "hmms_per_second":number_of_kofams/wall_time,
+            })
+
+            # Reformat the output of the largest subset once per input size
+            if reformat and stage == "search" and number_of_kofams == max(subset_filepaths) and n_jobs == thread_counts[0]:
+                cmd = [sys.executable, "-m", "pykofamsearch.reformat_pykofamsearch", "--input", output_filepath, "--output", os.devnull]
+                measurements = [run_command(cmd) for i in range(repeats)]
+                wall_time = min(wall_time for wall_time, peak_rss in measurements)
+                results.append({
+                    "stage":"reformat",
+                    "number_of_sequences":number_of_sequences,
+                    "number_of_kofams":number_of_kofams,
+                    "n_jobs":1,
+                    "wall_time":wall_time,
+                    "peak_rss":max(peak_rss for wall_time, peak_rss in measurements),
+                    "sequences_per_second":number_of_sequences/wall_time,
+                    "hmms_per_second":None,
+                })
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def compare_results(results:list, baseline:list, tolerance:float=0.1, memory_tolerance:float=0.1):
+    """
+    Compare results with a baseline on matching configurations
+
+    Returns
+    -------
+    comparisons : list
+        List of dictionaries with keys RESULT_KEYS, wall_time_ratio, peak_rss_ratio, and regression
+    """
+    key_to_baseline = {tuple(result[key] for key in RESULT_KEYS):result for result in baseline}
+    comparisons = list()
+    for result in results:
+        key = tuple(result[key] for key in RESULT_KEYS)
+        if key not in key_to_baseline:
+            continue
+        wall_time_ratio = result["wall_time"]/key_to_baseline[key]["wall_time"]
+        peak_rss_ratio = result["peak_rss"]/key_to_baseline[key]["peak_rss"]
+        comparison = dict(zip(RESULT_KEYS, key))
+        comparison["wall_time_ratio"] = wall_time_ratio
+        comparison["peak_rss_ratio"] = peak_rss_ratio
+        comparison["regression"] = (wall_time_ratio > 1 + tolerance) or (peak_rss_ratio > 1 + memory_tolerance)
+        comparisons.append(comparison)
+    return comparisons
+
+def parse_list(value:str):
+    return [int(x) for x in value.split(",") if x]
+
+def main(args=None):
+    # Options
+    # =======
+    # Path info
+    script_directory  =  os.path.dirname(os.path.abspath( __file__ ))
+    script_filename = __program__
+    description = """
+    Running: {} v{} via Python v{} | {}""".format(__program__, __version__, sys.version.split(" ")[0], sys.executable)
+    usage = "{} -b <database.kofamdb> -o <benchmark.json> [--baseline <baseline.json>]".format(__program__)
+    epilog = "PyKOfamSearch"
+
+    # Parser
+    parser = argparse.ArgumentParser(description=description, usage=usage, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-v', '--version', action='version', version=__version__)
+
+    parser_io = parser.add_argument_group('I/O arguments')
+    parser_io.add_argument("-i","--proteins", type=str, help = "path/to/proteins.fasta (e.g., test/test.faa) resampled with point mutations to generate proteomes.  Random sequences are used if not provided")
+    parser_io.add_argument("-o","--output", type=str, default="stdout", help = "path/to/benchmark.json [Default: stdout]")
+    parser_io.add_argument("--baseline", type=str, help = "path/to/baseline.json from a previous run.  Exits with status 1 if any matching configuration regresses")
+    parser_io.add_argument("--temporary_directory", type=str, help="path/to/temporary_directory/ for proteomes and outputs [Default: System default]")
+
+    parser_benchmark = parser.add_argument_group('Benchmark arguments')
+    parser_benchmark.add_argument("-n", "--number_of_sequences", type=parse_list, default=[1000], help = "Comma-separated synthetic proteome sizes [Default: 1000]")
+    parser_benchmark.add_argument("-k", "--number_of_kofams", type=parse_list, help = "Comma-separated database subset sizes (random KOfams) [Default: All KOfams]")
+    parser_benchmark.add_argument("-p", "--n_jobs", type=parse_list, default=[1], help = "Comma-separated thread counts [Default: 1]")
+    parser_benchmark.add_argument("-r", "--repeats", type=int, default=1, help = "Number of times each configuration is run.  The fastest wall time and largest peak memory are reported [Default: 1]")
+    parser_benchmark.add_argument("--mutation_rate", type=float, default=0.1, help = "Fraction of positions mutated when resampling --proteins [Default: 0.1]")
+    parser_benchmark.add_argument("--random_state", type=int, default=0, help = "Random seed for proteomes and database subsets [Default: 0]")
+    parser_benchmark.add_argument("--no_reformat", action="store_true", help = "Do not benchmark reformat_pykofamsearch")
+    parser_benchmark.add_argument("--tolerance", type=float, default=0.1, help = "Allowed fractional increase in wall time relative to --baseline [Default: 0.1]")
+    parser_benchmark.add_argument("--memory_tolerance", type=float, default=0.1, help = "Allowed fractional increase in peak memory relative to --baseline [Default: 0.1]")
+    parser_benchmark.add_argument("pykofamsearch_arguments", nargs=argparse.REMAINDER, help = "Additional arguments for pykofamsearch after `--` (e.g., -- --schedule database)")
+
+    parser_database = parser.add_argument_group('Database arguments')
+    parser_database.add_argument("-d", "--database_directory", type=str, help="path/to/kofam_database_directory/ cannot be used with -b/-serialized_database")
+    parser_database.add_argument("-b", "--serialized_database", type=str, help="path/to/database.pkl[.gz] or path/to/database.kofamdb (indexed) cannot be used with -d/--database_directory")
+
+    opts = parser.parse_args(args)
+    opts.script_directory  = script_directory
+    opts.script_filename = script_filename
+
+    if not any([opts.serialized_database, opts.database_directory]):
+        raise ValueError("Must either provide -d/--database_directory or -b/--serialized_database")
+    if opts.serialized_database:
+        database_arguments = ["--serialized_database", os.path.abspath(opts.serialized_database)]
+    else:
+        database_arguments = ["--database_directory", os.path.abspath(opts.database_directory)]
+    pykofamsearch_arguments = [argument for argument in opts.pykofamsearch_arguments if argument != "--"]
+
+    ko_to_data, name_to_hmm, missing_kos = load_database(
+        database_directory=opts.database_directory,
+        serialized_database=opts.serialized_database,
+    )
+    kofams = list(name_to_hmm)
+    del ko_to_data, name_to_hmm
+    if not opts.number_of_kofams:
+        opts.number_of_kofams = [len(kofams)]
+
+    source_sequences = None
+    if opts.proteins:
+        source_sequences = [sequence for id_record, sequence in read_fasta(opts.proteins)]
+
+    results = run_benchmarks(
+        database_arguments=database_arguments,
+        kofams=kofams,
+        sequence_sizes=opts.number_of_sequences,
+        kofam_sizes=opts.number_of_kofams,
+        thread_counts=opts.n_jobs,
+        source_sequences=source_sequences,
+        mutation_rate=opts.mutation_rate,
+        repeats=opts.repeats,
+        reformat=not opts.no_reformat,
+        pykofamsearch_arguments=pykofamsearch_arguments,
+        temporary_directory=opts.temporary_directory,
+        random_state=opts.random_state,
+    )
+    output = {
+        "version":__version__,
+        "python":sys.version.split(" ")[0],
+        "platform":platform.platform(),
+        "cpu_count":os.cpu_count(),
+        "timestamp":time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pykofamsearch_arguments":pykofamsearch_arguments,
+        "results":results,
+    }
+
+    regressions = list()
+    if opts.baseline:
+        with open(opts.baseline, "r") as f:
+            baseline = json.load(f)
+        output["comparisons"] = compare_results(results, baseline["results"], tolerance=opts.tolerance, memory_tolerance=opts.memory_tolerance)
+        for comparison in output["comparisons"]:
+            status = "REGRESSION" if comparison["regression"] else "ok"
+            print("{}\t{}\t{} sequences\t{} KOfams\t{} threads\twall time x{:0.2f}\tpeak memory x{:0.2f}".format(status, comparison["stage"], comparison["number_of_sequences"], comparison["number_of_kofams"], comparison["n_jobs"], comparison["wall_time_ratio"], comparison["peak_rss_ratio"]), file=sys.stderr)
+        regressions = [comparison for comparison in output["comparisons"] if comparison["regression"]]
+
+    if opts.output == "stdout":
+        json.dump(output, sys.stdout, indent=4)
+        print(file=sys.stdout)
+    else:
+        with open(opts.output, "w") as f:
+            json.dump(output, f, indent=4)
+
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
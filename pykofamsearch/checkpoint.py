@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import os, json
+
+def get_file_signature(filepath:str):
+    """
+    Get the absolute path, size, and modification time of a file or directory (or the path itself for stdin and pipes)
+    so a checkpoint is not resumed with different inputs
+    """
+    if filepath is None or not os.path.exists(filepath) or not (os.path.isfile(filepath) or os.path.isdir(filepath)):
+        return filepath
+    stat = os.stat(filepath)
+    return [os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns]
+
+class HitRecorder(object):
+    """
+    Wrap a HitWriter (of a sample for multiple proteomes) and record the columns that are written so they
+    can be journaled by a SearchCheckpoint.  Only the identifiers, thresholds, scores, and E-values are
+    recorded because the other columns are looked up from the KOfam metadata.
+    """
+    def __init__(self, writer, sample=None):
+        self.writer = writer
+        self.sample = sample
+        self.rows = list()
+
+    def write_columns(self, id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions):
+        self.writer.write_columns(id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions)
+        self.rows.append([self.sample, list(id_proteins), list(thresholds), list(scores), list(evalues)])
+
+class SearchCheckpoint(object):
+    """
+    Journal of the hits written for each completed KOfam of each block so an interrupted run can be restarted
+    without searching completed work.  On restart, the journaled hits are written again in query order
+    between the hits of the remaining KOfams so the output is the same as an uninterrupted run.
+
+    Layout:
+        checkpoint_directory/
+            checkpoint.json     # Options and inputs that affect the output (must match to resume)
+            block_1.jsonl       # One line per completed KOfam: [id_ko, [[sample, id_proteins, thresholds, scores, evalues], ...]]
+            block_2.jsonl
+
+    Floats are written by json with their shortest round-trip representation so replayed values are identical.
+
+    Usage:
+        checkpoint = SearchCheckpoint("checkpoint_directory", parameters={...})
+        completed = checkpoint.load_block(1)
+        checkpoint.open_block(1)
+        checkpoint.record("K00001", rows)
+        checkpoint.close_block()
+    """
+    def __init__(self, directory:str, parameters:dict):
+        self.directory = directory
+        self.parameters = json.loads(json.dumps(parameters))
+        self._f = None
+        os.makedirs(directory, exist_ok=True)
+        filepath = os.path.join(directory, "checkpoint.json")
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                previous_parameters = json.load(f)
+            if previous_parameters != self.parameters:
+                changed = sorted(key for key in previous_parameters.keys() | self.parameters.keys() if previous_parameters.get(key) != self.parameters.get(key))
+                raise ValueError("Checkpoint {} was created with different options or inputs ({}).  Use a new --checkpoint_directory".format(directory, ", ".join(changed)))
+        else:
+            with open(filepath + ".tmp", "w") as f:
+                json.dump(self.parameters, f, indent=4)
+            os.replace(filepath + ".tmp", filepath)
+
+    def get_block_filepath(self, block:int):
+        return os.path.join(self.directory, "block_{}.jsonl".format(block))
+
+    def load_block(self, block:int):
+        """
+        Load the completed KOfams of a block.  A partial last line (interrupted write) is removed.
+
+        Returns
+        -------
+        completed : dict
+            Dictionary of KOfam identifiers to journaled rows
+        """
+        completed = dict()
+        filepath = self.get_block_filepath(block)
+        if not os.path.exists(filepath):
+            return completed
+        size = 0
+        with open(filepath, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    id_ko, rows = json.loads(line)
+                except ValueError:
+                    break
+                completed[id_ko] = rows
+                size += len(line)
+        if size < os.path.getsize(filepath):
+            with open(filepath, "r+b") as f:
+                f.truncate(size)
+        return completed
+
+    def open_block(self, block:int):
+        self.close_block()
+        self._f = open(self.get_block_filepath(block), "a")
+
+    def record(self, id_ko:str, rows:list):
+        # Lines are flushed so completed KOfams survive the process being killed
+        self._f.write(json.dumps([id_ko, rows]) + "\n")
+        self._f.flush()
+
+    def close_block(self):
+        if self._f is not None:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._f.close()
+            self._f = None
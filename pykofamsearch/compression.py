@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+import io, os, gzip, zlib, struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# BGZF (blocked gzip used by samtools/htslib) is a series of independent gzip members of at most 64 KB
+# that record their compressed size in a `BC` extra subfield.  Blocks are compressed and decompressed
+# independently (zlib releases the GIL) so threads scale and block offsets allow random access.
+BGZF_BLOCK_SIZE = 65280
+BGZF_HEADER_FORMAT = "<BBBBIBBHBBHH"
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+WRITE_EXTENSIONS = {".gz":"bgzf", ".bgz":"bgzf", ".pgz":"bgzf", ".zst":"zstd"}
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires `zstandard`.  Please install with `pip install zstandard`")
+    return zstandard
+
+def get_compression(filepath:str, mode:str="rb"):
+    """
+    Get the compression of a file from its first bytes when reading (`gzip`, `bgzf`, `zstd`, or None)
+    or from its extension when writing (`.gz`/`.bgz`/`.pgz` are written as BGZF and `.zst` as zstd)
+    """
+    if "r" in mode:
+        with open(filepath, "rb") as f:
+            return detect_compression(f.read(18))
+    return WRITE_EXTENSIONS.get(os.path.splitext(filepath)[1])
+
+def detect_compression(header:bytes):
+    if header.startswith(GZIP_MAGIC):
+        return "bgzf" if is_bgzf_header(header) else "gzip"
+    if header.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+def is_bgzf_header(header:bytes):
+    # FEXTRA flag with a 6 byte extra field containing the `BC` subfield
+    return len(header) >= 18 and header[3] & 4 and header[12:14] == b"BC" and struct.unpack("<H", header[10:12])[0] == 6
+
+def compress_bgzf_block(data:bytes, level:int=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack(BGZF_HEADER_FORMAT, 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+def decompress_bgzf_block(data:bytes):
+    return zlib.decompress(data, -15)
+
+def read_bgzf_block(f):
+    """
+    Read the next BGZF block from f
+
+    Returns
+    -------
+    cdata : bytes or None
+        Raw deflate data (None at the end of the file)
+    isize : int
+        Uncompressed size
+    """
+    header = f.read(12)
+    if not header:
+        return None, 0
+    if len(header) < 12 or not header.startswith(GZIP_MAGIC) or not header[3] & 4:
+        raise ValueError("Not a BGZF block at offset {}".format(f.tell() - len(header)))
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = f.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        subfield_length = struct.unpack("<H", extra[i+2:i+4])[0]
+        if extra[i:i+2] == b"BC":
+            bsize = struct.unpack("<H", extra[i+4:i+6])[0]
+        i += 4 + subfield_length
+    if bsize is None:
+        raise ValueError("BGZF block without BC subfield at offset {}".format(f.tell() - 12 - xlen))
+    cdata = f.read(bsize - xlen - 19)
+    crc32, isize = struct.unpack("<II", f.read(8))
+    return cdata, isize
+
+def get_bgzf_index(filepath:str):
+    """
+    Get the (compressed offset, uncompressed offset) of every block of a BGZF file by reading the block
+    headers only (no decompression).  A BgzfReader can start at any compressed offset so chunks of a file
+    can be decompressed independently.
+    """
+    index = list()
+    uncompressed_offset = 0
+    with open(filepath, "rb") as f:
+        while True:
+            compressed_offset = f.tell()
+            cdata, isize = read_bgzf_block(f)
+            if cdata is None:
+                break
+            if isize:
+                index.append((compressed_offset, uncompressed_offset))
+            uncompressed_offset += isize
+    return index
+
+class BgzfReader(io.RawIOBase):
+    """
+    Read a BGZF file decompressing blocks on threads
+
+    Usage:
+        with io.BufferedReader(BgzfReader("proteins.faa.gz", threads=4)) as f:
+            data = f.read()
+    """
+    def __init__(self, filepath, threads:int=1, offset:int=0):
+        # filepath can also be a binary file object (e.g., a pipe)
+        self._f = open(filepath, "rb") if isinstance(filepath, (str, bytes, os.PathLike)) else filepath
+        if offset:
+            self._f.seek(offset)
+        self._executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._max_pending = 4 * threads
+        self._pending = deque()
+        self._buffer = b""
+        self._position = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while not self._eof and len(self._pending) < max(self._max_pending, 1):
+            cdata, isize = read_bgzf_block(self._f)
+            if cdata is None:
+                self._eof = True
+                break
+            if self._executor is None:
+                self._pending.append(decompress_bgzf_block(cdata))
+            else:
+                self._pending.append(self._executor.submit(decompress_bgzf_block, cdata))
+
+    def readinto(self, b):
+        while self._position >= len(self._buffer):
+            self._fill()
+            if not self._pending:
+                return 0
+            data = self._pending.popleft()
+            self._buffer = data if isinstance(data, bytes) else data.result()
+            self._position = 0
+        n = min(len(b), len(self._buffer) - self._position)
+        b[:n] = self._buffer[self._position:self._position + n]
+        self._position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+            self._f.close()
+        super().close()
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Write a BGZF file (readable by gzip) compressing blocks on threads
+
+    Usage:
+        with io.BufferedWriter(BgzfWriter("output.tsv.gz", threads=4)) as f:
+            f.write(data)
+    """
+    def __init__(self, filepath:str, threads:int=1, level:int=6):
+        self._f = open(filepath, "wb")
+        self.level = level
+        self._executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._max_pending = 4 * threads
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def _submit(self, data:bytes):
+        if self._executor is None:
+            self._f.write(compress_bgzf_block(data, self.level))
+        else:
+            self._pending.append(self._executor.submit(compress_bgzf_block, data, self.level))
+            # Blocks are written in order and at most max_pending are held in memory
+            while len(self._pending) > self._max_pending:
+                self._f.write(self._pending.popleft().result())
+
+    def write(self, b):
+        self._buffer.extend(b)
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._f.write(self._pending.popleft().result())
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._f.write(BGZF_EOF)
+            self._f.close()
+        super().close()
+
+def open_file(filepath:str, mode:str="rb", threads:int=1, level:int=None):
+    """
+    Open an uncompressed, gzip, BGZF, or zstd file.
+
+    Reading detects the compression from the first bytes of the file.  BGZF is decompressed on threads,
+    other gzip files use `isal` (multithreaded) if installed and `gzip` otherwise, and zstd requires `zstandard`.
+    Writing uses the extension: `.gz`, `.bgz`, and `.pgz` are written as BGZF (valid gzip) compressed on threads
+    and `.zst` as zstd compressed on threads.
+
+    Parameters
+    ----------
+    filepath : str or file-like object
+        path/to/file or a binary file object (e.g., sys.stdin.buffer) when reading
+    mode : str
+        `rb`, `rt`, `wb`, or `wt` (`r` and `w` are text)
+    threads : int
+        Number of compression threads
+    level : int
+        Compression level [Default: 6 for gzip and 3 for zstd]
+
+    Returns
+    -------
+    f : file-like object
+    """
+    if mode in {"r", "w"}:
+        mode += "t"
+    if mode not in {"rb", "rt", "wb", "wt"}:
+        raise ValueError("mode must be either `rb`, `rt`, `wb`, or `wt`")
+    if "r" in mode:
+        # The file is opened once and the header is peeked so pipes and process substitutions can be read
+        f = open(filepath, "rb") if isinstance(filepath, (str, bytes, os.PathLike)) else filepath
+        if not hasattr(f, "peek"):
+            f = io.BufferedReader(f)
+        compression = detect_compression(f.peek(18)[:18])
+        if compression == "bgzf":
+            f = io.BufferedReader(BgzfReader(f, threads=threads), buffer_size=BGZF_BLOCK_SIZE)
+        elif compression == "gzip":
+            try:
+                from isal import igzip_threaded
+                f = igzip_threaded.open(f, "rb", threads=threads)
+            except ImportError:
+                f = gzip.GzipFile(fileobj=f, mode="rb")
+        elif compression == "zstd":
+            zstandard = import_zstandard()
+            f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=True))
+    else:
+        compression = get_compression(filepath, mode)
+        if compression == "bgzf":
+            f = io.BufferedWriter(BgzfWriter(filepath, threads=threads, level=6 if level is None else level), buffer_size=BGZF_BLOCK_SIZE)
+        elif compression == "zstd":
+            zstandard = import_zstandard()
+            compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads if threads > 1 else 0)
+            f = compressor.stream_writer(open(filepath, "wb"), closefd=True)
+        else:
+            f = open(filepath, "wb")
+    if "t" in mode:
+        f = io.TextIOWrapper(f, encoding="utf-8")
+    return f
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import queue, threading
+
+class _Error(object):
+    __slots__ = ("exception",)
+
+    def __init__(self, exception):
+        self.exception = exception
+
+_DONE = object()
+
+def prefetch(iterable, maxsize:int=1):
+    """
+    Produce the items of iterable on a background thread at most maxsize items ahead of the consumer
+    (e.g., digitize the next block of sequences while the current block is searched).  Exceptions are
+    raised in the consumer.
+    """
+    items = queue.Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as e:
+            items.put(_Error(e))
+        else:
+            items.put(_DONE)
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            break
+        if isinstance(item, _Error):
+            raise item.exception
+        yield item
+    thread.join()
+
+class BackgroundWorker(object):
+    """
+    Run submitted functions in order on a background thread through a bounded queue so the
+    submitting thread (e.g., the one consuming hmmsearch results) is not blocked by output.
+    The first exception is raised by the next `submit` or by `close`.  If threaded is False then
+    functions are run immediately in the submitting thread.
+
+    Usage:
+        worker = BackgroundWorker(maxsize=256)
+        for hits in hmmsearch(...):
+            worker.submit(write_hits, hits, ...)
+        worker.close()
+    """
+    def __init__(self, maxsize:int=256, threaded:bool=True):
+        self.error = None
+        self.thread = None
+        if threaded:
+            self.queue = queue.Queue(maxsize=maxsize)
+            self.thread = threading.Thread(target=self._run, name="background_worker", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                break
+            # Keep draining after an error so the submitting thread does not block
+            if self.error is None:
+                function, args, kwargs = item
+                try:
+                    function(*args, **kwargs)
+                except BaseException as e:
+                    self.error = e
+
+    def submit(self, function, *args, **kwargs):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            function(*args, **kwargs)
+        else:
+            self.queue.put((function, args, kwargs))
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(_DONE)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
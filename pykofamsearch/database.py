@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+import sys, os, io, mmap, pickle, struct, json, shutil, hashlib, tempfile
+from collections.abc import Mapping
+import pyhmmer
+from pyhmmer.plan7 import HMM, HMMFile, Background
+from pyhmmer.easel import Alphabet
+from pyhmmer.hmmer import hmmpress
+from .metadata import KOfamMetadata
+from .compression import open_file
+
+# Indexed database layout
+# =======================
+# [magic (8 bytes)][index offset (uint64)][index length (uint64)][HMM blobs ...][index (pickle)]
+# The index is a dictionary with the keys `metadata`, `ko_to_data` (KOfamMetadata), and `models` where `models`
+# maps each KOfam identifier to the (offset, length) of its binary HMM within the file.
+MAGIC = b"PYKOFAM\x01"
+HEADER_FORMAT = "<QQ"
+HEADER_SIZE = len(MAGIC) + struct.calcsize(HEADER_FORMAT)
+
+# Build checkpoint journal lines are `id_ko, offset, length, checksum, model_length` (tab-separated) after an optional inputs line
+JOURNAL_INPUTS_PREFIX = "#inputs\t"
+
+def is_indexed_database(filepath:str):
+    """
+    Check if a file is an indexed database by reading the magic bytes
+    """
+    with open(filepath, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def serialize_hmm(hmm):
+    """
+    Serialize an HMM to HMMER binary format
+    """
+    with io.BytesIO() as f:
+        hmm.write(f, binary=True)
+        return f.getvalue()
+
+def get_hmm_checksum(hmm):
+    """
+    Get the checksum (md5) of an HMM in HMMER binary format
+    """
+    return hashlib.md5(serialize_hmm(hmm)).hexdigest()
+
+def deserialize_hmm(blob:bytes):
+    """
+    Read an HMM from HMMER binary format
+    """
+    with HMMFile(io.BytesIO(blob)) as f:
+        return f.read()
+
+class IndexedDatabaseWriter(object):
+    """
+    Write KOfam HMMs incrementally to an indexed database.  The index is written when the writer is closed
+    with models in the order of ko_to_data (followed by any models not in ko_to_data in the order they were added).
+
+    If checkpoint is True then each model is recorded in a journal (filepath.checkpoint) as it is written and
+    an interrupted build resumes from the journal.  Models that were already written are in `models`.
+
+    If inputs is provided (e.g., sizes and checksums of the files the models are built from) then it is recorded
+    in the journal and a build is only resumed with the same inputs.
+
+    The checksum and model length (number of match states) of each model are stored in ko_to_data so
+    databases can be compared and scheduled without decoding HMMs.
+
+    Usage:
+        with IndexedDatabaseWriter("database.kofamdb", ko_to_data, metadata={"version":"v2024.11.9"}) as writer:
+            for id_ko, hmm in name_to_hmm.items():
+                writer.add_hmm(id_ko, hmm)
+    """
+    def __init__(self, filepath:str, ko_to_data:dict=None, metadata:dict=None, checkpoint:bool=False, inputs:dict=None):
+        self.filepath = filepath
+        if ko_to_data is None:
+            ko_to_data = KOfamMetadata()
+        if not isinstance(ko_to_data, KOfamMetadata):
+            ko_to_data = KOfamMetadata.from_dict(ko_to_data)
+        self.ko_to_data = ko_to_data
+        self.metadata = dict(metadata) if metadata is not None else dict()
+        self.checkpoint = checkpoint
+        self.checkpoint_filepath = "{}.checkpoint".format(filepath)
+        # JSON round trip so inputs compare equal to the inputs read back from the journal
+        self.inputs = json.loads(json.dumps(inputs)) if inputs is not None else None
+        self.models = dict()
+        self.checksums = dict()
+        self.model_lengths = dict()
+        self._journal = None
+        if checkpoint and os.path.exists(filepath) and os.path.exists(self.checkpoint_filepath):
+            self._resume()
+        else:
+            self._f = open(filepath, "w+b")
+            self._f.write(MAGIC)
+            self._f.write(struct.pack(HEADER_FORMAT, 0, 0))
+            if checkpoint:
+                self._journal = open(self.checkpoint_filepath, "w")
+                self._write_inputs(self._journal)
+
+    def _write_inputs(self, f):
+        if self.inputs is not None:
+            print(JOURNAL_INPUTS_PREFIX + json.dumps(self.inputs, sort_keys=True), file=f, flush=True)
+
+    def _resume(self):
+        """
+        Load the models written before an interruption from the journal and truncate anything written after the last entry
+        """
+        end = HEADER_SIZE
+        inputs = None
+        with open(self.checkpoint_filepath, "r") as f:
+            for line in f:
+                # The last line may be incomplete if the build was interrupted while writing it
+                if not line.endswith("\n"):
+                    break
+                if line.startswith(JOURNAL_INPUTS_PREFIX):
+                    inputs = json.loads(line[len(JOURNAL_INPUTS_PREFIX):])
+                    continue
+                id_ko, offset, length, checksum, *model_length = line.rstrip("\n").split("\t")
+                offset, length = int(offset), int(length)
+                self.models[id_ko] = (offset, length)
+                self.checksums[id_ko] = checksum
+                if model_length and model_length[0]:
+                    self.model_lengths[id_ko] = int(model_length[0])
+                end = max(end, offset + length)
+        if inputs != self.inputs:
+            raise ValueError("Inputs changed since the interrupted build (checkpoint: {}, current: {}).  Please remove {} and {} to restart".format(inputs, self.inputs, self.filepath, self.checkpoint_filepath))
+        self._f = open(self.filepath, "r+b")
+        if os.path.getsize(self.filepath) < end:
+            raise ValueError("Checkpoint is ahead of the database file.  Please remove {} and {} to restart".format(self.filepath, self.checkpoint_filepath))
+        self._f.truncate(end)
+        self._f.seek(end)
+        for id_ko, checksum in self.checksums.items():
+            if id_ko in self.ko_to_data:
+                self.ko_to_data[id_ko]["checksum"] = checksum
+                if id_ko in self.model_lengths:
+                    self.ko_to_data[id_ko]["model_length"] = self.model_lengths[id_ko]
+        # Rewrite the journal without an incomplete last line
+        with open(self.checkpoint_filepath, "w") as f:
+            self._write_inputs(f)
+            for id_ko, (offset, length) in self.models.items():
+                print(id_ko, offset, length, self.checksums[id_ko], self.model_lengths.get(id_ko, ""), sep="\t", file=f)
+        self._journal = open(self.checkpoint_filepath, "a")
+
+    def add_blob(self, id_ko:str, blob:bytes, model_length:int=None):
+        if id_ko in self.models:
+            raise KeyError("Duplicate KOfam identifier: {}".format(id_ko))
+        offset = self._f.tell()
+        self._f.write(blob)
+        self.models[id_ko] = (offset, len(blob))
+        # Per-model checksums are stored with the metadata so database versions can be compared without decoding HMMs
+        checksum = hashlib.md5(blob).hexdigest()
+        self.checksums[id_ko] = checksum
+        if model_length is not None:
+            self.model_lengths[id_ko] = model_length
+        if id_ko in self.ko_to_data:
+            self.ko_to_data[id_ko]["checksum"] = checksum
+            if model_length is not None:
+                self.ko_to_data[id_ko]["model_length"] = model_length
+        if self._journal is not None:
+            # The blob must be on disk before the journal entry that references it
+            self._f.flush()
+            print(id_ko, offset, len(blob), checksum, "" if model_length is None else model_length, sep="\t", file=self._journal, flush=True)
+
+    def add_hmm(self, id_ko:str, hmm):
+        self.add_blob(id_ko, serialize_hmm(hmm), model_length=hmm.M)
+
+    def get_blob(self, id_ko:str):
+        """
+        Read back a binary HMM that was already written (including models resumed from a checkpoint)
+        """
+        offset, length = self.models[id_ko]
+        self._f.flush()
+        return os.pread(self._f.fileno(), length, offset)
+
+    def close(self):
+        if self._f.closed:
+            return
+        models = {id_ko:self.models[id_ko] for id_ko in self.ko_to_data if id_ko in self.models}
+        for id_ko in self.models:
+            if id_ko not in models:
+                models[id_ko] = self.models[id_ko]
+        self.models = models
+        # Database checksum is computed from the model checksums in index order so it does not depend on the order models were written
+        self.metadata["checksum"] = hashlib.md5("".join("{}:{}\n".format(id_ko, self.checksums[id_ko]) for id_ko in self.models).encode()).hexdigest()
+        index = pickle.dumps({"metadata":self.metadata, "ko_to_data":self.ko_to_data, "models":self.models}, protocol=pickle.HIGHEST_PROTOCOL)
+        index_offset = self._f.tell()
+        self._f.write(index)
+        self._f.seek(len(MAGIC))
+        self._f.write(struct.pack(HEADER_FORMAT, index_offset, len(index)))
+        self._f.close()
+        if self._journal is not None:
+            self._journal.close()
+            os.remove(self.checkpoint_filepath)
+
+    def abort(self):
+        """
+        Close without writing the index (the journal is kept so the build can be resumed)
+        """
+        self._f.close()
+        if self._journal is not None:
+            self._journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None and self.checkpoint:
+            self.abort()
+        else:
+            self.close()
+
+class IndexedDatabase(Mapping):
+    """
+    Memory-mapped indexed database that only decodes HMMs when they are accessed
+
+    Usage:
+        database = IndexedDatabase("database.kofamdb")
+        ko_to_data = database.ko_to_data
+        hmm = database["K00001"]
+    """
+    def __init__(self, filepath:str, cache:bool=True):
+        self.filepath = filepath
+        self.cache = cache
+        self._f = open(filepath, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("Not an indexed database: {}".format(filepath))
+        index_offset, index_length = struct.unpack(HEADER_FORMAT, self._mm[len(MAGIC):HEADER_SIZE])
+        if index_offset == 0:
+            self.close()
+            raise ValueError("Incomplete indexed database (index was not written): {}".format(filepath))
+        index = pickle.loads(self._mm[index_offset:index_offset + index_length])
+        self.metadata = index["metadata"]
+        self.ko_to_data = index["ko_to_data"]
+        if not isinstance(self.ko_to_data, KOfamMetadata):
+            self.ko_to_data = KOfamMetadata.from_dict(self.ko_to_data)
+        self.models = index["models"]
+        self._hmms = dict()
+
+    def get_blob(self, id_ko:str):
+        offset, length = self.models[id_ko]
+        return self._mm[offset:offset + length]
+
+    def __getitem__(self, id_ko:str):
+        if id_ko in self._hmms:
+            return self._hmms[id_ko]
+        hmm = deserialize_hmm(self.get_blob(id_ko))
+        if self.cache:
+            self._hmms[id_ko] = hmm
+        return hmm
+
+    def __delitem__(self, id_ko:str):
+        del self.models[id_ko]
+        self._hmms.pop(id_ko, None)
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __len__(self):
+        return len(self.models)
+
+    def __contains__(self, id_ko):
+        return id_ko in self.models
+
+    def close(self):
+        if not self._mm.closed:
+            self._mm.close()
+        self._f.close()
+
+def load_serialized_database(filepath:str, threads:int=1):
+    """
+    Load a serialized database in either indexed or pickle (uncompressed, gzip, BGZF, or zstd) format.
+    Compression is detected from the file and BGZF or zstd pickles are decompressed on threads.
+
+    Returns
+    -------
+    ko_to_data : KOfamMetadata
+        Table of KOfam metadata
+    name_to_hmm : dict or IndexedDatabase
+        Mapping of KOfam identifiers to HMMs.  HMMs from indexed databases are decoded on access.
+    """
+    if is_indexed_database(filepath):
+        name_to_hmm = IndexedDatabase(filepath)
+        ko_to_data = name_to_hmm.ko_to_data
+    else:
+        with open_file(filepath, "rb", threads=threads) as f:
+            database = pickle.load(f)
+        if not (isinstance(database, tuple) and len(database) == 2 and isinstance(database[0], (dict, KOfamMetadata)) and isinstance(database[1], dict)):
+            raise ValueError("Unrecognized serialized database format: {}.  Expected a pickled tuple of (KOfam metadata dictionary, dictionary of HMMs) from `serialize_kofam_models`".format(filepath))
+        ko_to_data, name_to_hmm = database
+        # Pickle databases store a dictionary of dictionaries (see `KOfamMetadata.to_dict`)
+        if not isinstance(ko_to_data, KOfamMetadata):
+            ko_to_data = KOfamMetadata.from_dict(ko_to_data)
+    return ko_to_data, name_to_hmm
+
+def get_model_checksums(ko_to_data:dict, name_to_hmm):
+    """
+    Get the checksum of each model from the metadata (recorded by serialize_kofam_models) or computed from the HMM
+
+    Returns
+    -------
+    model_checksums : dict
+        Dictionary of KOfam identifiers to checksums in the same order as name_to_hmm
+    """
+    model_checksums = dict()
+    for id_ko in name_to_hmm:
+        checksum = ko_to_data[id_ko].get("checksum")
+        if checksum is None:
+            hmm = name_to_hmm[id_ko]
+            if not isinstance(hmm, HMM):
+                raise ValueError("Model checksums are not in the database and cannot be computed from pre-optimized profiles.  Please rebuild the database with `serialize_kofam_models` or do not use --profile_cache_directory")
+            checksum = get_hmm_checksum(hmm)
+        model_checksums[id_ko] = checksum
+    return model_checksums
+
+def get_model_lengths(ko_to_data:dict, name_to_hmm):
+    """
+    Get the model length (number of match states) of each model from the metadata (recorded by serialize_kofam_models)
+    or from the HMM so models of indexed databases are only decoded if the length was not recorded
+
+    Returns
+    -------
+    model_lengths : dict
+        Dictionary of KOfam identifiers to model lengths in the same order as name_to_hmm
+    """
+    model_lengths = dict()
+    for id_ko in name_to_hmm:
+        model_length = ko_to_data[id_ko].get("model_length") if id_ko in ko_to_data else None
+        if model_length is None:
+            model_length = name_to_hmm[id_ko].M
+        model_lengths[id_ko] = int(model_length)
+    return model_lengths
+
+def diff_model_checksums(old:dict, new:dict):
+    """
+    Compare the model checksums of two database versions
+
+    Returns
+    -------
+    added : set
+        KOfams in new but not old
+    removed : set
+        KOfams in old but not new
+    changed : set
+        KOfams in both with different checksums
+    """
+    added = new.keys() - old.keys()
+    removed = old.keys() - new.keys()
+    changed = {id_ko for id_ko in new.keys() & old.keys() if new[id_ko] != old[id_ko]}
+    return added, removed, changed
+
+# Pre-optimized profile cache
+# ===========================
+def get_database_version(ko_to_data:dict, name_to_hmm):
+    """
+    Get a version identifier from the content of the models: the checksum of the model checksums in order
+    (see `get_model_checksums`) which is the checksum of an indexed database with the same models.
+    Copies or `touch` of a database keep the version while any change to the models or subset changes it.
+    """
+    model_checksums = get_model_checksums(ko_to_data, name_to_hmm)
+    return hashlib.md5("".join("{}:{}\n".format(id_ko, checksum) for id_ko, checksum in model_checksums.items()).encode()).hexdigest()
+
+def get_profile_cache_key(database_version:str, background=None):
+    """
+    Get the cache key for pre-optimized profiles.  Profiles are configured against a background
+    so the alphabet and background length are part of the key along with the pyhmmer version.
+    """
+    if background is None:
+        background = Background(Alphabet.amino())
+    alphabet = "amino" if background.alphabet.is_amino() else "nucleotide"
+    return "{}.{}.L{}.pyhmmer_{}".format(database_version, alphabet, background.L, pyhmmer.__version__)
+
+def write_pressed_database(hmms, prefix:str):
+    """
+    Write HMMs as an hmmpress-style database (prefix, prefix.h3m, prefix.h3i, prefix.h3f, prefix.h3p)
+    """
+    hmms = list(hmms)
+    with open(prefix, "wb") as f:
+        for hmm in hmms:
+            hmm.write(f, binary=True)
+    return hmmpress(hmms, prefix)
+
+def read_pressed_database(prefix:str):
+    """
+    Read OptimizedProfiles from an hmmpress-style database
+
+    Returns
+    -------
+    name_to_profile : dict
+        Dictionary of KOfam identifiers to OptimizedProfile objects
+    """
+    name_to_profile = dict()
+    with HMMFile(prefix) as hmm_file:
+        if not hmm_file.is_pressed():
+            raise ValueError("Not a pressed database: {}".format(prefix))
+        for profile in hmm_file.optimized_profiles():
+            name_to_profile[profile.name.decode()] = profile
+    return name_to_profile
+
+def build_profile_cache(cache_directory:str, database_version:str, name_to_hmm, background=None):
+    """
+    Build pre-optimized profiles for a database version in the cache directory if they do not already exist
+
+    Returns
+    -------
+    prefix : str
+        Prefix of the pressed database in the cache
+    """
+    key = get_profile_cache_key(database_version, background=background)
+    directory = os.path.join(cache_directory, key)
+    prefix = os.path.join(directory, "profiles.hmm")
+    if os.path.exists(os.path.join(directory, "metadata.json")):
+        return prefix
+
+    # Write to a temporary directory and rename so concurrent jobs never read a partial cache
+    os.makedirs(cache_directory, exist_ok=True)
+    directory_tmp = tempfile.mkdtemp(prefix=".{}.".format(key), dir=cache_directory)
+    try:
+        number_of_profiles = write_pressed_database(name_to_hmm.values(), os.path.join(directory_tmp, "profiles.hmm"))
+        with open(os.path.join(directory_tmp, "metadata.json"), "w") as f:
+            json.dump({"database_version":database_version, "key":key, "number_of_profiles":number_of_profiles}, f, indent=4)
+        try:
+            os.rename(directory_tmp, directory)
+        except OSError:
+            # Another job finished building the same cache first
+            if not os.path.exists(os.path.join(directory, "metadata.json")):
+                raise
+    finally:
+        if os.path.exists(directory_tmp):
+            shutil.rmtree(directory_tmp)
+    return prefix
+
+def load_profile_cache(cache_directory:str, database_version:str, name_to_hmm, background=None):
+    """
+    Load pre-optimized profiles for a database version from the cache directory (building the cache on a miss)
+
+    Returns
+    -------
+    name_to_profile : dict
+        Dictionary of KOfam identifiers to OptimizedProfile objects
+    """
+    prefix = build_profile_cache(cache_directory, database_version, name_to_hmm, background=background)
+    return read_pressed_database(prefix)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+import csv
+from collections.abc import Mapping, MutableMapping
+import numpy as np
+import pandas as pd
+
+# Score type codes used by the search loop (0 means the KOfam has no curated threshold)
+SCORE_TYPE_CODES = {None:0, "full":1, "domain":2}
+
+def parse_enzyme_commission_from_definition(definition:str):
+    """
+    Parse enzyme commission from KOfam definition
+
+    Parameters
+    ----------
+    definition : str
+        KOfam definition
+
+    Returns
+    -------
+    enzymes : set
+        Set of enzymes
+
+    Raises
+    ------
+    ValueError
+        If the definition is invalid
+    """
+
+    enzymes = set()
+    if "[EC:" in definition:
+        fields = definition.split("[EC:")
+        if not len(fields) == 2:
+            raise ValueError("Invalid definition: {}".format(definition))
+        enzymes_unformatted = fields[-1][:-1]
+        if not "." in enzymes_unformatted:
+            raise ValueError("Invalid enzyme commission: {}".format(enzymes_unformatted))
+        enzymes = set(enzymes_unformatted.split(" "))
+    return enzymes
+
+class KOfamRecord(MutableMapping):
+    """
+    Dictionary-like view of one row of a KOfamMetadata table (e.g., record["threshold"])
+    """
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row:int):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, field:str):
+        return self.table.get_value(self.row, field)
+
+    def __setitem__(self, field:str, value):
+        self.table.set_value(self.row, field, value)
+
+    def __delitem__(self, field:str):
+        raise TypeError("Fields cannot be removed from a KOfamRecord")
+
+    def __iter__(self):
+        return iter(self.table.fields)
+
+    def __len__(self):
+        return len(self.table.fields)
+
+    def __repr__(self):
+        return "KOfamRecord({})".format(dict(self))
+
+class KOfamMetadata(Mapping):
+    """
+    Columnar table of KOfam metadata from ko_list indexed by an integer row for each KOfam.
+
+    Numeric fields are NumPy arrays (NaN for `-`) and the remaining fields are lists.  The search loop
+    uses `index`, `score_type_codes`, and `get_scaled_thresholds` instead of per-KOfam dictionaries while
+    `metadata[id_ko]["threshold"]` returns a KOfamRecord for compatibility with dictionary access.
+
+    Usage:
+        ko_to_data = parse_ko_list("ko_list")
+        i = ko_to_data.index["K00001"]
+        thresholds = ko_to_data.get_scaled_thresholds(1.0)
+        thresholds[i], ko_to_data.score_type_codes[i]
+    """
+    def __init__(self, ids:list=None, columns:dict=None):
+        if ids is None:
+            ids = list()
+        if columns is None:
+            columns = dict()
+        self.ids = list(ids)
+        self.index = {id_ko:i for i, id_ko in enumerate(self.ids)}
+        self.columns = dict()
+        for field, values in columns.items():
+            self.columns[field] = values
+        if "enzyme_commission" not in self.columns and "definition" in self.columns:
+            self.columns["enzyme_commission"] = [parse_enzyme_commission_from_definition(definition) if isinstance(definition, str) else set() for definition in self.columns["definition"]]
+        if "checksum" not in self.columns:
+            self.columns["checksum"] = [None]*len(self.ids)
+        self.fields = list(self.columns)
+        self._update_score_types()
+        self._scaled_thresholds = dict()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._scaled_thresholds = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_scaled_thresholds", None)
+        return state
+
+    def _update_score_types(self):
+        score_types = self.columns.get("score_type", [None]*len(self.ids))
+        self.score_type_codes = np.asarray([SCORE_TYPE_CODES.get(score_type, 0) for score_type in score_types], dtype=np.int8)
+
+    @classmethod
+    def from_dict(cls, ko_to_data:dict):
+        """
+        Build a table from a dictionary of KOfam identifiers to dictionaries of fields (legacy serialized databases)
+        """
+        ids = list(ko_to_data)
+        fields = list()
+        for data in ko_to_data.values():
+            for field in data:
+                if field not in fields:
+                    fields.append(field)
+        columns = dict()
+        for field in fields:
+            values = [ko_to_data[id_ko].get(field) for id_ko in ids]
+            if field != "checksum" and all(value is None or isinstance(value, float) for value in values):
+                values = np.asarray([np.nan if value is None else value for value in values], dtype=np.float64)
+            columns[field] = values
+        return cls(ids, columns)
+
+    def to_dict(self):
+        """
+        Get a dictionary of KOfam identifiers to dictionaries of fields (missing values are None).  Pickle databases
+        are written in this layout so they can be loaded by versions without KOfamMetadata.
+        """
+        return {id_ko:{field:self.get_value(i, field) for field in self.fields} for id_ko, i in self.index.items()}
+
+    def get_value(self, row:int, field:str):
+        value = self.columns[field][row]
+        if isinstance(value, np.floating):
+            value = None if np.isnan(value) else float(value)
+        return value
+
+    def set_value(self, row:int, field:str, value):
+        if field not in self.columns:
+            self.columns[field] = [None]*len(self.ids)
+            self.fields.append(field)
+        column = self.columns[field]
+        if isinstance(column, np.ndarray):
+            column[row] = np.nan if value is None else value
+        else:
+            column[row] = value
+        if field == "score_type":
+            self._update_score_types()
+        if field == "threshold":
+            self._scaled_thresholds = dict()
+
+    def get_scaled_thresholds(self, threshold_scale:float):
+        """
+        Get the curated thresholds multiplied by threshold_scale and rounded to 2 decimals for every row
+        (None if there is no threshold).  Computed once per scale.
+        """
+        if threshold_scale not in self._scaled_thresholds:
+            thresholds = list()
+            for threshold in list(self.columns["threshold"]):
+                if threshold is None or threshold != threshold:
+                    threshold = None
+                # Same scaling and rounding as filter_hmmsearch_threshold
+                elif threshold:
+                    threshold = round(float(threshold) * threshold_scale, 2)
+                thresholds.append(threshold)
+            self._scaled_thresholds[threshold_scale] = thresholds
+        return self._scaled_thresholds[threshold_scale]
+
+    def subset(self, ids):
+        """
+        Get a new table with only the KOfams in ids (in the order of this table)
+        """
+        ids = set(ids)
+        rows = [i for id_ko, i in self.index.items() if id_ko in ids]
+        columns = dict()
+        for field, values in self.columns.items():
+            if isinstance(values, np.ndarray):
+                columns[field] = values[rows]
+            else:
+                columns[field] = [values[i] for i in rows]
+        return KOfamMetadata([self.ids[i] for i in rows], columns)
+
+    def to_dataframe(self):
+        df = pd.DataFrame({field:[self.get_value(i, field) for i in self.index.values()] for field in self.fields}, index=list(self.index))
+        df.index.name = "id_ko"
+        return df
+
+    def __getitem__(self, id_ko:str):
+        return KOfamRecord(self, self.index[id_ko])
+
+    def __delitem__(self, id_ko:str):
+        # Rows are kept in the columns so integer rows stay valid
+        del self.index[id_ko]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id_ko):
+        return id_ko in self.index
+
+def parse_ko_list(filepath:str):
+    """
+    Parse ko_list (uncompressed or gzip) into a KOfamMetadata table.  `-` is missing and numeric fields are floats.
+
+    Returns
+    -------
+    ko_to_data : KOfamMetadata
+    """
+    df = pd.read_csv(
+        filepath,
+        sep="\t",
+        index_col=0,
+        dtype=str,
+        na_values=["-"],
+        keep_default_na=False,
+        quoting=csv.QUOTE_NONE,
+        compression="gzip" if filepath.endswith(".gz") else None,
+    )
+    columns = dict()
+    for field, values in df.items():
+        numeric_values = pd.to_numeric(values, errors="coerce")
+        if numeric_values.notna().sum() == values.notna().sum():
+            columns[field] = numeric_values.to_numpy(dtype=np.float64)
+        else:
+            columns[field] = [None if pd.isna(value) else value for value in values.tolist()]
+    return KOfamMetadata(df.index.astype(str).tolist(), columns)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import time, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pyhmmer.easel import Alphabet, DigitalSequenceBlock
+from pyhmmer.plan7 import HMM, Pipeline
+
+# Reduced amino acid alphabet (Murphy et al. 2000, 10 groups) so seeds tolerate conservative substitutions
+REDUCED_ALPHABET = ["LVIM", "C", "A", "G", "ST", "P", "FYW", "EDNQ", "KR", "H"]
+KMER_SIZE = 6
+
+# Minimum number of consensus seeds shared by a protein and a KOfam for the pair to be searched
+SENSITIVITY_TO_MIN_SEEDS = {"high":1, "medium":2, "low":3}
+
+def get_reduction_table(symbols:str):
+    """
+    Lookup table from symbol index to reduced alphabet group (255 for gaps and degenerate residues)
+    """
+    letter_to_group = {letter:i for i, group in enumerate(REDUCED_ALPHABET) for letter in group}
+    return np.asarray([letter_to_group.get(symbol, 255) for symbol in symbols], dtype=np.uint8)
+
+AMINO_REDUCTION_TABLE = get_reduction_table(Alphabet.amino().symbols)
+TEXT_REDUCTION_TABLE = np.full(256, 255, dtype=np.uint8)
+for i, group in enumerate(REDUCED_ALPHABET):
+    for letter in group:
+        TEXT_REDUCTION_TABLE[ord(letter)] = i
+        TEXT_REDUCTION_TABLE[ord(letter.lower())] = i
+
+def get_kmers(reduced:np.ndarray, k:int=KMER_SIZE):
+    """
+    Get the unique k-mer codes of a reduced sequence skipping k-mers with gaps or degenerate residues
+    """
+    if len(reduced) < k:
+        return np.empty(0, dtype=np.uint32)
+    windows = np.lib.stride_tricks.sliding_window_view(reduced, k)
+    windows = windows[(windows < len(REDUCED_ALPHABET)).all(axis=1)]
+    codes = windows.astype(np.uint32) @ (len(REDUCED_ALPHABET) ** np.arange(k - 1, -1, -1, dtype=np.uint32))
+    return np.unique(codes)
+
+def get_consensus_seeds(hmm, k:int=KMER_SIZE):
+    """
+    Get the reduced alphabet k-mer seeds of the consensus sequence of an HMM
+    """
+    consensus = np.frombuffer(hmm.consensus.encode(), dtype=np.uint8)
+    return get_kmers(TEXT_REDUCTION_TABLE[consensus], k=k)
+
+class PrefilterIndex(object):
+    """
+    Inverted index of KOfam consensus seeds used to select candidate (KOfam, protein) pairs
+
+    Usage:
+        index = PrefilterIndex({"K00001":seeds, ...})
+        candidates = index.get_candidates(proteins, min_seeds=1)
+    """
+    def __init__(self, name_to_seeds:dict, k:int=KMER_SIZE):
+        self.k = k
+        # KOfams without seeds are searched against every sequence
+        self.exhaustive = [name for name, seeds in name_to_seeds.items() if seeds is None]
+        name_to_seeds = {name:seeds for name, seeds in name_to_seeds.items() if seeds is not None}
+        self.names = list(name_to_seeds)
+        rows = np.concatenate([np.full(len(seeds), i, dtype=np.int64) for i, seeds in enumerate(name_to_seeds.values())] or [np.empty(0, dtype=np.int64)])
+        codes = np.concatenate([np.asarray(seeds, dtype=np.uint32) for seeds in name_to_seeds.values()] or [np.empty(0, dtype=np.uint32)])
+        order = np.argsort(codes, kind="stable")
+        self.codes = codes[order]
+        self.rows = rows[order]
+
+    def get_candidates(self, sequences, min_seeds:int=1):
+        """
+        Get candidate proteins for each KOfam sharing at least min_seeds seeds
+
+        Returns
+        -------
+        candidates : dict
+            Dictionary of KOfam identifiers to arrays of sequence indices (KOfams without candidates are not included)
+        """
+        sequence_indices = list()
+        sequence_codes = list()
+        for i, seq in enumerate(sequences):
+            codes = get_kmers(AMINO_REDUCTION_TABLE[np.asarray(seq.sequence)], k=self.k)
+            sequence_indices.append(np.full(len(codes), i, dtype=np.int64))
+            sequence_codes.append(codes)
+        candidates = {name:np.arange(len(sequence_codes)) for name in self.exhaustive}
+        if not sequence_codes:
+            return candidates
+        sequence_indices = np.concatenate(sequence_indices)
+        sequence_codes = np.concatenate(sequence_codes)
+
+        # Join sequence k-mers with KOfam seeds on the k-mer code
+        starts = np.searchsorted(self.codes, sequence_codes, side="left")
+        ends = np.searchsorted(self.codes, sequence_codes, side="right")
+        counts = ends - starts
+        pair_sequences = np.repeat(sequence_indices, counts)
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+        pair_rows = self.rows[np.arange(counts.sum()) + offsets]
+
+        # Count shared seeds for each (KOfam, sequence) pair
+        keys, number_of_seeds = np.unique(pair_rows * len(sequences) + pair_sequences, return_counts=True)
+        keys = keys[number_of_seeds >= min_seeds]
+        pair_rows = keys // len(sequences)
+        pair_sequences = keys % len(sequences)
+        boundaries = np.flatnonzero(np.diff(pair_rows)) + 1
+        for rows, indices in zip(np.split(pair_rows, boundaries), np.split(pair_sequences, boundaries)):
+            if len(rows):
+                candidates[self.names[rows[0]]] = indices
+        return candidates
+
+def load_prefilter_index(ko_to_data, name_to_hmm):
+    """
+    Build a PrefilterIndex from the seeds in the metadata (precomputed by serialize_kofam_models) or from the
+    HMM consensus.  KOfams without seeds that are pre-optimized profiles are searched exhaustively.
+    """
+    name_to_seeds = dict()
+    for id_ko in name_to_hmm:
+        seeds = ko_to_data[id_ko].get("seeds")
+        if seeds is None:
+            hmm = name_to_hmm[id_ko]
+            if isinstance(hmm, HMM):
+                seeds = get_consensus_seeds(hmm)
+        name_to_seeds[id_ko] = seeds
+    return PrefilterIndex(name_to_seeds)
+
+def iterate_prefiltered_hits(queries, sequences, candidates:dict=None, n_jobs:int=1, alphabet=None, timings:dict=None, **search_options):
+    """
+    Search each query only against its candidate sequences (queries without candidates are skipped) or
+    against all sequences if candidates is None.  Each thread uses its own Pipeline and search_options must
+    include Z (the number of sequences) so E-values match an exhaustive search.  If timings is provided then
+    the search time (seconds) of each query is stored by KOfam identifier.
+
+    Yields
+    ------
+    TopHits for each query with candidates in the order of queries
+    """
+    if search_options.get("Z") is None:
+        raise ValueError("Z must be provided so E-values do not depend on the number of candidates")
+    if alphabet is None:
+        alphabet = Alphabet.amino()
+    local = threading.local()
+
+    def search(query):
+        pipeline = getattr(local, "pipeline", None)
+        if pipeline is None:
+            pipeline = local.pipeline = Pipeline(alphabet, **search_options)
+        start_time = time.monotonic()
+        if candidates is None:
+            targets = sequences
+        else:
+            targets = DigitalSequenceBlock(alphabet, [sequences[i] for i in candidates[query.name.decode()].tolist()])
+        hits = pipeline.search_hmm(query, targets)
+        pipeline.clear()
+        if timings is not None:
+            timings[query.name.decode()] = time.monotonic() - start_time
+        return hits
+
+    if candidates is not None:
+        queries = [query for query in queries if query.name.decode() in candidates]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        yield from executor.map(search, queries)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import sys, json, time, threading
+from contextlib import contextmanager
+
+# Stages of pykofamsearch.main in the order they are reported
+STAGES = ["database_load", "subset", "digitization", "deduplication", "prefilter", "search", "threshold_filtering", "output"]
+
+# Per-KOfam metrics (pyhmmer does not expose the MSV/bias/Viterbi/Forward filter counts of the pipeline)
+KOFAM_METRICS = ["search_time", "searched_sequences", "searched_residues", "reported_hits", "included_hits", "written_hits"]
+
+class StageProfiler(object):
+    """
+    Wall time of each stage of a run and optional per-KOfam search metrics.
+
+    Stage times are exclusive so time spent in a nested stage (e.g., `output` inside `threshold_filtering`)
+    is only counted for the nested stage.  Stages are tracked per thread so when input, search, and output
+    overlap (see `prefetch` and `BackgroundWorker`) the stage times can add up to more than the wall time.
+
+    Usage:
+        profiler = StageProfiler(per_kofam=True)
+        with profiler.stage("database_load"):
+            ...
+        for hits in profiler.iterate("search", hmmsearch(...)):
+            profiler.record_kofam(hits, search_time=...)
+        profiler.write_json("metrics.json")
+    """
+    def __init__(self, per_kofam:bool=False):
+        self.per_kofam = per_kofam
+        self.stage_to_time = {stage:0.0 for stage in STAGES}
+        self.kofam_to_metrics = dict()
+        self.start_time = time.monotonic()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _add(self, name:str, seconds:float):
+        with self._lock:
+            self.stage_to_time[name] = self.stage_to_time.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name:str):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = list()
+        now = time.monotonic()
+        if stack:
+            parent, start_time = stack[-1]
+            self._add(parent, now - start_time)
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.monotonic()
+            name, start_time = stack.pop()
+            self._add(name, now - start_time)
+            if stack:
+                stack[-1][1] = now
+
+    def iterate(self, name:str, iterable):
+        """
+        Yield from iterable and count the time spent producing each item (e.g., reading a block or waiting for a search) as stage
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record_kofam(self, hits, search_time:float=None, written_hits:int=0):
+        """
+        Add the metrics of a TopHits object to its KOfam (summed across blocks)
+        """
+        if not self.per_kofam:
+            return
+        id_ko = hits.query.name.decode()
+        metrics = self.kofam_to_metrics.get(id_ko)
+        if metrics is None:
+            metrics = self.kofam_to_metrics[id_ko] = dict.fromkeys(KOFAM_METRICS, 0)
+            metrics["search_time"] = 0.0
+        if search_time is not None:
+            metrics["search_time"] += search_time
+        metrics["searched_sequences"] += hits.searched_sequences
+        metrics["searched_residues"] += hits.searched_residues
+        metrics["reported_hits"] += len(hits.reported)
+        metrics["included_hits"] += len(hits.included)
+        metrics["written_hits"] += written_hits
+
+    def get_wall_time(self):
+        return time.monotonic() - self.start_time
+
+    def to_dict(self, **info):
+        return {
+            **info,
+            "wall_time":self.get_wall_time(),
+            "stages":dict(self.stage_to_time),
+            "kofams":self.kofam_to_metrics,
+        }
+
+    def write_json(self, filepath:str, **info):
+        with open(filepath, "w") as f:
+            json.dump(self.to_dict(**info), f, indent=4)
+
+    def write_prometheus(self, filepath:str, **labels):
+        """
+        Write metrics in the Prometheus text exposition format (e.g., for the node_exporter textfile collector)
+        """
+        def format_labels(**kwargs):
+            kwargs = {**labels, **kwargs}
+            if not kwargs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in kwargs.items()) + "}"
+
+        lines = [
+            "# HELP pykofamsearch_wall_seconds Wall time of the run",
+            "# TYPE pykofamsearch_wall_seconds gauge",
+            "pykofamsearch_wall_seconds{} {}".format(format_labels(), self.get_wall_time()),
+            "# HELP pykofamsearch_stage_seconds Wall time of each stage of the run",
+            "# TYPE pykofamsearch_stage_seconds gauge",
+        ]
+        for stage, seconds in self.stage_to_time.items():
+            lines.append("pykofamsearch_stage_seconds{} {}".format(format_labels(stage=stage), seconds))
+        for metric in KOFAM_METRICS:
+            name = "pykofamsearch_kofam_search_seconds" if metric == "search_time" else "pykofamsearch_kofam_{}".format(metric)
+            lines.append("# TYPE {} gauge".format(name))
+            for id_ko, metrics in self.kofam_to_metrics.items():
+                lines.append("{}{} {}".format(name, format_labels(id_ko=id_ko), metrics[metric]))
+        with open(filepath, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def report(self, file=sys.stderr, number_of_kofams:int=10):
+        wall_time = self.get_wall_time()
+        print("Stage wall time:", file=file)
+        for stage, seconds in self.stage_to_time.items():
+            print("    {}: {:0.3f}s ({:0.1%})".format(stage, seconds, seconds/wall_time if wall_time else 0.0), file=file)
+        if self.kofam_to_metrics:
+            print("Slowest KOfams (search time, searched residues, hits written):", file=file)
+            for id_ko, metrics in sorted(self.kofam_to_metrics.items(), key=lambda x: x[1]["search_time"], reverse=True)[:number_of_kofams]:
+                print("    {}: {:0.3f}s, {} residues, {} hits".format(id_ko, metrics["search_time"], metrics["searched_residues"], metrics["written_hits"]), file=file)
+
+class ProfiledWriter(object):
+    """
+    Wrap a HitWriter so time spent formatting and writing output is counted as the `output` stage
+    """
+    def __init__(self, writer, profiler:StageProfiler):
+        self.writer = writer
+        self.profiler = profiler
+
+    def write_columns(self, *args):
+        with self.profiler.stage("output"):
+            self.writer.write_columns(*args)
+
+    def flush(self):
+        with self.profiler.stage("output"):
+            self.writer.flush()
+
+    def close(self):
+        with self.profiler.stage("output"):
+            self.writer.close()
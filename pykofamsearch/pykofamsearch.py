@@ -1,17 +1,41 @@
 #!/usr/bin/env python
-import sys, os, glob, gzip, warnings, argparse, pickle
+import sys, os, glob, time, math, hashlib, warnings, argparse, pickle
 from collections import defaultdict
-from multiprocessing import cpu_count
 from tqdm import tqdm
 from pyhmmer.plan7 import HMMFile
-from pyhmmer.easel import SequenceFile, TextSequence, Alphabet
+from pyhmmer.easel import SequenceFile, TextSequence, Alphabet, DigitalSequenceBlock
 from pyhmmer import hmmsearch
 from . import __version__
+from .writers import HitWriter, TopHitsPerProteinWriter
+from .database import load_serialized_database, get_database_version, load_profile_cache, get_model_checksums, get_model_lengths
+from .result_store import ResultStore, get_sequence_hash
+from .metadata import SCORE_TYPE_CODES, KOfamMetadata, parse_ko_list
+from .prefilter import SENSITIVITY_TO_MIN_SEEDS, load_prefilter_index, iterate_prefiltered_hits
+from .scan import HMMSCAN_MAX_SEQUENCES, optimize_profiles, iterate_scanned_hits
+from .checkpoint import SearchCheckpoint, HitRecorder, get_file_signature
+from .resources import parse_n_jobs, get_available_cpus, get_affinity_cpus, get_cgroup_cpu_quota, get_available_memory, get_resident_memory, plan_memory, format_bytes
+from .profiling import StageProfiler, ProfiledWriter
+from .concurrency import prefetch, BackgroundWorker
+from .compression import open_file, get_compression
 
 # from pandas import notnull
 
 __program__ = os.path.split(sys.argv[0])[-1]
 
+# Default inclusion E-value threshold (incE) used by HMMER and PyHmmer
+INCLUSION_EVALUE = 0.01
+
+# Bits subtracted from E-value cutoffs (see `get_evalue_cutoff`)
+EVALUE_CUTOFF_MARGIN = 0.01
+
+# Proteome files of a multi-proteome input directory
+PROTEOME_EXTENSIONS = (".faa", ".fa", ".fasta", ".fas", ".pep", ".aa")
+COMPRESSION_EXTENSIONS = (".gz", ".bgz", ".pgz", ".zst")
+
+# KOfams sorted together by `--schedule length` (results are buffered for at most one chunk)
+SCHEDULE_CHUNK_SIZE = 64
+SCHEDULE_KOFAMS_PER_THREAD = 4
+
 # Filter 
 def filter_hmmsearch_threshold(
     hit,
@@ -19,7 +43,11 @@ def filter_hmmsearch_threshold(
     threshold_scale:float,
     score_type:str,
     return_failed_threshold:bool,
+    evalue:float=None,
     ):
+    # E-value can be provided when the hit was searched with a different number of sequences (Z)
+    if evalue is None:
+        evalue = hit.evalue
     # If threshold is not None
     if threshold:
         threshold = round(threshold * threshold_scale, 2)
@@ -31,17 +59,733 @@ def filter_hmmsearch_threshold(
             else:
                 score = hit.score
             if score >= threshold:
-                evalue = hit.evalue
                 return (threshold, score, evalue)
     else:
         score = hit.score
         if score_type:
             if score_type == "domain":
                 score = hit.best_domain.score
-        evalue = hit.evalue
         return (threshold, score, evalue)
 
+def parse_memory(value:str):
+    """
+    Parse a memory value with an optional K/M/G/T suffix (e.g., 512M, 2G) into bytes
+    """
+    value = str(value).strip().upper()
+    if value.endswith("B"):
+        value = value[:-1]
+    multiplier = 1
+    for i, suffix in enumerate("KMGT", start=1):
+        if value.endswith(suffix):
+            multiplier = 1024 ** i
+            value = value[:-1]
+            break
+    return int(float(value) * multiplier)
+
+def count_fasta_records(filepath:str, threads:int=1):
+    """
+    Count the number of records in a fasta file (uncompressed, gzip, BGZF, or zstd) without parsing sequences
+    """
+    n = 0
+    with open_file(filepath, "rb", threads=threads) as f:
+        for line in f:
+            if line.startswith(b">"):
+                n += 1
+    return n
+
+def open_sequence_file(filepath:str, threads:int=1, **kwargs):
+    """
+    Open a fasta file or stdin as a SequenceFile.  Uncompressed files are read directly by Easel while compressed
+    files (gzip, BGZF, or zstd), pipes, and stdin are streamed by Easel from `open_file` (decompressed on threads for BGZF).
+    """
+    if filepath == "stdin":
+        return SequenceFile(open_file(sys.stdin.buffer, "rb", threads=threads), format="fasta", **kwargs)
+    if os.path.isfile(filepath) and get_compression(filepath) is None:
+        return SequenceFile(filepath, format="fasta", **kwargs)
+    return SequenceFile(open_file(filepath, "rb", threads=threads), format="fasta", **kwargs)
+
+def iterate_sequence_blocks(
+    proteins:str,
+    sequences_per_block:int=None,
+    residues_per_block:int=None,
+    threads:int=1,
+    ):
+    """
+    Yield DigitalSequenceBlock objects of bounded size from a fasta file, pipe, or stdin
+    """
+    alphabet = Alphabet.amino()
+    with open_sequence_file(proteins, threads=threads, digital=True, alphabet=alphabet) as f:
+        while True:
+            block = f.read_block(sequences=sequences_per_block, residues=residues_per_block)
+            if not len(block):
+                break
+            yield block
+
+def deduplicate_sequences(sequences, alphabet=None):
+    """
+    Collapse identical digital sequences into the first occurrence
+
+    Parameters
+    ----------
+    sequences : DigitalSequenceBlock or list
+        Digital sequences
+    alphabet : Alphabet
+        Alphabet of the sequences [Default: amino]
+
+    Returns
+    -------
+    unique_sequences : DigitalSequenceBlock
+        First occurrence of each unique sequence in input order
+    duplicates : dict
+        Dictionary of representative names to the names of all identical sequences (including the representative)
+        sorted by name which is how HMMER orders hits with the same score.  Only representatives with duplicates are included.
+    """
+    if alphabet is None:
+        alphabet = Alphabet.amino()
+    unique_sequences = DigitalSequenceBlock(alphabet)
+    checksum_to_name = dict()
+    duplicates = defaultdict(list)
+    for seq in sequences:
+        checksum = hashlib.md5(seq.sequence).digest()
+        name = seq.name.decode()
+        if checksum in checksum_to_name:
+            representative = checksum_to_name[checksum]
+            if representative not in duplicates:
+                duplicates[representative].append(representative)
+            duplicates[representative].append(name)
+        else:
+            checksum_to_name[checksum] = name
+            unique_sequences.append(seq)
+    return unique_sequences, {representative:sorted(names) for representative, names in duplicates.items()}
+
+def iterate_deduplicated_blocks(blocks, deduplicate:bool=True, profiler:StageProfiler=None):
+    """
+    Yield (proteins, duplicates) for each block where duplicates is from `deduplicate_sequences` (None if not deduplicate)
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+    for proteins in blocks:
+        duplicates = None
+        if deduplicate:
+            with profiler.stage("deduplication"):
+                proteins, duplicates = deduplicate_sequences(proteins)
+        yield proteins, duplicates
+
+def get_sample_identifier(filepath:str):
+    """
+    Get the sample identifier of a proteome from its filename without compression and fasta extensions (e.g., genome_1.faa.gz -> genome_1)
+    """
+    name = os.path.basename(filepath)
+    if name.endswith(COMPRESSION_EXTENSIONS):
+        name = os.path.splitext(name)[0]
+    if name.endswith(PROTEOME_EXTENSIONS):
+        name = os.path.splitext(name)[0]
+    return name
+
+def get_input_samples(proteins:str):
+    """
+    Get the proteomes of a multi-proteome input
+
+    * Directory: every fasta file (.faa, .fa, .fasta, .fas, .pep, or .aa optionally with .gz, .bgz, .pgz, or .zst) with the sample identifier from the filename
+    * Manifest: a file that does not start with `>` with one path/to/proteins.fasta per line and an optional first column (tab-separated) of sample identifiers.  Empty lines and lines starting with `#` are ignored.
+
+    Returns
+    -------
+    samples : list or None
+        List of (id_sample, path/to/proteins.fasta) or None if proteins is a fasta file, pipe, or stdin
+    """
+    if proteins == "stdin":
+        return None
+    samples = list()
+    if os.path.isdir(proteins):
+        for filename in sorted(os.listdir(proteins)):
+            filepath = os.path.join(proteins, filename)
+            name = os.path.splitext(filename)[0] if filename.endswith(COMPRESSION_EXTENSIONS) else filename
+            if not filename.startswith(".") and name.endswith(PROTEOME_EXTENSIONS) and os.path.isfile(filepath):
+                samples.append((get_sample_identifier(filename), filepath))
+        if not samples:
+            raise ValueError("No proteomes ({}) in directory: {}".format(", ".join(PROTEOME_EXTENSIONS), proteins))
+    else:
+        # Pipes and process substitutions are always fasta because peeking would consume them
+        if not os.path.isfile(proteins):
+            return None
+        with open_file(proteins, "rt") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line.strip():
+                    continue
+                if not samples and line.startswith(">"):
+                    return None
+                if line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                if len(fields) == 1:
+                    samples.append((get_sample_identifier(fields[0]), fields[0]))
+                elif len(fields) == 2:
+                    samples.append((fields[0], fields[1]))
+                else:
+                    raise ValueError("Manifest lines must be either path/to/proteins.fasta or [id_sample]<tab>[path/to/proteins.fasta]: {}".format(line))
+        if not samples:
+            return None
+    sample_to_count = defaultdict(int)
+    for id_sample, filepath in samples:
+        sample_to_count[id_sample] += 1
+    duplicate_samples = sorted(id_sample for id_sample, count in sample_to_count.items() if count > 1)
+    if duplicate_samples:
+        raise ValueError("Sample identifiers must be unique: {}".format(", ".join(duplicate_samples)))
+    return samples
+
+def iterate_sample_blocks(
+    samples,
+    sequences_per_block:int=None,
+    residues_per_block:int=None,
+    deduplicate:bool=True,
+    threads:int=1,
+    profiler:StageProfiler=None,
+    ):
+    """
+    Pack the proteomes of several samples into shared blocks so they are searched in a single pass.
+    Proteomes are not split across blocks (a proteome larger than the block size is its own block) so the
+    hits of each sample are in the same order as searching the sample on its own.  Sequences are renamed
+    `<sample index>|<identifier>` and identical sequences are collapsed within each sample.
+
+    Yields
+    ------
+    proteins : DigitalSequenceBlock
+        Tagged sequences of the block
+    duplicates : dict or None
+        See `deduplicate_sequences` (tagged names, None if not deduplicate)
+    sample_to_size : dict
+        Sample indices of the block to their number of sequences (before deduplication)
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+    alphabet = Alphabet.amino()
+    block = DigitalSequenceBlock(alphabet)
+    block_duplicates = dict() if deduplicate else None
+    sample_to_size = dict()
+    number_of_residues = 0
+    for i, (id_sample, filepath) in enumerate(samples):
+        with profiler.stage("digitization"):
+            with open_sequence_file(filepath, threads=threads, digital=True, alphabet=alphabet) as f:
+                proteins = f.read_block()
+        number_of_sequences = len(proteins)
+        duplicates = None
+        if deduplicate:
+            with profiler.stage("deduplication"):
+                proteins, duplicates = deduplicate_sequences(proteins, alphabet=alphabet)
+        residues = sum(len(seq) for seq in proteins)
+        if sample_to_size and any([
+            sequences_per_block and len(block) + len(proteins) > sequences_per_block,
+            residues_per_block and number_of_residues + residues > residues_per_block,
+            ]):
+            yield block, block_duplicates, sample_to_size
+            block = DigitalSequenceBlock(alphabet)
+            block_duplicates = dict() if deduplicate else None
+            sample_to_size = dict()
+            number_of_residues = 0
+        prefix = "{}|".format(i)
+        for seq in proteins:
+            seq.name = prefix.encode() + seq.name
+            block.append(seq)
+        if duplicates:
+            for representative, names in duplicates.items():
+                block_duplicates[prefix + representative] = [prefix + name for name in names]
+        sample_to_size[i] = number_of_sequences
+        number_of_residues += residues
+    if sample_to_size:
+        yield block, block_duplicates, sample_to_size
+
+def write_hits(
+    hits,
+    ko_to_data:KOfamMetadata,
+    threshold_scale:float,
+    all_hits:bool,
+    writer,
+    evalue_threshold:float=None,
+    duplicates:dict=None,
+    ):
+    """
+    Write the hits from a TopHits object that pass the curated threshold (or all included hits if all_hits).
+    Hits are collected into columns and written in bulk by a HitWriter.
+    If evalue_threshold is provided then it is used for inclusion instead of `hit.included` which is
+    necessary when the search used bit score cutoffs (see `prepare_threshold_queries`).
+    If duplicates is provided (see `deduplicate_sequences`) then each hit is written for all identical sequences.
+    Returns the number of rows written.
+    """
+    id_ko = hits.query.name.decode()
+    # Thresholds and score types are looked up once per KOfam by integer row (see KOfamMetadata)
+    i = ko_to_data.index[id_ko]
+    threshold = ko_to_data.get_scaled_thresholds(threshold_scale)[i]
+    score_type_code = ko_to_data.score_type_codes[i]
+    domain = score_type_code == SCORE_TYPE_CODES["domain"]
+    id_proteins = list()
+    thresholds = list()
+    scores = list()
+    evalues = list()
+    for hit in hits:
+        if hit.evalue <= evalue_threshold if evalue_threshold is not None else hit.included:
+            # Same logic as filter_hmmsearch_threshold with the threshold already scaled
+            score = hit.best_domain.score if domain else hit.score
+            if all_hits or (score_type_code and score >= threshold):
+                id_protein = hit.name.decode()
+                ids = [id_protein]
+                if duplicates and id_protein in duplicates:
+                    ids = duplicates[id_protein]
+                evalue = hit.evalue
+                for id_protein in ids:
+                    id_proteins.append(id_protein)
+                    thresholds.append(threshold)
+                    scores.append(score)
+                    evalues.append(evalue)
+    if id_proteins:
+        n = len(id_proteins)
+        data = ko_to_data[id_ko]
+        writer.write_columns(id_proteins, [id_ko]*n, thresholds, scores, evalues, [data["definition"]]*n, [data["enzyme_commission"]]*n)
+    return len(id_proteins)
+
+def write_sample_hits(
+    hits,
+    ko_to_data:KOfamMetadata,
+    threshold_scale:float,
+    all_hits:bool,
+    sample_to_writer:dict,
+    sample_to_z:dict,
+    evalue_threshold:float,
+    duplicates:dict=None,
+    ):
+    """
+    Write the hits of a multi-proteome search (see `iterate_sample_blocks`) to the writer of each sample
+    with the sample tag removed from the identifiers.  E-values are recomputed from P-values with the number
+    of sequences (Z) of each sample so inclusion uses evalue_threshold (i.e., min(evalue, INCLUSION_EVALUE))
+    instead of `hit.included`.  Returns the number of rows written.
+    """
+    id_ko = hits.query.name.decode()
+    i = ko_to_data.index[id_ko]
+    threshold = ko_to_data.get_scaled_thresholds(threshold_scale)[i]
+    score_type_code = ko_to_data.score_type_codes[i]
+    domain = score_type_code == SCORE_TYPE_CODES["domain"]
+    sample_to_columns = dict()
+    for hit in hits:
+        id_protein = hit.name.decode()
+        sample = int(id_protein.split("|", 1)[0])
+        evalue = hit.pvalue * sample_to_z[sample]
+        if evalue <= evalue_threshold:
+            score = hit.best_domain.score if domain else hit.score
+            if all_hits or (score_type_code and score >= threshold):
+                ids = [id_protein]
+                if duplicates and id_protein in duplicates:
+                    ids = duplicates[id_protein]
+                if sample not in sample_to_columns:
+                    sample_to_columns[sample] = (list(), list(), list(), list())
+                id_proteins, thresholds, scores, evalues = sample_to_columns[sample]
+                for id_protein in ids:
+                    id_proteins.append(id_protein.split("|", 1)[1])
+                    thresholds.append(threshold)
+                    scores.append(score)
+                    evalues.append(evalue)
+    number_of_hits = 0
+    data = ko_to_data[id_ko]
+    for sample, (id_proteins, thresholds, scores, evalues) in sample_to_columns.items():
+        n = len(id_proteins)
+        sample_to_writer[sample].write_columns(id_proteins, [id_ko]*n, thresholds, scores, evalues, [data["definition"]]*n, [data["enzyme_commission"]]*n)
+        number_of_hits += n
+    return number_of_hits
+
+def schedule_queries(name_to_hmm, schedule:str="length", ko_to_data:KOfamMetadata=None, n_jobs:int=1):
+    """
+    Order queries for hmmsearch.  Threads take queries in order so dispatching the longest models
+    first (cost is proportional to model length x target residues) avoids idle threads at the end.
+
+    Models are sorted longest first within consecutive chunks of the database order (at least
+    SCHEDULE_CHUNK_SIZE KOfams and SCHEDULE_KOFAMS_PER_THREAD KOfams per thread) instead of globally.  hmmsearch
+    yields results in query order so `reorder_results` only buffers the results of one chunk before
+    writing them in database order.  Model lengths are read from the metadata (see `get_model_lengths`)
+    so HMMs of indexed databases are not decoded to be sorted.
+
+    Parameters
+    ----------
+    name_to_hmm : dict
+        Mapping of KOfam identifiers to HMMs (or Profiles/OptimizedProfiles)
+    schedule : str
+        `length` for longest models first or `database` for database order
+    ko_to_data : KOfamMetadata
+        KOfam metadata with model lengths [Default: Lengths from the HMMs]
+    n_jobs : int
+        Number of search threads
+
+    Returns
+    -------
+    queries : list
+    """
+    if schedule == "length":
+        model_lengths = get_model_lengths(ko_to_data if ko_to_data is not None else dict(), name_to_hmm)
+        chunk_size = max(SCHEDULE_CHUNK_SIZE, SCHEDULE_KOFAMS_PER_THREAD * n_jobs)
+        ids = list(model_lengths)
+        order = list()
+        for start in range(0, len(ids), chunk_size):
+            order.extend(sorted(ids[start:start + chunk_size], key=model_lengths.get, reverse=True))
+        return [name_to_hmm[id_ko] for id_ko in order]
+    elif schedule == "database":
+        return list(name_to_hmm.values())
+    else:
+        raise ValueError("schedule must be either `length` or `database`")
+
+def reorder_results(items, order):
+    """
+    Reorder search results that arrive in schedule order (e.g., longest models first) into database order.
+    Results are buffered until every earlier KOfam is available so the output order does not depend on the schedule.
+    KOfams of order that never arrive (e.g., skipped by the prefilter) are passed over when items are exhausted.
+
+    Parameters
+    ----------
+    items : iterable
+        (id_ko, result) pairs in any order
+    order : list
+        KOfam identifiers in output (database) order
+
+    Yields
+    ------
+    (id_ko, result) pairs in order
+    """
+    id_ko_to_position = {id_ko:j for j, id_ko in enumerate(order)}
+    position_to_item = dict()
+    position = 0
+    for id_ko, result in items:
+        position_to_item[id_ko_to_position[id_ko]] = (id_ko, result)
+        while position in position_to_item:
+            yield position_to_item.pop(position)
+            position += 1
+    for j in sorted(position_to_item):
+        yield position_to_item[j]
+
+def get_evalue_cutoff(query, evalue:float, number_of_sequences:int):
+    """
+    Get the sequence bit score of a query with an E-value of evalue when searching number_of_sequences (Z) sequences.
+    Sequence P-values are the exponential tail of the Forward score (P = exp(-lambda * (score - tau))) so hits
+    below this score can never have E = P * Z <= evalue.  Returns -inf if every hit can pass (evalue >= Z).
+    """
+    if not number_of_sequences or evalue >= number_of_sequences:
+        return float("-inf")
+    tau = query.evalue_parameters.f_tau
+    lambda_ = query.evalue_parameters.f_lambda
+    # Cutoffs are stored as single precision so a small margin keeps hits at the boundary
+    return tau - math.log(evalue / number_of_sequences) / lambda_ - EVALUE_CUTOFF_MARGIN
+
+def set_threshold_cutoffs(queries, ko_to_data:KOfamMetadata, threshold_scale:float, evalue_threshold:float=None, number_of_sequences:int=None):
+    """
+    Set the trusted cutoffs of threshold queries in place (see `prepare_threshold_queries`).  Used to update
+    the E-value cutoffs when the number of sequences changes (e.g., between proteomes) without copying the queries.
+    """
+    lowest_score = float("-inf")
+    scaled_thresholds = ko_to_data.get_scaled_thresholds(threshold_scale)
+    for query in queries:
+        i = ko_to_data.index[query.name.decode()]
+        threshold = scaled_thresholds[i]
+        cutoff = lowest_score
+        if evalue_threshold is not None:
+            cutoff = get_evalue_cutoff(query, evalue_threshold, number_of_sequences)
+        if ko_to_data.score_type_codes[i] != SCORE_TYPE_CODES["domain"] and threshold is not None:
+            cutoff = max(cutoff, threshold)
+        query.cutoffs.trusted = (cutoff, lowest_score)
+    return queries
+
+def prepare_threshold_queries(queries, ko_to_data:KOfamMetadata, threshold_scale:float, evalue_threshold:float=None, number_of_sequences:int=None):
+    """
+    Push the curated thresholds into the search as per-model bit score cutoffs (like hmmsearch --cut_tc)
+    so hits that can never pass are not stored or iterated in Python.
+
+    * KOfams without a score_type never report hits so they are not searched
+    * KOfams with score_type `full` use the maximum of the scaled threshold and the E-value cutoff as the sequence cutoff
+    * KOfams with score_type `domain` use the E-value cutoff because the sequence score does not bound the best domain score
+
+    The E-value cutoff is the sequence score with an E-value of evalue_threshold for number_of_sequences (see `get_evalue_cutoff`)
+    so KOfams that cannot use thresholds are still pruned like an E-value search.  The search must use `bit_cutoffs="trusted"`
+    which replaces E-value reporting and inclusion so hits should be written with `evalue_threshold=min(evalue, INCLUSION_EVALUE)`.
+
+    Returns
+    -------
+    queries : list
+        Copies of the queries with trusted cutoffs set
+    """
+    threshold_queries = [query.copy() for query in queries if ko_to_data.score_type_codes[ko_to_data.index[query.name.decode()]]]
+    return set_threshold_cutoffs(threshold_queries, ko_to_data, threshold_scale, evalue_threshold=evalue_threshold, number_of_sequences=number_of_sequences)
+
+def read_text_sequences(proteins:str, threads:int=1):
+    """
+    Read (identifier, sequence) pairs from a fasta file or stdin
+    """
+    records = list()
+    with open_sequence_file(proteins, threads=threads, digital=False) as f:
+        for seq in f:
+            records.append((seq.name.decode(), seq.sequence))
+    return records
+
+def update_result_store(
+    store,
+    hash_to_sequence:dict,
+    name_to_hmm,
+    model_checksums:dict,
+    n_jobs:int=1,
+    sequences_per_block:int=None,
+    ):
+    """
+    Search the (sequence x model) pairs that are missing from a result store:
+
+    * stored sequences x new or changed models
+    * new sequences x all models
+
+    Models that are not in the database are removed from the store when new sequences are added.  Searches do not use Z
+    or E-value reporting thresholds because hits are stored with P-values and E-values are computed at output.
+
+    Returns
+    -------
+    new_sequences : dict
+        Sequences that were searched against all models
+    new_models : dict
+        KOfams that were searched against all stored sequences
+    removed_models : set
+        Checksums of models that were removed from the store
+    """
+    alphabet = Alphabet.amino()
+    if sequences_per_block is None:
+        sequences_per_block = 10000
+    stored_models = store.get_models()
+    new_models = {id_ko:checksum for id_ko, checksum in model_checksums.items() if checksum not in stored_models}
+    stored_sequences = store.get_sequence_hashes()
+    new_sequences = {sequence_hash:sequence for sequence_hash, sequence in hash_to_sequence.items() if sequence_hash not in stored_sequences}
+
+    # Every stored sequence must be searched against every stored model so models that are not in this
+    # database (e.g., previous versions or --subset) are removed only when new sequences are added
+    removed_models = set()
+    if new_sequences:
+        removed_models = stored_models - set(model_checksums.values())
+        store.remove_models(removed_models)
+
+    def search(queries, rows, desc):
+        block = DigitalSequenceBlock(alphabet, [TextSequence(name=sequence_hash.encode(), sequence=sequence).digitize(alphabet) for sequence_hash, sequence in rows])
+        for hits in tqdm(hmmsearch(queries, block, cpus=n_jobs, E=float("inf")), desc=desc, total=len(queries)):
+            checksum = model_checksums[hits.query.name.decode()]
+            store.add_hits((hit.name.decode(), checksum, hit.score, hit.best_domain.score, hit.pvalue) for hit in hits)
+
+    # Stored sequences x new or changed models
+    if new_models and stored_sequences:
+        queries = [name_to_hmm[id_ko] for id_ko in new_models]
+        for i, rows in enumerate(store.iterate_sequences(batch_size=sequences_per_block), start=1):
+            search(queries, rows, f"Performing HMMSearch [Stored sequences x new models, block {i}]")
+
+    # New sequences x all models
+    if new_sequences:
+        queries = schedule_queries(name_to_hmm, schedule="length", n_jobs=n_jobs)
+        rows = list(new_sequences.items())
+        for i, start in enumerate(range(0, len(rows), sequences_per_block), start=1):
+            search(queries, rows[start:start + sequences_per_block], f"Performing HMMSearch [New sequences x all models, block {i}]")
+        store.add_sequences(new_sequences)
+    store.add_models({checksum:id_ko for id_ko, checksum in new_models.items()})
+    return new_sequences, new_models, removed_models
+
+def write_stored_hits(
+    store,
+    records:list,
+    model_checksums:dict,
+    ko_to_data:KOfamMetadata,
+    threshold_scale:float,
+    all_hits:bool,
+    writer,
+    evalue:float,
+    number_of_sequences:int,
+    ):
+    """
+    Write hits from a result store for the input records (identifier, sequence hash) in database order.
+    E-values are computed from the stored P-values with the number of sequences (Z) of the input and
+    inclusion uses the same E-value threshold as hmmsearch (min(evalue, INCLUSION_EVALUE)).
+    """
+    hash_to_ids = defaultdict(list)
+    for id_protein, sequence_hash in records:
+        hash_to_ids[sequence_hash].append(id_protein)
+    evalue_threshold = min(evalue, INCLUSION_EVALUE)
+    scaled_thresholds = ko_to_data.get_scaled_thresholds(threshold_scale)
+    for id_ko, checksum in tqdm(model_checksums.items(), desc="Writing stored hits", total=len(model_checksums)):
+        i = ko_to_data.index[id_ko]
+        threshold = scaled_thresholds[i]
+        score_type_code = ko_to_data.score_type_codes[i]
+        domain = score_type_code == SCORE_TYPE_CODES["domain"]
+        id_proteins = list()
+        thresholds = list()
+        scores = list()
+        evalues = list()
+        for sequence_hash, score, domain_score, pvalue in store.get_hits(checksum):
+            ids = hash_to_ids.get(sequence_hash)
+            if ids is None:
+                continue
+            hit_evalue = pvalue * number_of_sequences
+            if hit_evalue <= evalue_threshold:
+                hit_score = domain_score if domain else score
+                if all_hits or (score_type_code and hit_score >= threshold):
+                    for id_protein in ids:
+                        id_proteins.append(id_protein)
+                        thresholds.append(threshold)
+                        scores.append(hit_score)
+                        evalues.append(hit_evalue)
+        if id_proteins:
+            n = len(id_proteins)
+            data = ko_to_data[id_ko]
+            writer.write_columns(id_proteins, [id_ko]*n, thresholds, scores, evalues, [data["definition"]]*n, [data["enzyme_commission"]]*n)
+
+class HitPairCollector(object):
+    """
+    Collect the (id_protein, id_ko) pairs written by write_hits (used to benchmark the prefilter)
+    """
+    def __init__(self):
+        self.pairs = set()
+
+    def write_columns(self, id_proteins, id_kos, *args):
+        self.pairs.update(zip(id_proteins, id_kos))
+
+class ThreadUtilizationMonitor(object):
+    """
+    Sample per-thread CPU time from /proc/self/task (Linux) to report how busy the search threads were
+    """
+    def __init__(self, interval:float=1.0):
+        self.interval = interval
+        self.available = os.path.isdir("/proc/self/task")
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if self.available else None
+        self.thread_to_cputime = dict()
+        self.main_thread = str(os.getpid())
+        self.last_sample = 0.0
+        self.start_time = None
+        self.start_cputime = None
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def start(self):
+        self.start_time = time.monotonic()
+        times = os.times()
+        self.start_cputime = times.user + times.system
+
+    def sample(self, force:bool=False):
+        if not self.available:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_sample < self.interval:
+            return
+        self.last_sample = now
+        for tid in os.listdir("/proc/self/task"):
+            try:
+                with open(f"/proc/self/task/{tid}/stat", "r") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+            # utime and stime are the 14th and 15th fields of stat
+            cputime = (int(fields[11]) + int(fields[12]))/self.clock_ticks
+            self.thread_to_cputime[tid] = max(cputime, self.thread_to_cputime.get(tid, 0.0))
+
+    def stop(self):
+        self.sample(force=True)
+        self.wall_time += time.monotonic() - self.start_time
+        times = os.times()
+        self.cpu_time += times.user + times.system - self.start_cputime
+
+    def report(self, n_jobs:int, file=sys.stderr, per_thread:bool=False):
+        if self.wall_time <= 0:
+            return
+        print("Search wall time: {:0.2f}s | CPU time: {:0.2f}s | Thread utilization: {:0.1%} of {} threads".format(self.wall_time, self.cpu_time, self.cpu_time/(self.wall_time * n_jobs), n_jobs), file=file)
+        if per_thread:
+            for tid, cputime in sorted(self.thread_to_cputime.items(), key=lambda x: x[1], reverse=True):
+                if tid != self.main_thread and cputime > 0:
+                    print("Thread {}: {:0.2f}s CPU ({:0.1%} of search wall time)".format(tid, cputime, cputime/self.wall_time), file=file)
+
+def load_database(
+    database_directory:str=None,
+    serialized_database:str=None,
+    profile_cache_directory:str=None,
+    subset:str=None,
+    profiler:StageProfiler=None,
+    threads:int=1,
+    ):
+    """
+    Load the KOfam thresholds and HMMs from a database directory or serialized database.
+    If profiler is provided then loading and subsetting are timed as the `database_load` and `subset` stages.
+    Compressed pickle databases are decompressed with threads (BGZF or zstd).
+
+    Returns
+    -------
+    ko_to_data : KOfamMetadata
+        Table of KOfam metadata
+    name_to_hmm : dict
+        Mapping of KOfam identifiers to HMMs (or OptimizedProfiles if profile_cache_directory)
+    missing_kos : set
+        KOfams in ko_list without HMMs
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    with profiler.stage("database_load"):
+        if serialized_database:
+            print("Loading serialized KOFAM database", file=sys.stderr)
+            # Load serialized database (HMMs from indexed databases are decoded lazily)
+            ko_to_data, name_to_hmm = load_serialized_database(serialized_database, threads=threads)
+            missing_kos = ko_to_data.keys() - name_to_hmm.keys()
+
+        else:
+            # Load KOFAM thresholds
+            ko_to_data = parse_ko_list(os.path.join(database_directory, "ko_list"))
+                
+            # Load HMMs
+            name_to_hmm = dict()
+            missing_kos = set()
+            for id_ko in tqdm(ko_to_data, desc="Loading HMMs", total=len(ko_to_data)):
+                ko_filepath = os.path.join(database_directory, "profiles", f"{id_ko}.hmm")
+                try:
+                    with HMMFile(ko_filepath) as f:
+                        for hmm in list(f):
+                            name_to_hmm[hmm.name.decode()] = hmm
+                except FileNotFoundError:
+                    missing_kos.add(id_ko)
+
+    with profiler.stage("subset"):
+        # Subset
+        # ======
+        if subset:
+            subset_kos = set()
+            with open(subset, "r") as f:
+                for line in f:
+                    if line:
+                        if not line.startswith("#"):
+                            subset_kos.add(line.strip())
+            print("Unique subset: {} KOfams".format(len(subset_kos)), file=sys.stderr)
+            print("Subset missing from database: {} KOfams".format(len(subset_kos - set(ko_to_data.keys()))), file=sys.stderr)
+        else:
+            subset_kos = set(ko_to_data.keys())
+        
+        # Ignore
+        # ======
+        ignore_kos = set(ko_to_data.keys()) - subset_kos
+        if ignore_kos:
+            for id_ko in ignore_kos:
+                if id_ko in ko_to_data:
+                    del ko_to_data[id_ko]
+                if id_ko in name_to_hmm:
+                    del name_to_hmm[id_ko]
+
+    # Pre-optimized profiles
+    # ======================
+    # Only the subset is optimized and the cache is keyed by the content of its models
+    if profile_cache_directory:
+        with profiler.stage("database_load"):
+            database_version = get_database_version(ko_to_data, name_to_hmm)
+            print("Loading pre-optimized profiles from cache: {}".format(profile_cache_directory), file=sys.stderr)
+            name_to_hmm = load_profile_cache(profile_cache_directory, database_version, name_to_hmm)
+
+    return ko_to_data, name_to_hmm, missing_kos
+
 def main(args=None):
+    # Server mode
+    # ===========
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from .serve_pykofamsearch import main as serve_main
+        return serve_main(sys.argv[2:])
+
     # Options
     # =======
     # Path info
@@ -60,23 +804,45 @@ def main(args=None):
     parser.add_argument('-v', '--version', action='version', version=__version__)
 
     parser_io = parser.add_argument_group('I/O arguments')
-    parser_io.add_argument("-i","--proteins", type=str, default="stdin", help = "path/to/proteins.fasta. stdin does not stream and loads everything into memory. [Default: stdin]")
-    parser_io.add_argument("-o","--output", type=str, default="stdout", help = "path/to/output.tsv [Default: stdout]")
+    parser_io.add_argument("-i","--proteins", type=str, default="stdin", help = "path/to/proteins.fasta (uncompressed, gzip, BGZF, or zstd) or stdin.  Everything is loaded into memory unless --sequences_per_block or --max_block_memory is used (also streams stdin and pipes).  Multiple proteomes can be provided as a directory of fasta files or a manifest ([id_sample]<tab>[path/to/proteins.fasta] per line) which are searched in a single pass and written to separate files in -o/--output [Default: stdin]")
+    parser_io.add_argument("-o","--output", type=str, default="stdout", help = "path/to/output.tsv or path/to/output_directory/ for multiple proteomes [Default: stdout]")
     parser_io.add_argument("-s", "--subset", type=str, help = "path/to/identifiers.list where HMM identifiers are on a separate line used to subset the database. Only HMMs in the subset will be used.")
     parser_io.add_argument("--no_header", action="store_true", help = "No header")
+    parser_io.add_argument("--format", type=str, default="tsv", choices={"tsv", "parquet", "arrow"}, help = "Output format. `parquet` and `arrow` are typed columnar formats that require `pyarrow` [Default: tsv]")
+    parser_io.add_argument("--output_suffix", type=str, help = "Suffix of the output files of multiple proteomes (e.g., .tsv.gz) [Default: .tsv, .parquet, or .arrow from --format]")
+    parser_io.add_argument("--evalue_scope", type=str, default="sample", choices={"sample", "global"}, help = "Number of sequences (Z) used for E-values with multiple proteomes. `sample` uses the size of each proteome (same as searching each proteome separately) and `global` uses the total of all proteomes.  -Z/--number_of_sequences overrides both [Default: sample]")
+    parser_io.add_argument("--result_store", type=str, help = "path/to/results.sqlite persistent result store keyed by sequence hash and model checksum.  Only new sequences (x all models) and new or changed models (x all stored sequences) are searched and the output is written from the store in database order")
 
     parser_utility = parser.add_argument_group('Utility arguments')
-    parser_utility.add_argument("-p","--n_jobs", type=int, default=1,  help = "Number of threads to use [Default: 1]")
-    # parser_utility.add_argument("--stream", action="store_true", help = "Stream input protein sequences and do not load all sequences into memory. Much slower and not recommended.")
+    parser_utility.add_argument("-p","--n_jobs", type=parse_n_jobs, default=1,  help = "Number of threads to use.  `auto` (or -1) uses the CPUs available to the process (CPU affinity limited by the cgroup CPU quota) [Default: 1]")
+    parser_utility.add_argument("--memory_limit", type=str, help = "Memory budget (e.g., 4G) or `auto` for the cgroup memory limit (available memory if there is no limit).  Threads and the input block size (unless --sequences_per_block or --max_block_memory) are chosen to fit after loading the database")
+    parser_utility.add_argument("--sequences_per_block", type=int, help = "Read and search input proteins in blocks of at most this many sequences instead of loading everything into memory")
+    parser_utility.add_argument("--max_block_memory", type=str, help = "Read and search input proteins in blocks of at most this many residues (~bytes) (e.g., 512M, 2G)")
+    parser_utility.add_argument("--profile", action="store_true", help = "Report the wall time of each stage (database load, subset, digitization, deduplication, prefilter, search, threshold filtering, and output) and the slowest KOfams")
+    parser_utility.add_argument("--metrics_json", type=str, help = "path/to/metrics.json with stage wall times and per-KOfam search time, searched sequences and residues, and reported, included, and written hits")
+    parser_utility.add_argument("--metrics_prometheus", type=str, help = "path/to/metrics.prom with the metrics of --metrics_json in the Prometheus text format (e.g., for the node_exporter textfile collector)")
+    parser_utility.add_argument("--no_pipelining", action="store_true", help = "Do not overlap reading, searching, and writing.  By default, the next block is digitized and the hits of the current block are filtered and written on background threads while the current block is searched (up to 2 additional blocks are held in memory)")
+    parser_utility.add_argument("--checkpoint_directory", type=str, help = "path/to/checkpoint_directory/ to journal the hits of each completed KOfam of each block.  If the run is interrupted then rerunning the same command skips completed KOfams and rewrites the output which is the same as an uninterrupted run")
+    parser_utility.add_argument("--no_deduplication", action="store_true", help = "Do not collapse identical sequences before searching.  By default, duplicates (within each block) are searched once and hits are written for every identifier")
 
     parser_hmmsearch = parser.add_argument_group('HMMSearch arguments')
     parser_hmmsearch.add_argument("-e","--evalue", type=float, default=0.1,  help = "E-value threshold [Default: 0.1]")
     parser_hmmsearch.add_argument("-a", "--all_hits", action="store_true", help="Return all hits and do not use curated threshold. Not recommended for large queries.")
+    parser_hmmsearch.add_argument("--max_hits_per_protein", type=int, help = "Only write the best K hits of each protein (kept in bounded heaps per block) which bounds the output of --all_hits")
+    parser_hmmsearch.add_argument("--hit_ranking", type=str, default="score", choices={"score", "threshold_ratio"}, help = "Ranking of hits for --max_hits_per_protein. `score` uses the bit score (same best hit as `reformat_pykofamsearch --best_hits_only`) and `threshold_ratio` uses the score divided by the curated threshold (KOfams without thresholds are ranked last) [Default: score]")
+    parser_hmmsearch.add_argument("--no_threshold_pruning", action="store_true", help = "Do not use curated thresholds (and E-value cutoffs for KOfams that cannot use thresholds) as bit score cutoffs inside the search.  Output is the same but hits that fail thresholds are computed and stored")
+    parser_hmmsearch.add_argument("--schedule", type=str, default="length", choices={"length", "database"}, help = "Order KOfams are dispatched to threads. `length` sends the longest models first within chunks of the database order to reduce idle threads at the end while `database` dispatches in database order.  Hits are written in database order with either schedule [Default: length]")
+    parser_hmmsearch.add_argument("--engine", type=str, default="auto", choices={"auto", "hmmsearch", "hmmscan"}, help = "Search engine. `hmmscan` searches each protein against all KOfams (parallel over proteins) which avoids the per-KOfam setup of `hmmsearch` for a few proteins.  `auto` uses `hmmscan` for blocks of at most {} proteins when --profile_cache_directory is used (and not --prefilter) and `hmmsearch` otherwise.  Output is the same [Default: auto]".format(HMMSCAN_MAX_SEQUENCES))
+    parser_hmmsearch.add_argument("-Z","--number_of_sequences", type=int, help = "Number of sequences used for E-value calculation. Computed from the input when using blocks with a fasta file but required for blocks with stdin [Default: Number of input sequences]")
+    parser_hmmsearch.add_argument("--prefilter", action="store_true", help = "Only search (KOfam, protein) pairs that share reduced alphabet k-mer seeds with the KOfam consensus.  Faster but hits without shared seeds are missed (see --prefilter_benchmark)")
+    parser_hmmsearch.add_argument("--sensitivity", type=str, default="high", choices={"high", "medium", "low"}, help = "Prefilter sensitivity where `high`, `medium`, and `low` require at least {high}, {medium}, and {low} shared seeds [Default: high]".format(**SENSITIVITY_TO_MIN_SEEDS))
+    parser_hmmsearch.add_argument("--prefilter_benchmark", action="store_true", help = "Use --prefilter and also run the exhaustive search to report the recall of the prefilter")
     parser_hmmsearch.add_argument("-t","--threshold_scale", type=float, default=1.0, help = "Multiplier for the curated thresholds. Higher values will make the annotation more strict [Default: 1.0]")
 
     parser_database = parser.add_argument_group('Database arguments')
     parser_database.add_argument("-d", "--database_directory", type=str, help="path/to/kofam_database_directory/ cannot be used with -b/-serialized_database")
-    parser_database.add_argument("-b", "--serialized_database", type=str, help="path/to/database.pkl cannot be used with -d/--database_directory")
+    parser_database.add_argument("-b", "--serialized_database", type=str, help="path/to/database.pkl[.gz] or path/to/database.kofamdb (indexed) cannot be used with -d/--database_directory")
+    parser_database.add_argument("--profile_cache_directory", type=str, help="path/to/profile_cache/ of pre-optimized (hmmpress) profiles keyed by the checksum of the (subset) models.  Built on first use (or by `serialize_kofam_models --profile_cache_directory`) and loaded directly afterwards")
     # parser_database.add_argument("-e", "--enzymes", action="store_true", help="Only use KOfam with Enzyme Commission identifiers")
 
 
@@ -84,11 +850,16 @@ def main(args=None):
     opts.script_directory  = script_directory
     opts.script_filename = script_filename
 
+    # Per-KOfam metrics time each query inside the search threads
+    profiler = StageProfiler(per_kofam=any([opts.profile, opts.metrics_json, opts.metrics_prometheus]))
+
     # Threads
     # =======
-    cpus_available = cpu_count()
-    if opts.n_jobs < 0:
+    # CPU affinity and cgroup CPU quotas (e.g., Kubernetes or SLURM) are used instead of the host CPU count
+    cpus_available = get_available_cpus()
+    if opts.n_jobs == "auto":
         opts.n_jobs = cpus_available
+        print("Threads: {} (CPU affinity: {}, cgroup CPU quota: {})".format(opts.n_jobs, get_affinity_cpus(), get_cgroup_cpu_quota() or "none"), file=sys.stderr)
     if opts.n_jobs > cpus_available:
         warnings.warn("--n_jobs {} but only {} cpus are available. Adjusting --n_jobs to {}".format(opts.n_jobs, cpus_available, cpus_available))
         opts.n_jobs = cpus_available
@@ -96,166 +867,348 @@ def main(args=None):
 
     # Database
     # ========
-    if opts.serialized_database:
-        print("Loading serialized KOFAM database", file=sys.stderr)
-        # Load serialized database
-        if opts.serialized_database.endswith((".gz", ".pgz")):
-            f = gzip.open(opts.serialized_database, "rb")
-        else:
-            f = open(opts.serialized_database, "rb")
-        ko_to_data, name_to_hmm = pickle.load(f)
-        missing_kos = ko_to_data.keys() - name_to_hmm.keys()
-        f.close()
+    if not any([opts.serialized_database, opts.database_directory]):
+        try:
+            opts.database_directory = os.environ["KOFAM_DATABASE"]
+        except KeyError:
+            print("Must either provide -d/--database_directory, -b/--serialized_database or set `KOFAM_DATABASE` environment variable")
+            sys.exit(1)
+    ko_to_data, name_to_hmm, missing_kos = load_database(
+        database_directory=opts.database_directory,
+        serialized_database=opts.serialized_database,
+        profile_cache_directory=opts.profile_cache_directory,
+        subset=opts.subset,
+        profiler=profiler,
+        threads=opts.n_jobs,
+    )
+
+    if opts.engine == "hmmscan" and (opts.prefilter or opts.prefilter_benchmark):
+        raise ValueError("--engine hmmscan cannot be used with --prefilter or --prefilter_benchmark")
+    if opts.checkpoint_directory and (opts.result_store or opts.prefilter_benchmark):
+        raise ValueError("--checkpoint_directory cannot be used with --result_store or --prefilter_benchmark")
+
+    # Multiple proteomes
+    # ==================
+    samples = get_input_samples(opts.proteins)
+    if samples is not None:
+        if opts.result_store or opts.prefilter_benchmark:
+            raise ValueError("--result_store and --prefilter_benchmark cannot be used with multiple proteomes")
+        if opts.output == "stdout":
+            raise ValueError("-o/--output must be a directory with multiple proteomes")
+        os.makedirs(opts.output, exist_ok=True)
+        if opts.output_suffix is None:
+            opts.output_suffix = ".{}".format(opts.format)
+        print("Number of proteomes: {}".format(len(samples)), file=sys.stderr)
 
-    else:
-        if not opts.database_directory:
-            try:
-                opts.database_directory = os.environ["KOFAM_DATABASE"]
-            except KeyError:
-                print("Must either provide -d/--database_directory, -b/--serialized_database or set `KOFAM_DATABASE` environment variable")
-                sys.exit(1)
-
-        # Load KOFAM thresholds
-        ko_to_data = defaultdict(dict)
-        with open(os.path.join(opts.database_directory, "ko_list"), "r") as f:
-            header = next(f).strip().split("\t")[1:]
-            for line in f:
-                line = line.strip()
-                if line:
-                    id_ko, *fields = line.split("\t")
-                    
-                    for i, v in enumerate(fields):
-                        id_field = header[i]
-                        try:
-                            v = float(v)
-                        except ValueError:
-                            v = v
-                        if v == "-":
-                            v = None
-                        ko_to_data[id_ko][id_field] = v
-                
-        # Load HMMs
-        name_to_hmm = dict()
-        missing_kos = set()
-        for id_ko in tqdm(ko_to_data, desc="Loading HMMs", total=len(ko_to_data)):
-            ko_filepath = os.path.join(opts.database_directory, "profiles", f"{id_ko}.hmm")
-            try:
-                with HMMFile(ko_filepath) as f:
-                    for hmm in list(f):
-                        name_to_hmm[hmm.name.decode()] = hmm
-            except FileNotFoundError:
-                missing_kos.add(id_ko)
-                
-    # Subset
-    # ======
-    if opts.subset:
-        subset_kos = set()
-        with open(opts.subset, "r") as f:
-            for line in f:
-                if line:
-                    if not line.startswith("#"):
-                        subset_kos.add(line.strip())
-        print("Unique subset: {} KOfams".format(len(subset_kos)), file=sys.stderr)
-        print("Subset missing from database: {} KOfams".format(len(subset_kos - set(ko_to_data.keys()))), file=sys.stderr)
-    else:
-        subset_kos = set(ko_to_data.keys())
-        
-    # Ignore
-    # ======
-    ignore_kos = set(ko_to_data.keys()) - subset_kos
-    if ignore_kos:
-        for id_ko in ignore_kos:
-            if id_ko in ko_to_data:
-                del ko_to_data[id_ko]
-            if id_ko in name_to_hmm:
-                del name_to_hmm[id_ko]
-
-    
     # Output
     # ======
-    if opts.output == "stdout":
-        f_output = sys.stdout 
+    def open_writer(output:str):
+        hit_writer = HitWriter(output, format=opts.format, header=not opts.no_header, threads=opts.n_jobs)
+        if opts.max_hits_per_protein:
+            # Every protein is in a single block and writers are flushed (or closed) after each block
+            hit_writer = TopHitsPerProteinWriter(hit_writer, opts.max_hits_per_protein, ranking=opts.hit_ranking)
+        return ProfiledWriter(hit_writer, profiler)
+
+    writer = None
+    if samples is None:
+        writer = open_writer(opts.output)
+        
+    monitor = ThreadUtilizationMonitor()
+
+    # Result store
+    # ============
+    if opts.result_store:
+        with profiler.stage("digitization"):
+            records = read_text_sequences(opts.proteins, threads=opts.n_jobs)
+        if opts.number_of_sequences is None:
+            opts.number_of_sequences = len(records)
+        hash_to_sequence = dict()
+        for i, (id_protein, sequence) in enumerate(records):
+            sequence_hash = get_sequence_hash(sequence)
+            hash_to_sequence[sequence_hash] = sequence
+            records[i] = (id_protein, sequence_hash)
+        model_checksums = get_model_checksums(ko_to_data, name_to_hmm)
+        with ResultStore(opts.result_store) as store:
+            monitor.start()
+            with profiler.stage("search"):
+                new_sequences, new_models, removed_models = update_result_store(store, hash_to_sequence, name_to_hmm, model_checksums, n_jobs=opts.n_jobs, sequences_per_block=opts.sequences_per_block)
+            monitor.stop()
+            print("Result store: {} new sequences, {} new or changed KOfams, {} removed KOfams".format(len(new_sequences), len(new_models), len(removed_models)), file=sys.stderr)
+            with profiler.stage("threshold_filtering"):
+                write_stored_hits(store, records, model_checksums, ko_to_data, opts.threshold_scale, opts.all_hits, writer, evalue=opts.evalue, number_of_sequences=opts.number_of_sequences)
     else:
-        if opts.output.endswith(".gz"):
-            f_output = gzip.open(opts.output, "wt")
+        # Input
+        # =====
+        residues_per_block = None
+        if opts.max_block_memory:
+            residues_per_block = parse_memory(opts.max_block_memory)
+
+        # Memory limit
+        # ============
+        if opts.memory_limit:
+            if opts.memory_limit == "auto":
+                memory_limit, source = get_available_memory()
+            else:
+                memory_limit, source = parse_memory(opts.memory_limit), "--memory_limit"
+            used_memory = get_resident_memory()
+            n_jobs, planned_residues_per_block = plan_memory(memory_limit, used_memory, opts.n_jobs, blocks_in_memory=1 if opts.no_pipelining else 3)
+            if n_jobs < opts.n_jobs:
+                warnings.warn("--n_jobs {} does not fit in the memory limit. Adjusting --n_jobs to {}".format(opts.n_jobs, n_jobs))
+                opts.n_jobs = n_jobs
+            decision = "user-defined blocks"
+            if not any([opts.sequences_per_block, residues_per_block]):
+                if samples is None and opts.proteins != "stdin" and os.path.isfile(opts.proteins) and get_compression(opts.proteins) is None and os.path.getsize(opts.proteins) <= planned_residues_per_block:
+                    decision = "input fits in one block"
+                elif opts.proteins == "stdin" and opts.number_of_sequences is None:
+                    warnings.warn("Blocks from stdin require -Z/--number_of_sequences so the memory limit is not applied to the input")
+                    decision = "stdin without -Z"
+                else:
+                    residues_per_block = planned_residues_per_block
+                    opts.max_block_memory = str(residues_per_block)
+                    decision = "{} residues per block".format(residues_per_block)
+            print("Memory limit: {} ({}) | Used after loading database: {} | Threads: {} | Input: {}".format(format_bytes(memory_limit), source, format_bytes(used_memory), opts.n_jobs, decision), file=sys.stderr)
+
+        if samples is not None:
+            if opts.evalue_scope == "global" and opts.number_of_sequences is None:
+                opts.number_of_sequences = sum(count_fasta_records(filepath, threads=opts.n_jobs) for id_sample, filepath in samples)
+                print("Number of sequences: {}".format(opts.number_of_sequences), file=sys.stderr)
+            blocks = None
+            blocked = True
+        elif any([opts.sequences_per_block, residues_per_block]):
+            # E-values depend on the number of sequences so blocks must share the same Z
+            if opts.number_of_sequences is None:
+                if opts.proteins == "stdin":
+                    raise ValueError("-Z/--number_of_sequences must be provided when reading blocks from stdin")
+                opts.number_of_sequences = count_fasta_records(opts.proteins, threads=opts.n_jobs)
+                print("Number of sequences: {}".format(opts.number_of_sequences), file=sys.stderr)
+            blocks = profiler.iterate("digitization", iterate_sequence_blocks(opts.proteins, sequences_per_block=opts.sequences_per_block, residues_per_block=residues_per_block, threads=opts.n_jobs))
+            blocked = True
         else:
-            f_output = open(opts.output, "w")
+            with profiler.stage("digitization"):
+                with open_sequence_file(opts.proteins, threads=opts.n_jobs, digital=True, alphabet=Alphabet.amino()) as f:
+                    proteins = f.read_block()
+            if opts.number_of_sequences is None:
+                opts.number_of_sequences = len(proteins)
+            blocks = [proteins]
+            blocked = False
 
-    if not opts.no_header:
-        print("id_protein", "id_ko", "threshold", "score", "e-value", "definition", "enzyme_commission", sep="\t", file=f_output)
-        
-    # Input
-    # =====
-    if opts.proteins == "stdin":
-        from Bio.SeqIO.FastaIO import SimpleFastaParser
+        # Run HMMSearch  
+        # =============
+        queries = schedule_queries(name_to_hmm, schedule=opts.schedule, ko_to_data=ko_to_data, n_jobs=opts.n_jobs)
+        search_options = dict(E=opts.evalue, Z=opts.number_of_sequences)
+        evalue_threshold = None
+        if not any([opts.all_hits, opts.no_threshold_pruning]):
+            search_options["bit_cutoffs"] = "trusted"
+            evalue_threshold = min(opts.evalue, INCLUSION_EVALUE)
+            queries = prepare_threshold_queries(queries, ko_to_data, opts.threshold_scale, evalue_threshold=evalue_threshold, number_of_sequences=opts.number_of_sequences)
+        cutoffs_number_of_sequences = opts.number_of_sequences
 
-        proteins = list()
-        for header, seq in tqdm(SimpleFastaParser(sys.stdin), f"Parsing sequences from {sys.stdin}"):
-            id = header.split(" ")[0]
-            digital_sequence = TextSequence(sequence=seq, name=id.encode()).digitize(Alphabet.amino())
-            proteins.append(digital_sequence)
+        # Prefilter
+        prefilter_index = None
+        if opts.prefilter or opts.prefilter_benchmark:
+            with profiler.stage("prefilter"):
+                prefilter_index = load_prefilter_index(ko_to_data, name_to_hmm)
+            min_seeds = SENSITIVITY_TO_MIN_SEEDS[opts.sensitivity]
+            benchmark = defaultdict(float)
+            exhaustive_hits = HitPairCollector()
+            prefiltered_hits = HitPairCollector()
 
-    else:
-        with SequenceFile(opts.proteins, format="fasta", digital=True) as f:
-            proteins = f.read_block()#sequences=opts.sequences_per_block)
-
-    # Run HMMSearch  
-    # =============
-    # Only hits that pass threshold
-    if not opts.all_hits:
-        for hits in tqdm(hmmsearch(name_to_hmm.values(), proteins, cpus=opts.n_jobs, E=opts.evalue), desc="Performing HMMSearch", total=len(name_to_hmm)):
-            id_ko = hits.query_name.decode()
-            data = ko_to_data[id_ko]
-            threshold = data["threshold"]
-            score_type = data["score_type"]
-            definition = data["definition"]
-            enzyme_commission = data["enzyme_commission"]
-            for hit in hits:
-                if hit.included:
-                    result = filter_hmmsearch_threshold(hit, threshold, opts.threshold_scale, score_type, return_failed_threshold=False)
-                    if result:
-                        scaled_threshold, score, evalue = result
-                        print(
-                            hit.name.decode(), 
-                            id_ko, 
-                            scaled_threshold, 
-                            "{:0.3f}".format(score), 
-                            "{:0.5e}".format(evalue), 
-                            definition, 
-                            enzyme_commission,
-                        sep="\t", 
-                        file=f_output,
-                        )
-
-    # Consider all hits even those that do not pass threshold
-    else:
-        for hits in tqdm(hmmsearch(name_to_hmm.values(), proteins, cpus=opts.n_jobs, E=opts.evalue), desc="Performing HMMSearch", total=len(name_to_hmm)):
-            id_ko = hits.query_name.decode()
+        # Checkpoint
+        checkpoint = None
+        if opts.checkpoint_directory:
+            parameters = dict(
+                version=__version__,
+                proteins=[get_file_signature(filepath) for id_sample, filepath in samples] if samples is not None else get_file_signature(opts.proteins),
+                samples=[id_sample for id_sample, filepath in samples] if samples is not None else None,
+                database=get_file_signature(opts.serialized_database or opts.database_directory),
+                subset=get_file_signature(opts.subset),
+                evalue=opts.evalue,
+                threshold_scale=opts.threshold_scale,
+                all_hits=opts.all_hits,
+                number_of_sequences=opts.number_of_sequences,
+                sequences_per_block=opts.sequences_per_block,
+                max_block_memory=opts.max_block_memory,
+                prefilter=opts.prefilter,
+                sensitivity=opts.sensitivity,
+                evalue_scope=opts.evalue_scope,
+            )
+            checkpoint = SearchCheckpoint(opts.checkpoint_directory, parameters=parameters)
+        # Results are written in database order regardless of --schedule
+        database_order = list(name_to_hmm)
+
+        # Hits are filtered and written in the order of the search by a background thread
+        def handle_hits(hits, duplicates, search_time=None, sample_to_z=None):
+            hit_writer = writer
+            hit_sample_to_writer = sample_to_writer
+            if checkpoint is not None:
+                if sample_to_z is None:
+                    hit_writer = HitRecorder(writer)
+                    recorders = [hit_writer]
+                else:
+                    hit_sample_to_writer = {sample:HitRecorder(sample_writer, sample=sample) for sample, sample_writer in sample_to_writer.items()}
+                    recorders = hit_sample_to_writer.values()
+            # Only hits that pass threshold unless --all_hits which considers all hits even those that do not pass threshold
+            with profiler.stage("threshold_filtering"):
+                if sample_to_z is None:
+                    number_of_hits = write_hits(hits, ko_to_data, opts.threshold_scale, opts.all_hits, hit_writer, evalue_threshold=evalue_threshold, duplicates=duplicates)
+                else:
+                    number_of_hits = write_sample_hits(hits, ko_to_data, opts.threshold_scale, opts.all_hits, hit_sample_to_writer, sample_to_z, evalue_threshold=min(opts.evalue, INCLUSION_EVALUE), duplicates=duplicates)
+            if checkpoint is not None:
+                checkpoint.record(hits.query.name.decode(), [row for recorder in recorders for row in recorder.rows])
+            if search_time is not None:
+                profiler.record_kofam(hits, search_time=search_time, written_hits=number_of_hits)
+            if opts.prefilter_benchmark:
+                write_hits(hits, ko_to_data, opts.threshold_scale, opts.all_hits, prefiltered_hits, evalue_threshold=evalue_threshold, duplicates=duplicates)
+        output = BackgroundWorker(threaded=not opts.no_pipelining)
+
+        # Journaled hits of completed KOfams are written again instead of searching
+        def replay_hits(id_ko, rows):
             data = ko_to_data[id_ko]
-            threshold = data["threshold"]
-            score_type = data["score_type"]
-            definition = data["definition"]
-            enzyme_commission = data["enzyme_commission"]
-            for hit in hits:
-                if hit.included:
-                    result = filter_hmmsearch_threshold(hit, threshold, opts.threshold_scale, score_type, return_failed_threshold=True)
-                    scaled_threshold, score, evalue = result
-                    scaled_threshold = "" if scaled_threshold is None else scaled_threshold
-                    print(
-                        hit.name.decode(), 
-                        id_ko, 
-                        scaled_threshold, 
-                        "{:0.3f}".format(score), 
-                        "{:0.5e}".format(evalue), 
-                        definition, 
-                        enzyme_commission,
-                    sep="\t", 
-                    file=f_output,
-                    )
+            for sample, id_proteins, thresholds, scores, evalues in rows:
+                n = len(id_proteins)
+                hit_writer = writer if sample is None else sample_to_writer[sample]
+                hit_writer.write_columns(id_proteins, [id_ko]*n, thresholds, scores, evalues, [data["definition"]]*n, [data["enzyme_commission"]]*n)
+
+        # Search results and journaled rows as (id_ko, (hits, rows, search_time)) pairs in the order they are available
+        def iterate_search_results(search, completed, timings, time_results=False):
+            # Without timings from the search threads (see iterate_prefiltered_hits) the search time of each KOfam
+            # is the wall time waiting for its TopHits from hmmsearch (results arrive in query order)
+            for id_ko, rows in completed.items():
+                yield id_ko, (None, rows, None)
+            previous_time = time.monotonic()
+            for hits in search:
+                id_ko = hits.query.name.decode()
+                search_time = None
+                if timings is not None:
+                    search_time = timings.pop(id_ko)
+                elif time_results:
+                    search_time = time.monotonic() - previous_time
+                yield id_ko, (hits, None, search_time)
+                monitor.sample()
+                previous_time = time.monotonic()
+
+        # hmmscan needs OptimizedProfiles which are configured once (pre-optimized with --profile_cache_directory)
+        scan_queries = None
+
+        # Output files of multiple proteomes are only open while their block is searched
+        sample_to_writer = dict()
+        def open_sample_writers(sample_to_z):
+            for sample in sample_to_z:
+                filepath = os.path.join(opts.output, samples[sample][0] + opts.output_suffix)
+                sample_to_writer[sample] = open_writer(filepath)
+        def close_sample_writers(sample_to_z):
+            for sample in sample_to_z:
+                sample_to_writer.pop(sample).close()
+
+        if samples is not None:
+            # Proteomes are packed into shared blocks and searched in a single pass.  The search uses the smallest Z of the block so
+            # reported hits are a superset of each sample and E-values are recomputed per sample (see write_sample_hits)
+            blocks = iterate_sample_blocks(samples, sequences_per_block=opts.sequences_per_block, residues_per_block=residues_per_block, deduplicate=not opts.no_deduplication, threads=opts.n_jobs, profiler=profiler)
+        else:
+            # Identical sequences are searched once (Z is the number of input sequences so E-values are unchanged)
+            blocks = ((proteins, duplicates, None) for proteins, duplicates in iterate_deduplicated_blocks(blocks, deduplicate=not opts.no_deduplication, profiler=profiler))
+        if not opts.no_pipelining:
+            # The next block is digitized while the current block is searched
+            blocks = prefetch(blocks, maxsize=1)
+
+        # Hits are written after each block so memory scales with block size instead of input size
+        for i, (proteins, duplicates, sample_to_size) in enumerate(blocks, start=1):
+            desc = f"Performing HMMSearch [Block {i}]" if blocked else "Performing HMMSearch"
+            sample_to_z = None
+            if sample_to_size is not None:
+                desc = f"Performing HMMSearch [Block {i}: {len(sample_to_size)} proteomes]"
+                sample_to_z = {sample:opts.number_of_sequences or size for sample, size in sample_to_size.items()}
+                output.submit(open_sample_writers, sample_to_z)
+                if not len(proteins):
+                    output.submit(close_sample_writers, sample_to_z)
+                    continue
+                search_options["Z"] = min(z for z in sample_to_z.values() if z)
+                if evalue_threshold is not None and search_options["Z"] != cutoffs_number_of_sequences:
+                    # E-value cutoffs follow the number of sequences of the smallest proteome in the block
+                    set_threshold_cutoffs(queries, ko_to_data, opts.threshold_scale, evalue_threshold=evalue_threshold, number_of_sequences=search_options["Z"])
+                    if scan_queries is not None:
+                        set_threshold_cutoffs(scan_queries, ko_to_data, opts.threshold_scale, evalue_threshold=evalue_threshold, number_of_sequences=search_options["Z"])
+                    cutoffs_number_of_sequences = search_options["Z"]
+
+            # KOfams completed before an interruption are not searched again
+            completed = dict()
+            block_queries = queries
+            if checkpoint is not None:
+                completed = checkpoint.load_block(i)
+                if completed:
+                    print("Resuming from checkpoint: {} of {} KOfams already completed [Block {}]".format(len(completed), len(queries), i), file=sys.stderr)
+                    block_queries = [query for query in queries if query.name.decode() not in completed]
+                output.submit(checkpoint.open_block, i)
+
+            if opts.prefilter_benchmark:
+                start_time = time.monotonic()
+                for hits in tqdm(hmmsearch(queries, proteins, cpus=opts.n_jobs, **search_options), desc=f"{desc} [Exhaustive]", total=len(queries)):
+                    write_hits(hits, ko_to_data, opts.threshold_scale, opts.all_hits, exhaustive_hits, evalue_threshold=evalue_threshold, duplicates=duplicates)
+                benchmark["exhaustive_time"] += time.monotonic() - start_time
+            monitor.start()
+            start_time = time.monotonic()
+            timings = None
+            engine = opts.engine
+            if engine == "auto":
+                engine = "hmmscan" if all([opts.profile_cache_directory, prefilter_index is None, len(proteins) <= HMMSCAN_MAX_SEQUENCES]) else "hmmsearch"
+            searched_kos = {query.name.decode() for query in block_queries}
+            if not block_queries:
+                search = list()
+            elif engine == "hmmscan":
+                # Hits are regrouped by KOfam in query order so the output is the same as hmmsearch
+                if scan_queries is None:
+                    scan_queries = optimize_profiles(queries)
+                desc = desc.replace("HMMSearch", "HMMScan")
+                search = iterate_scanned_hits([query for query in scan_queries if query.name.decode() not in completed], proteins, n_jobs=opts.n_jobs, **search_options)
+            elif prefilter_index is not None:
+                with profiler.stage("prefilter"):
+                    candidates = prefilter_index.get_candidates(proteins, min_seeds=min_seeds)
+                benchmark["number_of_pairs"] += len(proteins) * len(block_queries)
+                benchmark["number_of_candidates"] += sum(len(candidates[query.name.decode()]) for query in block_queries if query.name.decode() in candidates)
+                searched_kos = {id_ko for id_ko in searched_kos if id_ko in candidates}
+                timings = dict() if profiler.per_kofam else None
+                search = iterate_prefiltered_hits(block_queries, proteins, candidates, n_jobs=opts.n_jobs, timings=timings, **search_options)
+            else:
+                search = hmmsearch(block_queries, proteins, cpus=opts.n_jobs, **search_options)
+            results = iterate_search_results(tqdm(profiler.iterate("search", search), desc=desc, total=len(searched_kos)), completed, timings, time_results=profiler.per_kofam and engine == "hmmsearch")
+            # Journaled hits of completed KOfams are written in database order between the hits of the remaining KOfams
+            block_order = [id_ko for id_ko in database_order if id_ko in searched_kos or id_ko in completed]
+            for id_ko, (hits, rows, search_time) in reorder_results(results, block_order):
+                if hits is None:
+                    output.submit(replay_hits, id_ko, rows)
+                else:
+                    output.submit(handle_hits, hits, duplicates, search_time=search_time, sample_to_z=sample_to_z)
+            monitor.stop()
+            if checkpoint is not None:
+                output.submit(checkpoint.close_block)
+            if prefilter_index is not None:
+                benchmark["prefiltered_time"] += time.monotonic() - start_time
+            if sample_to_z is None:
+                output.submit(writer.flush)
+            else:
+                output.submit(close_sample_writers, sample_to_z)
+        output.close()
+
+        if prefilter_index is not None:
+            print("Prefilter: {} of {} (KOfam, protein) pairs searched ({:0.2%}) with --sensitivity {}".format(int(benchmark["number_of_candidates"]), int(benchmark["number_of_pairs"]), benchmark["number_of_candidates"]/max(benchmark["number_of_pairs"], 1), opts.sensitivity), file=sys.stderr)
+        if opts.prefilter_benchmark:
+            recall = len(exhaustive_hits.pairs & prefiltered_hits.pairs)/max(len(exhaustive_hits.pairs), 1)
+            print("Prefilter benchmark: recall {:0.4f} ({} of {} hits) | Exhaustive search: {:0.2f}s | Prefiltered search: {:0.2f}s".format(recall, len(exhaustive_hits.pairs & prefiltered_hits.pairs), len(exhaustive_hits.pairs), benchmark["exhaustive_time"], benchmark["prefiltered_time"]), file=sys.stderr)
 
     # Output close
-    if f_output != sys.stdout:
-        f_output.close()
+    if writer is not None:
+        writer.close()
+
+    # Metrics
+    # =======
+    if profiler.per_kofam:
+        info = dict(version=__version__, number_of_sequences=opts.number_of_sequences, number_of_kofams=len(name_to_hmm), n_jobs=opts.n_jobs)
+        if opts.profile:
+            profiler.report()
+        if opts.metrics_json:
+            profiler.write_json(opts.metrics_json, **info)
+        if opts.metrics_prometheus:
+            profiler.write_prometheus(opts.metrics_prometheus)
         
     # Verbosity
     # =========
@@ -265,6 +1218,7 @@ def main(args=None):
         print("------------------------", file=sys.stderr)
         print("Number of missing KOfams: {}".format(len(missing_kos)), file=sys.stderr)
         print("------------------------", file=sys.stderr)
+        monitor.report(opts.n_jobs, per_thread=opts.verbosity > 1)
 
         if opts.verbosity > 1:
             if len(missing_kos):
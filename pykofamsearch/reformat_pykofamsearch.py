@@ -1,13 +1,142 @@
 #!/usr/bin/env python
-import sys, os, argparse, gzip
-from collections import defaultdict
+import sys, os, argparse, csv, heapq, pickle, shutil, tempfile
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 from . import __version__
+from .writers import COLUMNS, import_pyarrow
+from .compression import open_file
 
 
 __program__ = os.path.split(sys.argv[0])[-1]
 
+ALL_HITS_COLUMNS = ["number_of_hits", "ids", "names", "evalues", "scores", "enzyme_commissions"]
+BEST_HITS_COLUMNS = ["id", "name", "evalue", "score", "enzyme_commission"]
+
+def parse_enzyme_commissions(enzyme_commissions:pd.Series):
+    """
+    Parse enzyme commission fields written as Python sets or lists (e.g., {'1.1.1.22', '1.1.1.343'} or set())
+    into `;` separated strings without eval
+    """
+    return (
+        enzyme_commissions.fillna("")
+        .str.replace(r"^set\(\)$", "", regex=True)
+        .str.strip("{}[]")
+        .str.replace("'", "", regex=False)
+        .str.replace(", ", ";", regex=False)
+    )
+
+def iterate_chunks(opts):
+    """
+    Yield DataFrames of hits with typed columns: id_protein, id_ko, score, evalue, definition, enzyme_commission (`;` separated)
+    """
+    if opts.input_format in {"parquet", "arrow"}:
+        pa = import_pyarrow()
+        if opts.input_format == "parquet":
+            batches = pa.parquet.ParquetFile(opts.input).iter_batches(batch_size=opts.chunksize)
+        else:
+            batches = pa.ipc.open_file(pa.memory_map(opts.input, "r")).to_batches()
+        for batch in batches:
+            df = batch.to_pandas()
+            yield pd.DataFrame({
+                "id_protein":df["id_protein"].astype(str),
+                "id_ko":df["id_ko"].astype(str),
+                "score":df["score"].astype(float),
+                "evalue":df["e-value"].astype(float),
+                "definition":df["definition"].astype(str),
+                "enzyme_commission":df["enzyme_commission"].map(lambda x: ";".join(x) if x is not None else ""),
+            })
+    else:
+        if opts.input == "stdin":
+            f_input = sys.stdin
+        else:
+            # Uncompressed, gzip, BGZF, or zstd
+            f_input = open_file(opts.input, "rb", threads=opts.n_jobs)
+        reader = pd.read_csv(
+            f_input,
+            sep="\t",
+            header=None,
+            names=COLUMNS,
+            skiprows=0 if opts.no_header else 1,
+            chunksize=opts.chunksize,
+            dtype=str,
+            quoting=csv.QUOTE_NONE,
+            na_filter=False,
+        )
+        for df in reader:
+            yield pd.DataFrame({
+                "id_protein":df["id_protein"],
+                "id_ko":df["id_ko"],
+                "score":df["score"].astype(float),
+                "evalue":df["e-value"].astype(float),
+                "definition":df["definition"],
+                "enzyme_commission":parse_enzyme_commissions(df["enzyme_commission"]),
+            })
+
+def partition_hits(chunks, directory:str, n_partitions:int):
+    """
+    Hash partition hits by protein to disk so each partition can be grouped independently.
+    Each row keeps its position in the input so the original protein order can be restored.
+    """
+    filepaths = [os.path.join(directory, "partition_{}.pkl".format(i)) for i in range(n_partitions)]
+    files = [open(filepath, "wb") for filepath in filepaths]
+    offset = 0
+    for df in tqdm(chunks, desc="Partitioning PyKOfamSearch", unit=" chunks"):
+        df.insert(0, "row", np.arange(offset, offset + len(df), dtype=np.int64))
+        offset += len(df)
+        partitions = pd.util.hash_pandas_object(df["id_protein"], index=False).values % n_partitions
+        for i, df_partition in df.groupby(partitions, sort=False):
+            pickle.dump(df_partition, files[i], protocol=pickle.HIGHEST_PROTOCOL)
+    for f in files:
+        f.close()
+    return filepaths
+
+def read_partition(filepath:str):
+    dataframes = list()
+    with open(filepath, "rb") as f:
+        while True:
+            try:
+                dataframes.append(pickle.load(f))
+            except EOFError:
+                break
+    if dataframes:
+        return pd.concat(dataframes, ignore_index=True).sort_values("row", kind="stable", ignore_index=True)
+
+def split_enzyme_commissions(enzyme_commissions:str):
+    return set(enzyme_commissions.split(";")) if enzyme_commissions else set()
+
+def group_partition(df:pd.DataFrame, best_hits_only:bool):
+    """
+    Group the hits for each protein in a partition
+
+    Yields
+    ------
+    (first_row, id_protein, values) where values are in the order of ALL_HITS_COLUMNS or BEST_HITS_COLUMNS
+    """
+    codes, id_proteins = pd.factorize(df["id_protein"], sort=False)
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    first_rows = df["row"].values[order][starts].tolist()
+
+    if best_hits_only:
+        # First hit with the highest score for each protein
+        index = df.groupby(codes, sort=True)["score"].idxmax().values
+        for first_row, id_protein, i in zip(first_rows, id_proteins, index):
+            yield first_row, id_protein, [
+                df.at[i, "id_ko"],
+                df.at[i, "definition"],
+                float(df.at[i, "evalue"]),
+                float(df.at[i, "score"]),
+                split_enzyme_commissions(df.at[i, "enzyme_commission"]),
+            ]
+    else:
+        columns = [df[name].values[order].tolist() for name in ["id_ko", "definition", "evalue", "score", "enzyme_commission"]]
+        for first_row, id_protein, start, count in zip(first_rows, id_proteins, starts.tolist(), counts.tolist()):
+            ids, names, evalues, scores, enzyme_commissions = [values[start:start + count] for values in columns]
+            enzyme_commissions = sorted(set.union(*map(split_enzyme_commissions, enzyme_commissions)))
+            yield first_row, id_protein, [count, ids, names, evalues, scores, enzyme_commissions]
+
 def main(args=None):
     # Path info
     script_directory  =  os.path.dirname(os.path.abspath( __file__ ))
@@ -26,79 +155,76 @@ def main(args=None):
     parser.add_argument("-i","--input", type=str, default="stdin", help = "path/to/input.tsv. The results of `pykofamsearch.py` [Default: stdin]")
     parser.add_argument("-o","--output", type=str, default="stdout", help = "path/to/output.tsv [Default: stdout]")
     parser.add_argument("-f", "--format", type=str, choices={"table", "pickle"}, help="Output format")
+    parser.add_argument("--input_format", type=str, default="auto", choices={"auto", "tsv", "parquet", "arrow"}, help="Input format.  `auto` uses parquet for .parquet, arrow for .arrow/.feather, and tsv otherwise [Default: auto]")
     parser.add_argument("--no_header",action="store_true", help="Input does not have header")
     parser.add_argument("-b", "--best_hits_only",action="store_true", help="Best hits only")
+    parser.add_argument("--n_partitions", type=int, default=16, help="Number of partitions to hash proteins into on disk.  Memory scales with the largest partition [Default: 16]")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Number of input rows to read at a time [Default: 1000000]")
+    parser.add_argument("-p", "--n_jobs", type=int, default=1, help="Number of threads for compressed (BGZF or zstd) input and output [Default: 1]")
+    parser.add_argument("--temporary_directory", type=str, help="path/to/temporary_directory/ for partitions [Default: System default]")
 
     # Options
     opts = parser.parse_args()
     opts.script_directory  = script_directory
     opts.script_filename = script_filename
 
-    # Output
-    if opts.output == "stdout":
-        opts.output = sys.stdout 
-
     # Input
-    if opts.input == "stdin":
-        f_input = sys.stdin 
-    else:
-        if opts.input.endswith(".gz"):
-            f_input = gzip.open(opts.input, "rt")
-        else:
-            f_input = open(opts.input, "r")
-
-    if not opts.no_header:
-        next(f_input)
-    
-    if opts.best_hits_only:
-        output = defaultdict(dict)
-        for line in tqdm(f_input, desc="Reading PyKOfamSearch"):
-            line = line.strip()
-            if line:
-                id_protein, id_ko, threshold, score, evalue, definition, enzyme_commission = line.split("\t")
-                score = float(score)
-                evalue = float(evalue)
-                update = True
-                if id_protein in output:
-                    existing_score = output[id_protein]["score"]
-                    if score <= existing_score:
-                        update = False
-                if update:
-                    output[id_protein]["id"] = id_ko
-                    output[id_protein]["name"] = definition
-                    output[id_protein]["evalue"] = evalue
-                    output[id_protein]["score"] = score
-                    output[id_protein]["enzyme_commission"] = eval(enzyme_commission)
-        df_output = pd.DataFrame(output).T
-        if df_output.empty:
-            df_output = pd.Dataframe(columns=["id", "name", "evalue", "score", "enzyme_commission"])
-    else:
-        try:
-            output = defaultdict(lambda: defaultdict(list))
-            for line in tqdm(f_input, desc="Reading PyKofamSearch"):
-                line = line.strip()
-                if line:
-                    id_protein, id_ko, threshold, score, evalue, definition, enzyme_commission = line.split("\t")
-                    output[id_protein]["ids"].append(id_ko)
-                    output[id_protein]["names"].append(definition)
-                    output[id_protein]["evalues"].append(float(evalue))
-                    output[id_protein]["scores"].append(float(score))
-                    output[id_protein]["enzyme_commissions"].append(eval(enzyme_commission))
-            df_output = pd.DataFrame(output).T
-            df_output.insert(0, "number_of_hits", df_output["ids"].map(len))
-            df_output["enzyme_commissions"] = df_output["enzyme_commissions"].map(lambda x:list(set.union(*x)))
-        except KeyError:
-            df_output = pd.DataFrame(columns=["number_of_hits", "ids", "names", "evalues", "scores", "enzyme_commissions"])
-    df_output.index.name = "id_protein"
-
-    if opts.format == "pickle":
-        df_output.to_pickle(opts.output)
-    else:
-        df_output.to_csv(opts.output, sep="\t")
+    if opts.input_format == "auto":
+        opts.input_format = "tsv"
+        if opts.input.endswith(".parquet"):
+            opts.input_format = "parquet"
+        if opts.input.endswith((".arrow", ".feather")):
+            opts.input_format = "arrow"
 
-    if opts.input != "stdin":
-        f_input.close()
-    
+    columns = BEST_HITS_COLUMNS if opts.best_hits_only else ALL_HITS_COLUMNS
+    directory = tempfile.mkdtemp(prefix="reformat_pykofamsearch.", dir=opts.temporary_directory)
+    try:
+        # Partition
+        filepaths = partition_hits(iterate_chunks(opts), directory, opts.n_partitions)
+
+        # Group each partition and write proteins sorted by first appearance
+        grouped_filepaths = list()
+        for filepath in tqdm(filepaths, desc="Grouping partitions"):
+            df = read_partition(filepath)
+            os.remove(filepath)
+            grouped_filepath = filepath[:-len(".pkl")] + ".grouped.pkl"
+            with open(grouped_filepath, "wb") as f:
+                if df is not None:
+                    for record in sorted(group_partition(df, opts.best_hits_only), key=lambda x: x[0]):
+                        pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            grouped_filepaths.append(grouped_filepath)
+
+        def read_records(filepath):
+            with open(filepath, "rb") as f:
+                while True:
+                    try:
+                        yield pickle.load(f)
+                    except EOFError:
+                        break
+
+        # Merge partitions back into the input order of proteins
+        records = heapq.merge(*map(read_records, grouped_filepaths), key=lambda x: x[0])
+
+        if opts.format == "pickle":
+            data = {id_protein:values for first_row, id_protein, values in records}
+            df_output = pd.DataFrame.from_dict(data, orient="index", columns=columns, dtype=object)
+            df_output.index.name = "id_protein"
+            df_output.to_pickle(sys.stdout.buffer if opts.output == "stdout" else opts.output)
+        else:
+            if opts.output == "stdout":
+                f_output = sys.stdout
+            else:
+                # .gz (BGZF) and .zst are compressed on threads
+                f_output = open_file(opts.output, "wt", threads=opts.n_jobs)
+            # Same quoting as pandas.DataFrame.to_csv
+            writer = csv.writer(f_output, delimiter="\t", lineterminator="\n", quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(["id_protein"] + columns)
+            for first_row, id_protein, values in records:
+                writer.writerow([id_protein] + values)
+            if f_output != sys.stdout:
+                f_output.close()
+    finally:
+        shutil.rmtree(directory)
 
 
 if __name__ == "__main__":
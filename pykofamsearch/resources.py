@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+import os, math, argparse
+
+# Memory of a digitized DigitalSequenceBlock per residue including per-sequence overhead (measured on test/test.faa)
+BYTES_PER_RESIDUE = 4
+# Upper estimate of the dynamic programming matrices of a search thread
+THREAD_MEMORY = 64 * 1024**2
+# Fraction of the memory limit that is used (the rest is left for the allocator, output buffers, and hits)
+MEMORY_HEADROOM = 0.8
+MIN_RESIDUES_PER_BLOCK = 1024**2
+
+def parse_n_jobs(value:str):
+    """
+    Parse --n_jobs which is either `auto` (or -1) or a positive integer
+    """
+    if str(value).lower() == "auto":
+        return "auto"
+    try:
+        n_jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("n_jobs must be `auto`, -1, or a positive integer: {}".format(value))
+    if n_jobs == -1:
+        return "auto"
+    if n_jobs < 1:
+        raise argparse.ArgumentTypeError("n_jobs must be `auto`, -1, or a positive integer: {}".format(value))
+    return n_jobs
+
+def get_cgroup_directories(controller:str):
+    """
+    Get the cgroup directories of this process for a controller from the innermost to the mount point.
+    Both cgroup v2 (unified) and v1 hierarchies are checked.
+    """
+    directories = list()
+    try:
+        with open("/proc/self/cgroup", "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return directories
+    for line in lines:
+        fields = line.split(":", 2)
+        if len(fields) != 3:
+            continue
+        hierarchy_id, controllers, path = fields
+        if hierarchy_id == "0" and controllers == "":
+            mount_points = ["/sys/fs/cgroup", "/sys/fs/cgroup/unified"]
+        elif controller in controllers.split(","):
+            mount_points = ["/sys/fs/cgroup/{}".format(controllers), "/sys/fs/cgroup/{}".format(controller)]
+        else:
+            continue
+        for mount_point in mount_points:
+            if not os.path.isdir(mount_point):
+                continue
+            # Hybrid systems mount the v2 hierarchy at /sys/fs/cgroup/unified
+            if hierarchy_id == "0" and not os.path.exists(os.path.join(mount_point, "cgroup.controllers")):
+                continue
+            # Limits of parent cgroups also apply (inside a cgroup namespace the path is `/`)
+            directory = os.path.join(mount_point, path.lstrip("/"))
+            while True:
+                if os.path.isdir(directory):
+                    directories.append(directory)
+                if os.path.normpath(directory) == os.path.normpath(mount_point):
+                    break
+                directory = os.path.dirname(directory)
+            break
+    return directories
+
+def read_cgroup_value(directory:str, filename:str):
+    try:
+        with open(os.path.join(directory, filename), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def get_cgroup_cpu_quota():
+    """
+    Get the CPU quota (cpu.max in v2 or cpu.cfs_quota_us/cpu.cfs_period_us in v1) as a number of CPUs (None if unlimited)
+    """
+    quotas = list()
+    for directory in get_cgroup_directories("cpu"):
+        value = read_cgroup_value(directory, "cpu.max")
+        if value is not None:
+            quota, period = (value.split() + ["100000"])[:2]
+            if quota != "max":
+                quotas.append(int(quota)/int(period))
+            continue
+        quota = read_cgroup_value(directory, "cpu.cfs_quota_us")
+        period = read_cgroup_value(directory, "cpu.cfs_period_us")
+        if quota is not None and period is not None and int(quota) > 0:
+            quotas.append(int(quota)/int(period))
+    return min(quotas) if quotas else None
+
+def get_cgroup_memory_limit():
+    """
+    Get the memory limit in bytes (memory.max in v2 or memory.limit_in_bytes in v1) (None if unlimited)
+    """
+    limits = list()
+    for directory in get_cgroup_directories("memory"):
+        for filename in ["memory.max", "memory.limit_in_bytes"]:
+            value = read_cgroup_value(directory, filename)
+            # v1 reports unlimited as a page-aligned maximum integer
+            if value is not None and value != "max" and int(value) < 2**60:
+                limits.append(int(value))
+    return min(limits) if limits else None
+
+def get_affinity_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def get_available_cpus():
+    """
+    Get the number of CPUs this process can use: the CPU affinity (e.g., taskset, SLURM, or cpusets)
+    limited by the cgroup CPU quota (e.g., Kubernetes CPU limits) rounded down (at least 1)
+    """
+    cpus = get_affinity_cpus()
+    quota = get_cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(int(math.floor(quota)), 1))
+    return cpus
+
+def get_available_memory():
+    """
+    Get the memory available to this process in bytes: the cgroup memory limit or MemAvailable from /proc/meminfo
+    (total physical memory if /proc/meminfo is not available) if there is no limit
+
+    Returns
+    -------
+    memory : int
+    source : str
+        `cgroup`, `meminfo`, or `physical`
+    """
+    limit = get_cgroup_memory_limit()
+    if limit is not None:
+        return limit, "cgroup"
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024, "meminfo"
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"), "physical"
+
+def get_resident_memory():
+    """
+    Get the resident memory of this process in bytes
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource, sys
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux and bytes on macOS
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def plan_memory(memory_limit:int, used_memory:int, n_jobs:int, blocks_in_memory:int=3):
+    """
+    Choose the number of threads and the number of residues per block that fit in a memory budget.
+    The memory that is already used (e.g., the database) and THREAD_MEMORY for each thread are subtracted from
+    MEMORY_HEADROOM x memory_limit and the rest is split between the blocks held in memory at once (3 with pipelining).
+    Threads are reduced if their memory does not fit.  Residues per block are rounded down to a power of 2 so
+    the block size is stable across runs (e.g., resuming a --checkpoint_directory).
+
+    Returns
+    -------
+    n_jobs : int
+    residues_per_block : int
+    """
+    budget = MEMORY_HEADROOM * memory_limit - used_memory
+    while n_jobs > 1 and budget - n_jobs * THREAD_MEMORY < blocks_in_memory * BYTES_PER_RESIDUE * MIN_RESIDUES_PER_BLOCK:
+        n_jobs -= 1
+    residues_per_block = (budget - n_jobs * THREAD_MEMORY) / (blocks_in_memory * BYTES_PER_RESIDUE)
+    residues_per_block = max(residues_per_block, MIN_RESIDUES_PER_BLOCK)
+    residues_per_block = 2 ** int(math.floor(math.log2(residues_per_block)))
+    return n_jobs, residues_per_block
+
+def format_bytes(value:float):
+    for unit in ["B", "K", "M", "G"]:
+        if abs(value) < 1024:
+            return "{:0.1f}{}".format(value, unit)
+        value /= 1024
+    return "{:0.1f}T".format(value)
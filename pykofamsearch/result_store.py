@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import sqlite3, hashlib
+
+def get_sequence_hash(sequence:str):
+    """
+    Hash a protein sequence (case-insensitive)
+    """
+    return hashlib.md5(sequence.upper().encode()).hexdigest()
+
+class ResultStore(object):
+    """
+    Persistent store of hmmsearch hits keyed by sequence hash and KOfam model checksum (SQLite).
+
+    Every stored sequence has been searched against every stored model so only new sequences and
+    new or changed models need to be searched.  Hits are stored with P-values (not E-values) and
+    scores so E-values can be computed for any number of sequences and thresholds can be applied at output.
+
+    Usage:
+        with ResultStore("results.sqlite") as store:
+            store.remove_models(store.get_models() - set(current_checksums))
+            ...
+    """
+    def __init__(self, filepath:str):
+        self.filepath = filepath
+        self.connection = sqlite3.connect(filepath)
+        self.connection.executescript("""
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS sequences (hash TEXT PRIMARY KEY, sequence TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS models (checksum TEXT PRIMARY KEY, id_ko TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS hits (hash TEXT NOT NULL, checksum TEXT NOT NULL, score REAL NOT NULL, domain_score REAL NOT NULL, pvalue REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS hits_checksum ON hits (checksum);
+        """)
+
+    def get_models(self):
+        return {checksum for checksum, in self.connection.execute("SELECT checksum FROM models")}
+
+    def get_sequence_hashes(self):
+        return {sequence_hash for sequence_hash, in self.connection.execute("SELECT hash FROM sequences")}
+
+    def get_number_of_sequences(self):
+        return self.connection.execute("SELECT COUNT(*) FROM sequences").fetchone()[0]
+
+    def iterate_sequences(self, batch_size:int=10000):
+        """
+        Yield lists of (hash, sequence) for all stored sequences
+        """
+        cursor = self.connection.execute("SELECT hash, sequence FROM sequences")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+    def remove_models(self, checksums):
+        """
+        Remove models (and their hits) that are no longer in the database
+        """
+        checksums = [(checksum,) for checksum in checksums]
+        self.connection.executemany("DELETE FROM hits WHERE checksum = ?", checksums)
+        self.connection.executemany("DELETE FROM models WHERE checksum = ?", checksums)
+
+    def add_sequences(self, hash_to_sequence:dict):
+        self.connection.executemany("INSERT OR IGNORE INTO sequences (hash, sequence) VALUES (?, ?)", hash_to_sequence.items())
+
+    def add_models(self, checksum_to_id:dict):
+        self.connection.executemany("INSERT OR IGNORE INTO models (checksum, id_ko) VALUES (?, ?)", checksum_to_id.items())
+
+    def add_hits(self, hits):
+        """
+        Add hits as (hash, checksum, score, domain_score, pvalue)
+        """
+        self.connection.executemany("INSERT INTO hits (hash, checksum, score, domain_score, pvalue) VALUES (?, ?, ?, ?, ?)", hits)
+
+    def get_hits(self, checksum:str):
+        """
+        Get hits for a model as (hash, score, domain_score, pvalue) sorted by P-value
+        """
+        return self.connection.execute("SELECT hash, score, domain_score, pvalue FROM hits WHERE checksum = ? ORDER BY pvalue, hash", (checksum,)).fetchall()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.connection.rollback()
+        self.close()
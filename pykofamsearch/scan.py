@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+from typing import NamedTuple
+from pyhmmer.easel import Alphabet
+from pyhmmer.plan7 import HMM, Background, Profile
+from pyhmmer import hmmscan
+
+# Largest number of input sequences searched with hmmscan when using `--engine auto`.  hmmsearch pays
+# a pipeline setup for every KOfam which dominates for a few sequences while hmmscan pays it for every
+# sequence (see `benchmark_pykofamsearch -n 1,4,16,64 -- --engine hmmscan` for the crossover).
+HMMSCAN_MAX_SEQUENCES = 16
+
+class ScannedDomain(NamedTuple):
+    score: float
+
+class ScannedHit(NamedTuple):
+    """
+    Hit of a protein to a KOfam from hmmscan with the attributes of a pyhmmer Hit used by `write_hits`
+    """
+    name: bytes
+    score: float
+    evalue: float
+    pvalue: float
+    reported: bool
+    included: bool
+    best_domain: ScannedDomain
+
+class ScannedHits(object):
+    """
+    Hits of a KOfam regrouped from hmmscan with the attributes of a pyhmmer TopHits used by `write_hits`
+    and `StageProfiler.record_kofam`.  Hits are sorted by decreasing score and then name like hmmsearch.
+    """
+    def __init__(self, query, hits:list, searched_sequences:int, searched_residues:int):
+        self.query = query
+        self.hits = sorted(hits, key=lambda hit: (-hit.score, hit.name))
+        self.searched_sequences = searched_sequences
+        self.searched_residues = searched_residues
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+    @property
+    def reported(self):
+        return [hit for hit in self.hits if hit.reported]
+
+    @property
+    def included(self):
+        return [hit for hit in self.hits if hit.included]
+
+def optimize_profiles(queries, alphabet=None):
+    """
+    Configure HMMs as OptimizedProfiles (cutoffs are kept) so hmmscan does not convert every HMM for every sequence.
+    OptimizedProfiles (e.g., from --profile_cache_directory) are returned as is.
+    """
+    if alphabet is None:
+        alphabet = Alphabet.amino()
+    background = Background(alphabet)
+    profiles = list()
+    for query in queries:
+        if isinstance(query, HMM):
+            profile = Profile(query.M, alphabet)
+            profile.configure(query, background)
+            query = profile.to_optimized()
+        profiles.append(query)
+    return profiles
+
+def iterate_scanned_hits(queries, sequences, n_jobs:int=1, **search_options):
+    """
+    Search sequences against the queries with hmmscan (parallel over sequences) and yield a ScannedHits for
+    every query in order (KOfam-major like hmmsearch).  search_options (e.g., E, Z, bit_cutoffs) are passed
+    to hmmscan so E-values use Z (the number of sequences) instead of the number of KOfams.
+
+    Parameters
+    ----------
+    queries : list
+        OptimizedProfiles (see `optimize_profiles`)
+    sequences : DigitalSequenceBlock
+        Digital sequences
+    n_jobs : int
+        Number of threads
+    """
+    name_to_hits = {query.name:list() for query in queries}
+    for top_hits in hmmscan(sequences, queries, cpus=n_jobs, **search_options):
+        id_protein = top_hits.query.name
+        for hit in top_hits:
+            name_to_hits[hit.name].append(ScannedHit(id_protein, hit.score, hit.evalue, hit.pvalue, hit.reported, hit.included, ScannedDomain(hit.best_domain.score)))
+    searched_residues = sum(len(sequence) for sequence in sequences)
+    for query in queries:
+        yield ScannedHits(query, name_to_hits[query.name], len(sequences), searched_residues)
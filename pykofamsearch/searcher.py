@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+import os, math, asyncio, threading
+from typing import NamedTuple, Optional
+from pyhmmer.easel import Alphabet, DigitalSequence, DigitalSequenceBlock, TextSequence
+from pyhmmer import hmmsearch
+from .pykofamsearch import (
+    INCLUSION_EVALUE,
+    load_database,
+    open_sequence_file,
+    deduplicate_sequences,
+    schedule_queries,
+    reorder_results,
+    prepare_threshold_queries,
+    write_hits,
+)
+
+class KOfamHit(NamedTuple):
+    """
+    Hit that passed the curated threshold (or any included hit with all_hits).  Same fields as the pykofamsearch output.
+    """
+    id_protein: str
+    id_ko: str
+    threshold: Optional[float]
+    score: float
+    evalue: float
+    definition: str
+    enzyme_commission: set
+
+class HitCollector(object):
+    """
+    Collect the columns written by write_hits as KOfamHit objects
+    """
+    def __init__(self):
+        self.hits = list()
+
+    def write_columns(self, *columns):
+        self.hits.extend(map(KOfamHit._make, zip(*columns)))
+
+class KOfamSearcher(object):
+    """
+    Annotate proteins with KOfams in-process.  The database is loaded and the HMMs are decoded once so
+    repeated searches (e.g., thousands of genomes) do not pay for interpreter, import, or database setup.
+
+    Results are the same as the `pykofamsearch` command with the same options.  `search`, `iter_search`,
+    and `search_batch` are thread-safe and each call uses n_jobs threads.  `search_batch` searches the
+    proteomes one after another so concurrent proteomes need separate calls (e.g., `search_async`).
+
+    Usage:
+        from pykofamsearch import KOfamSearcher
+
+        searcher = KOfamSearcher.from_database(serialized_database="database.kofamdb", n_jobs=4)
+        hits = searcher.search("genome.faa")
+        hits = searcher.search({"protein_1":"MSKGEELFTGVV...", ...})
+        results = searcher.search_batch({"genome_1":"genome_1.faa", "genome_2":"genome_2.faa"})
+        hits = await searcher.search_async("genome.faa")
+    """
+    def __init__(
+        self,
+        ko_to_data,
+        name_to_hmm,
+        n_jobs:int=1,
+        evalue:float=0.1,
+        threshold_scale:float=1.0,
+        all_hits:bool=False,
+        threshold_pruning:bool=True,
+        deduplicate:bool=True,
+        schedule:str="length",
+        ):
+        self.ko_to_data = ko_to_data
+        # HMMs from indexed databases are decoded here (each lookup decodes) instead of on every search
+        self.name_to_hmm = {id_ko:name_to_hmm[id_ko] for id_ko in name_to_hmm}
+        self.n_jobs = n_jobs
+        self.evalue = evalue
+        self.threshold_scale = threshold_scale
+        self.all_hits = all_hits
+        self.threshold_pruning = threshold_pruning
+        self.deduplicate = deduplicate
+        self.alphabet = Alphabet.amino()
+        self.missing_kos = set()
+        self._queries = schedule_queries(self.name_to_hmm, schedule=schedule, ko_to_data=ko_to_data, n_jobs=n_jobs)
+        self._threshold_queries = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_database(
+        cls,
+        serialized_database:str=None,
+        database_directory:str=None,
+        profile_cache_directory:str=None,
+        subset:str=None,
+        **kwargs,
+        ):
+        """
+        Load a searcher from a serialized database (pickle or indexed) or a database directory (see `pykofamsearch -h`)
+        """
+        if not any([serialized_database, database_directory]):
+            raise ValueError("Must either provide database_directory or serialized_database")
+        ko_to_data, name_to_hmm, missing_kos = load_database(
+            database_directory=database_directory,
+            serialized_database=serialized_database,
+            profile_cache_directory=profile_cache_directory,
+            subset=subset,
+            threads=kwargs.get("n_jobs", 1),
+        )
+        searcher = cls(ko_to_data, name_to_hmm, **kwargs)
+        searcher.missing_kos = missing_kos
+        return searcher
+
+    def __len__(self):
+        return len(self.name_to_hmm)
+
+    def __repr__(self):
+        return "{}(number_of_kofams={}, n_jobs={}, evalue={}, threshold_scale={}, all_hits={})".format(self.__class__.__name__, len(self), self.n_jobs, self.evalue, self.threshold_scale, self.all_hits)
+
+    def digitize(self, sequences):
+        """
+        Convert sequences into a DigitalSequenceBlock
+
+        Parameters
+        ----------
+        sequences : str, dict, DigitalSequenceBlock, or iterable
+            path/to/proteins.fasta (uncompressed, gzip, BGZF, or zstd), dictionary of identifiers to
+            sequences, or an iterable of DigitalSequence, TextSequence, or (identifier, sequence) pairs
+        """
+        if isinstance(sequences, DigitalSequenceBlock):
+            return sequences
+        if isinstance(sequences, (str, os.PathLike)):
+            with open_sequence_file(os.fspath(sequences), threads=self.n_jobs, digital=True, alphabet=self.alphabet) as f:
+                return f.read_block()
+        if isinstance(sequences, dict):
+            sequences = sequences.items()
+        block = DigitalSequenceBlock(self.alphabet)
+        for sequence in sequences:
+            if isinstance(sequence, tuple):
+                id_protein, sequence = sequence
+                sequence = TextSequence(sequence=str(sequence), name=str(id_protein).encode())
+            if isinstance(sequence, TextSequence):
+                sequence = sequence.digitize(self.alphabet)
+            if not isinstance(sequence, DigitalSequence):
+                raise TypeError("Sequences must be DigitalSequence, TextSequence, or (identifier, sequence) pairs")
+            block.append(sequence)
+        return block
+
+    def _get_queries(self, threshold_scale:float, all_hits:bool, number_of_sequences:int):
+        if all_hits or not self.threshold_pruning:
+            return self._queries
+        # Queries with the scaled thresholds and E-value cutoffs are prepared once per threshold scale and reused
+        # while the number of sequences is in the same power of 2.  Cutoffs for the lower power of 2 are lower
+        # (at most 1/lambda bits) so no hits are lost and searches of similar sizes do not copy the queries again.
+        number_of_sequences = 2**int(math.log2(max(number_of_sequences, 1)))
+        with self._lock:
+            cutoffs_number_of_sequences, queries = self._threshold_queries.get(threshold_scale, (None, None))
+            if cutoffs_number_of_sequences != number_of_sequences:
+                queries = prepare_threshold_queries(self._queries, self.ko_to_data, threshold_scale, evalue_threshold=min(self.evalue, INCLUSION_EVALUE), number_of_sequences=number_of_sequences)
+                self._threshold_queries[threshold_scale] = (number_of_sequences, queries)
+            return queries
+
+    def iter_search(self, sequences, number_of_sequences:int=None, threshold_scale:float=None, all_hits:bool=None):
+        """
+        Search sequences and yield the hits of each KOfam as a list of KOfamHit in database order as soon as the KOfam and all earlier KOfams are searched
+
+        Parameters
+        ----------
+        sequences : str, dict, DigitalSequenceBlock, or iterable
+            See `digitize`
+        number_of_sequences : int
+            Number of sequences used for E-value calculation [Default: Number of sequences]
+        threshold_scale : float
+            Multiplier for the curated thresholds [Default: threshold_scale of the searcher]
+        all_hits : bool
+            Return all included hits without the curated thresholds [Default: all_hits of the searcher]
+        """
+        if threshold_scale is None:
+            threshold_scale = self.threshold_scale
+        if all_hits is None:
+            all_hits = self.all_hits
+        proteins = self.digitize(sequences)
+        if number_of_sequences is None:
+            number_of_sequences = len(proteins)
+        if not len(proteins):
+            return
+
+        duplicates = None
+        if self.deduplicate:
+            proteins, duplicates = deduplicate_sequences(proteins, alphabet=self.alphabet)
+        search_options = dict(E=self.evalue, Z=number_of_sequences)
+        evalue_threshold = None
+        if not (all_hits or not self.threshold_pruning):
+            search_options["bit_cutoffs"] = "trusted"
+            evalue_threshold = min(self.evalue, INCLUSION_EVALUE)
+        queries = self._get_queries(threshold_scale, all_hits, number_of_sequences)
+
+        collector = HitCollector()
+        # Hits are yielded in database order (KOfams may be searched in a different order, see `schedule_queries`)
+        results = ((hits.query.name.decode(), hits) for hits in hmmsearch(queries, proteins, cpus=self.n_jobs, **search_options))
+        for id_ko, hits in reorder_results(results, list(self.name_to_hmm)):
+            if write_hits(hits, self.ko_to_data, threshold_scale, all_hits, collector, evalue_threshold=evalue_threshold, duplicates=duplicates):
+                yield collector.hits
+                collector.hits = list()
+
+    def search(self, sequences, number_of_sequences:int=None, threshold_scale:float=None, all_hits:bool=None):
+        """
+        Search sequences (see `iter_search`)
+
+        Returns
+        -------
+        hits : list
+            List of KOfamHit in the same order as the pykofamsearch output
+        """
+        hits = list()
+        for kofam_hits in self.iter_search(sequences, number_of_sequences=number_of_sequences, threshold_scale=threshold_scale, all_hits=all_hits):
+            hits.extend(kofam_hits)
+        return hits
+
+    def search_batch(self, proteomes, threshold_scale:float=None, all_hits:bool=None):
+        """
+        Search several proteomes sequentially (each search uses n_jobs threads).  E-values are computed with
+        the number of sequences of each proteome.
+
+        Parameters
+        ----------
+        proteomes : dict or iterable
+            Dictionary of proteome identifiers to sequences (see `digitize`) or an iterable of sequences
+
+        Returns
+        -------
+        results : dict or list
+            Hits for each proteome keyed like proteomes
+        """
+        if isinstance(proteomes, dict):
+            return {id_proteome:self.search(sequences, threshold_scale=threshold_scale, all_hits=all_hits) for id_proteome, sequences in proteomes.items()}
+        return [self.search(sequences, threshold_scale=threshold_scale, all_hits=all_hits) for sequences in proteomes]
+
+    async def search_async(self, sequences, **kwargs):
+        """
+        Search sequences on the default executor of the running event loop (see `search`)
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self.search(sequences, **kwargs))
@@ -1,11 +1,18 @@
 #!/usr/bin/env python
-import sys, os, glob, gzip, warnings, argparse, pickle, subprocess, tarfile, shutil, tempfile
+import sys, os, io, glob, gzip, json, ftplib, hashlib, warnings, argparse, pickle, subprocess, tarfile, shutil, tempfile
 from datetime import datetime
-from collections import defaultdict
-from urllib.request import urlopen
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from http.client import HTTPException
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
 from tqdm import tqdm
 from pyhmmer.plan7 import HMMFile
 from . import __version__
+from .database import IndexedDatabaseWriter, IndexedDatabase, get_database_version, build_profile_cache, serialize_hmm, deserialize_hmm
+from .metadata import parse_ko_list, parse_enzyme_commission_from_definition
+from .prefilter import get_consensus_seeds
+from .compression import open_file
 
 __program__ = os.path.split(sys.argv[0])[-1]
 
@@ -20,82 +27,234 @@ def check_mode(opts):
         raise ValueError("Invalid mode: either specify --output_directory for online mode or --serialized_database for offline mode.")
     
 
+def get_remote_metadata(url:str, ftp:ftplib.FTP=None):
+    """
+    Get the size and modification time of a remote file (FTP SIZE/MDTM or HTTP HEAD Content-Length/Last-Modified/ETag).
+    Values the server does not provide are None.
+    """
+    remote = {"url":url, "size":None, "modified":None, "etag":None}
+    if ftp is not None:
+        path = urlparse(url).path
+        try:
+            remote["size"] = ftp.size(path)
+        except ftplib.error_perm:
+            pass
+        try:
+            remote["modified"] = ftp.sendcmd(f"MDTM {path}").split()[-1]
+        except ftplib.error_perm:
+            pass
+    else:
+        try:
+            with urlopen(Request(url, method="HEAD")) as response:
+                if response.headers.get("content-length") is not None:
+                    remote["size"] = int(response.headers["content-length"])
+                remote["modified"] = response.headers.get("last-modified")
+                remote["etag"] = response.headers.get("etag")
+        except (OSError, HTTPException):
+            # Servers that do not support HEAD cannot be verified
+            pass
+    return remote
+
+def is_unchanged_download(previous:dict, remote:dict):
+    """
+    Check if a previous download is of the same remote file.  Downloads cannot be verified (and are not reused)
+    if the server provides neither the size nor the modification time.
+    """
+    if previous is None:
+        return False
+    if remote["size"] is None and remote["modified"] is None and remote["etag"] is None:
+        return False
+    return previous == remote
+
+def download_file(url:str, filepath:str, chunk_size:int=1024*1024):
+    """
+    Download a file over HTTP(S) or FTP to filepath.  Data is written to filepath.part and an
+    interrupted download resumes from the size of the partial file (HTTP Range or FTP REST).
+
+    The size and modification time of the remote file are recorded in filepath.remote so an existing download
+    is only reused, and a partial download is only resumed, if the remote file has not changed (e.g., a new
+    KEGG release).  Otherwise the existing download is discarded and downloaded again.  HTTP resumes also use
+    If-Range so the server sends the whole file if it changed since the partial download.
+    """
+    filepath_part = filepath + ".part"
+    filepath_remote = filepath + ".remote"
+    parsed_url = urlparse(url)
+    ftp = None
+    if parsed_url.scheme == "ftp":
+        ftp = ftplib.FTP(parsed_url.hostname, timeout=60)
+        ftp.login(parsed_url.username or "anonymous", parsed_url.password or "")
+        ftp.voidcmd("TYPE I")
+    remote = get_remote_metadata(url, ftp=ftp)
+    previous = None
+    if os.path.exists(filepath_remote):
+        with open(filepath_remote, "r") as f:
+            previous = json.load(f)
+    unchanged = is_unchanged_download(previous, remote)
+
+    if os.path.exists(filepath):
+        if unchanged and remote["size"] in {None, os.path.getsize(filepath)}:
+            print(f"Using existing download (unchanged remote file): {filepath}", file=sys.stderr)
+            if ftp is not None:
+                ftp.quit()
+            return filepath
+        print(f"Remote file changed or cannot be verified.  Downloading again: {filepath}", file=sys.stderr)
+        os.remove(filepath)
+    if os.path.exists(filepath_part) and not unchanged:
+        print(f"Remote file changed or cannot be verified.  Discarding partial download: {filepath_part}", file=sys.stderr)
+        os.remove(filepath_part)
+    with open(filepath_remote, "w") as f:
+        json.dump(remote, f, indent=4)
+    offset = os.path.getsize(filepath_part) if os.path.exists(filepath_part) else 0
+    if offset:
+        print(f"Resuming download of {url} from {offset} bytes", file=sys.stderr)
+
+    if ftp is not None:
+        total_size = remote["size"]
+        with open(filepath_part, "ab") as f, tqdm(total=total_size, initial=offset, unit='B', unit_scale=True, desc="Downloading") as progress_bar:
+            if total_size is None or offset < total_size:
+                def callback(chunk):
+                    f.write(chunk)
+                    progress_bar.update(len(chunk))
+                ftp.retrbinary(f"RETR {parsed_url.path}", callback, blocksize=chunk_size, rest=offset or None)
+        ftp.quit()
+    else:
+        headers = dict()
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            # The whole file is sent instead of the range if the remote file changed
+            validator = remote["etag"] or remote["modified"]
+            if validator:
+                headers["If-Range"] = validator
+        try:
+            response = urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            # Range not satisfiable means the partial file is already complete
+            if e.code != 416:
+                raise
+            response = None
+        if response is not None:
+            with response:
+                if offset and response.status != 206:
+                    # Server does not support ranges or the remote file changed so start over
+                    offset = 0
+                total_size = offset + int(response.headers.get('content-length', 0))
+                with open(filepath_part, "ab" if offset else "wb") as f, tqdm(total=total_size, initial=offset, unit='B', unit_scale=True, desc="Downloading") as progress_bar:
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        progress_bar.update(len(chunk))
+    if remote["size"] is not None and os.path.getsize(filepath_part) != remote["size"]:
+        size = os.path.getsize(filepath_part)
+        os.remove(filepath_part)
+        raise IOError(f"Downloaded {size} bytes of {url} but the remote file is {remote['size']} bytes.  Run again to download it again.")
+    os.rename(filepath_part, filepath)
+    return filepath
+
 def download_kofam_data_from_ftp(output_directory, ko_list_url, profiles_url):
+    """
+    Download ko_list (decompressed) and profiles.tar.gz (kept compressed and streamed when building the database)
 
-    
+    Returns
+    -------
+    ko_list_path : str
+    profiles_path : str
+    """
     os.makedirs(output_directory, exist_ok=True)
 
     # Download and decompress ko_list.gz
     print(f"Downloading ko_list.gz from {ko_list_url} to {output_directory}/ko_list", file=sys.stderr)
     ko_list_path = os.path.join(output_directory, "ko_list")
-    
-    with urlopen(ko_list_url) as response:
-        with gzip.open(response, 'rb') as gz_file:
-            with open(ko_list_path, 'wb') as out_file:
-                shutil.copyfileobj(gz_file, out_file, length=16*1024)
+    ko_list_gz_path = download_file(ko_list_url, ko_list_path + ".gz")
+    with gzip.open(ko_list_gz_path, 'rb') as gz_file:
+        with open(ko_list_path, 'wb') as out_file:
+            shutil.copyfileobj(gz_file, out_file, length=16*1024)
     print("ko_list successfully downloaded and decompressed", file=sys.stderr)
 
-    # Download and extract profiles.tar.gz using a temporary file
-    print(f"Downloading profiles.tar.gz from {profiles_url} to {output_directory}/profiles/", file=sys.stderr)
-    
-    with tempfile.NamedTemporaryFile(suffix='.tar.gz', delete=True) as temp_tar:
-        # Download with progress bar
-        with urlopen(profiles_url) as response:
-            total_size = int(response.headers.get('content-length', 0))
-            progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, desc="Downloading")
-            while True:
-                chunk = response.read(16*1024)
-                if not chunk:
-                    break
-                temp_tar.write(chunk)
-                progress_bar.update(len(chunk))
-            progress_bar.close()
-        
-        # Ensure all data is written to disk
-        temp_tar.flush()
-        
-        # Extract with progress bar
-        with tarfile.open(temp_tar.name, mode='r:gz') as tar:
-            members = tar.getmembers()
-            progress_bar = tqdm(members, desc="Extracting", total=len(members))
-            for member in members:
-                tar.extract(member, path=output_directory)
-                progress_bar.update(1)
-            progress_bar.close()
-            
-    print("profiles.tar.gz successfully downloaded and extracted", file=sys.stderr)
-    
-def parse_enzyme_commission_from_definition(definition:str):
+    # Download profiles.tar.gz (resumable)
+    print(f"Downloading profiles.tar.gz from {profiles_url} to {output_directory}/profiles.tar.gz", file=sys.stderr)
+    profiles_path = download_file(profiles_url, os.path.join(output_directory, "profiles.tar.gz"))
+    print("profiles.tar.gz successfully downloaded", file=sys.stderr)
+    return ko_list_path, profiles_path
+
+def get_input_signature(filepath:str, chunk_size:int=1024*1024):
+    """
+    Get the size and checksum (md5) of a file (e.g., ko_list or profiles.tar.gz) or the number of HMM files and
+    the checksum of their names and sizes for a profiles directory so a build checkpoint is not resumed with different inputs
     """
-    Parse enzyme commission from KOfam definition
+    if os.path.isdir(filepath):
+        filenames = sorted(filename for filename in os.listdir(filepath) if filename.endswith(".hmm"))
+        checksum = hashlib.md5()
+        for filename in filenames:
+            checksum.update("{}\t{}\n".format(filename, os.path.getsize(os.path.join(filepath, filename))).encode())
+        return {"number_of_files":len(filenames), "checksum":checksum.hexdigest()}
+    checksum = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+    return {"size":os.path.getsize(filepath), "checksum":checksum.hexdigest()}
 
-    Parameters
-    ----------
-    definition : str
-        KOfam definition
+def iterate_profiles(profiles:str, ko_to_data:dict, skip:set=None):
+    """
+    Yield (id_ko, data) for the HMM file of each KOfam from a profiles directory or streamed from a profiles.tar.gz
+    without extracting to disk.  KOfams that are not in ko_to_data or are in skip are ignored.
+    """
+    if skip is None:
+        skip = set()
+    if os.path.isdir(profiles):
+        for id_ko in ko_to_data:
+            if id_ko in skip:
+                continue
+            ko_filepath = os.path.join(profiles, f"{id_ko}.hmm")
+            if os.path.exists(ko_filepath):
+                with open(ko_filepath, "rb") as f:
+                    yield id_ko, f.read()
+    else:
+        with tarfile.open(profiles, mode="r|*") as tar:
+            for member in tar:
+                filename = os.path.basename(member.name)
+                if member.isfile() and filename.endswith(".hmm"):
+                    id_ko = filename[:-len(".hmm")]
+                    if id_ko in ko_to_data and id_ko not in skip:
+                        yield id_ko, tar.extractfile(member).read()
+
+def parse_profile(args):
+    """
+    Parse an HMM file, serialize each HMM to HMMER binary format, and get the prefilter seeds
 
     Returns
     -------
-    enzymes : set
-        Set of enzymes
-
-    Raises
-    ------
-    ValueError
-        If the definition is invalid
-    """
-
-    enzymes = set()
-    if "[EC:" in definition:
-        fields = definition.split("[EC:")
-        if not len(fields) == 2:
-            raise ValueError("Invalid definition: {}".format(definition))
-        enzymes_unformatted = fields[-1][:-1]
-        if not "." in enzymes_unformatted:
-            raise ValueError("Invalid enzyme commission: {}".format(enzymes_unformatted))
-        enzymes = set(enzymes_unformatted.split(" "))
-    return enzymes
+    id_ko : str
+        KOfam identifier from the filename
+    models : list
+        List of (name, blob, seeds, model_length) where seeds are the consensus k-mers for the prefilter
+    """
+    id_ko, data = args
+    with HMMFile(io.BytesIO(data)) as f:
+        return id_ko, [(hmm.name.decode(), serialize_hmm(hmm), get_consensus_seeds(hmm), hmm.M) for hmm in f]
 
+def parse_profiles(profiles, n_jobs:int=1, max_pending:int=None):
+    """
+    Parse (id_ko, data) HMM files with a process pool.  Results are yielded as they complete
+    and at most max_pending files are read ahead so memory stays bounded.
+    """
+    if n_jobs == 1:
+        yield from map(parse_profile, profiles)
+        return
+    if max_pending is None:
+        max_pending = n_jobs * 8
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = set()
+        for item in profiles:
+            pending.add(executor.submit(parse_profile, item))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
+    
 def main(args=None):
     # Options
     # =======
@@ -104,7 +263,7 @@ def main(args=None):
     script_filename = __program__
     description = """
     Running: {} v{} via Python v{} | {}""".format(__program__, __version__, sys.version.split(" ")[0], sys.executable)
-    usage = "{} -d <path/to/kofam_profiles_database_directory/> -k <path/to/ko_list> -b <kofam_hmm_database.pkl.gz> -f name ".format(__program__)
+    usage = "{} -d <path/to/kofam_profiles_database_directory/> -k <path/to/ko_list> -b <kofam_hmm_database.pkl.gz> -f pickle ".format(__program__)
     epilog = "PyKOfamSearch"
 
     # Parser
@@ -114,8 +273,8 @@ def main(args=None):
 
     # Pipeline
     parser_offline = parser.add_argument_group('Offline arguments')
-    parser_offline.add_argument("-b", "--serialized_database",  type=str, help="path/to/database.pkl[.gz] will be tuple where first item is threshold dictionary and second item is dictionary of HMM models. Cannot be used with -o/--output_directory")
-    parser_offline.add_argument("-d", "--profiles",  type=str, help="path/to/kofam_profiles_database_directory/ .  [Command: `wget -v -c ftp://ftp.genome.jp/pub/db/kofam/profiles.tar.gz -O - |  tar -xz`]")
+    parser_offline.add_argument("-b", "--serialized_database",  type=str, help="path/to/database.pkl[.gz] will be tuple where first item is dictionary of KOfam metadata (thresholds, score types, definitions, and enzyme commissions) and second item is dictionary of HMM models.  If --database_format indexed then path/to/database.kofamdb.  Cannot be used with -o/--output_directory")
+    parser_offline.add_argument("-d", "--profiles",  type=str, help="path/to/kofam_profiles_database_directory/ or path/to/profiles.tar.gz (streamed without extracting).  [Command: `wget -v -c ftp://ftp.genome.jp/pub/db/kofam/profiles.tar.gz`]")
     parser_offline.add_argument("-k", "--ko_list",  type=str, help="path/to/ko_list[.gz] . [Command: wget -v -O - ftp://ftp.genome.jp/pub/db/kofam/ko_list.gz | gzip -d > ko_list]")
 
     parser_online = parser.add_argument_group('Online arguments')
@@ -123,6 +282,12 @@ def main(args=None):
     parser_online.add_argument("--ko_list_url",  type=str, default="ftp://ftp.genome.jp/pub/db/kofam/ko_list.gz", help="FTP URL for ko_list [Default: ftp://ftp.genome.jp/pub/db/kofam/ko_list.gz]")
     parser_online.add_argument("--profiles_url",  type=str, default="ftp://ftp.genome.jp/pub/db/kofam/profiles.tar.gz", help="FTP URL for profiles.tar.gz [Default: ftp://ftp.genome.jp/pub/db/kofam/profiles.tar.gz]")
 
+    parser_database = parser.add_argument_group('Database arguments')
+    parser_database.add_argument("-f", "--database_format", type=str, default="pickle", choices={"pickle", "indexed"}, help="Serialized database format. `indexed` is a memory-mapped file with an offset index where HMMs are only decoded when needed (must be uncompressed) [Default: pickle]")
+
+    parser_database.add_argument("-p", "--n_jobs", type=int, default=1, help="Number of processes used to parse HMMs [Default: 1]")
+    parser_database.add_argument("--profile_cache_directory", type=str, help="path/to/profile_cache/ to write pre-optimized (hmmpress) profiles for the serialized database so `pykofamsearch --profile_cache_directory` can load them directly")
+
     opts = parser.parse_args()
     opts.script_directory  = script_directory
     opts.script_filename = script_filename
@@ -130,86 +295,90 @@ def main(args=None):
     # Mode
     mode = check_mode(opts)
     
+    database_version = None
     if mode == "online":
         database_version = "v{}".format(datetime.now().strftime("%Y.%m.%-d"))
 
         # Download KOFAM data
         # ===================
-        download_kofam_data_from_ftp(
+        opts.ko_list, opts.profiles = download_kofam_data_from_ftp(
             output_directory=os.path.join(opts.output_directory, "data"),
             ko_list_url=opts.ko_list_url,
             profiles_url=opts.profiles_url
         )
-        opts.ko_list = os.path.join(opts.output_directory, "data", "ko_list")
-        opts.profiles = os.path.join(opts.output_directory, "data", "profiles")
-        opts.serialized_database = os.path.join(opts.output_directory, "database.pkl.gz")
+        if opts.database_format == "indexed":
+            opts.serialized_database = os.path.join(opts.output_directory, "database.kofamdb")
+        else:
+            opts.serialized_database = os.path.join(opts.output_directory, "database.pkl.gz")
         with open(os.path.join(opts.output_directory, "database.version"), "w") as f:
             print(database_version, file=f)
             
         
     # Database
     # ========
-    # Load KOFAM thresholds
-    ko_to_data = defaultdict(dict)
-    if opts.ko_list.endswith(".gz"):
-        f = gzip.open(opts.ko_list, "rt")
-    else:
-        f = open(opts.ko_list, "r")
-        
-    header = next(f).strip().split("\t")[1:]
-    for line in f:
-        line = line.strip()
-        if line:
-            id_ko, *fields = line.split("\t")
-            
-            for i, v in enumerate(fields):
-                id_field = header[i]
-                try:
-                    v = float(v)
-                except ValueError:
-                    v = v
-                if v == "-":
-                    v = None
-                ko_to_data[id_ko][id_field] = v
-    f.close()
-    
-    # Add enzyme commission
-    for id_ko in ko_to_data:
-        ko_to_data[id_ko]["enzyme_commission"] = parse_enzyme_commission_from_definition(ko_to_data[id_ko]["definition"])
+    # Load KOFAM thresholds (enzyme commissions are parsed from definitions)
+    ko_to_data = parse_ko_list(opts.ko_list)
     if mode == "online":
-        from pandas import DataFrame
-        df = DataFrame(ko_to_data).T
-        df.index.name = "id_ko"
+        df = ko_to_data.to_dataframe().drop(["checksum", "seeds", "model_length"], axis=1, errors="ignore")
         df.to_csv(os.path.join(opts.output_directory, "kegg-ortholog_metadata.tsv"), sep="\t")
-    # Load HMMs
-    if not os.path.isdir(opts.profiles):
-        raise ValueError("--profiles must be a directory of HMM files.  If you need to download, use the following command: `wget -v -c ftp://ftp.genome.jp/pub/db/kofam/profiles.tar.gz -O - |  tar -xz`")
-
-    name_to_hmm = dict()
-    missing_kos = set()
-    for id_ko in tqdm(ko_to_data, desc="Loading KOfam HMMs", total=len(ko_to_data)):
-        ko_filepath = os.path.join(opts.profiles, f"{id_ko}.hmm")
-        try:
-            with HMMFile(ko_filepath) as f:
-                for hmm in list(f):
-                    name = hmm.name
-                    name = name.decode()
-                    assert name == id_ko, "Filename {} does not match KOfam name {}".format(os.path.split(ko_filepath)[1], name)
-                    name_to_hmm[id_ko] = hmm
-        except FileNotFoundError:
-            missing_kos.add(id_ko)
-    assert len(name_to_hmm), "No HMM files detected in {}.  Are you sure this is a profiles/ directory?".format(opts.profiles)
-        
+    # Build database
+    # ==============
+    if not os.path.isdir(opts.profiles) and not (os.path.isfile(opts.profiles) and tarfile.is_tarfile(opts.profiles)):
+        raise ValueError("--profiles must be a directory of HMM files or profiles.tar.gz.  If you need to download, use the following command: `wget -v -c ftp://ftp.genome.jp/pub/db/kofam/profiles.tar.gz`")
+    if opts.serialized_database.endswith((".gz", ".pgz", ".bgz", ".zst")) and opts.database_format == "indexed":
+        raise ValueError("--database_format indexed cannot be compressed because it is memory-mapped")
+
+    # HMMs are parsed in parallel and written incrementally to an indexed database with a checkpoint journal
+    # so an interrupted build resumes where it stopped.  Pickle databases are converted from the indexed build.
+    if opts.database_format == "indexed":
+        build_filepath = opts.serialized_database
+    else:
+        build_filepath = opts.serialized_database + ".build.kofamdb"
+    metadata = {"version":database_version, "pykofamsearch":__version__}
+    # The checkpoint is only resumed if ko_list and the profiles are unchanged
+    inputs = {"ko_list":get_input_signature(opts.ko_list), "profiles":get_input_signature(opts.profiles)}
+    print(f"Building indexed KOfams: {build_filepath}", file=sys.stderr)
+    with IndexedDatabaseWriter(build_filepath, ko_to_data, metadata=metadata, checkpoint=True, inputs=inputs) as writer:
+        if writer.models:
+            print(f"Resuming from checkpoint: {len(writer.models)} KOfams already written", file=sys.stderr)
+        profiles = iterate_profiles(opts.profiles, ko_to_data, skip=set(writer.models))
+        for id_ko, models in tqdm(parse_profiles(profiles, n_jobs=opts.n_jobs), desc="Parsing KOfam HMMs", total=len(ko_to_data) - len(writer.models)):
+            for name, blob, seeds, model_length in models:
+                assert name == id_ko, "Filename {}.hmm does not match KOfam name {}".format(id_ko, name)
+                writer.add_blob(id_ko, blob, model_length=model_length)
+                ko_to_data[id_ko]["seeds"] = seeds
+        # Prefilter seeds (and model lengths from older journals) for KOfams written before resuming from a checkpoint
+        for id_ko in writer.models:
+            if ko_to_data[id_ko].get("seeds") is None or ko_to_data[id_ko].get("model_length") is None:
+                hmm = deserialize_hmm(writer.get_blob(id_ko))
+                ko_to_data[id_ko]["seeds"] = get_consensus_seeds(hmm)
+                ko_to_data[id_ko]["model_length"] = hmm.M
+        assert len(writer.models), "No HMM files detected in {}.  Are you sure this is a profiles/ directory or profiles.tar.gz?".format(opts.profiles)
+    missing_kos = ko_to_data.keys() - writer.models.keys()
+
     # Output
     # ======
     # Write serialized database
-    print(f"Writing serialized KOfams: {opts.serialized_database}", file=sys.stderr)
-    if opts.serialized_database.endswith((".gz", ".pgz")):
-        f_out = gzip.open(opts.serialized_database, "wb")
-    else:
-        f_out = open(opts.serialized_database, "wb")
-    pickle.dump((ko_to_data, name_to_hmm), f_out)
-    f_out.close()
+    if opts.database_format == "pickle":
+        print(f"Writing serialized KOfams: {opts.serialized_database}", file=sys.stderr)
+        database = IndexedDatabase(build_filepath)
+        name_to_hmm = {id_ko:database[id_ko] for id_ko in tqdm(database, desc="Decoding KOfam HMMs", total=len(database))}
+        ko_to_data = database.ko_to_data
+        database.close()
+        # .gz/.pgz (BGZF) and .zst are compressed on threads
+        with open_file(opts.serialized_database, "wb", threads=opts.n_jobs) as f_out:
+            # Metadata is written as a dictionary of dictionaries so earlier versions can load the database
+            pickle.dump((ko_to_data.to_dict(), name_to_hmm), f_out)
+        os.remove(build_filepath)
+
+    # Write pre-optimized profiles
+    if opts.profile_cache_directory:
+        if opts.database_format == "indexed":
+            name_to_hmm = IndexedDatabase(opts.serialized_database)
+            ko_to_data = name_to_hmm.ko_to_data
+        cache_version = get_database_version(ko_to_data, name_to_hmm)
+        print(f"Writing pre-optimized profiles: {opts.profile_cache_directory}", file=sys.stderr)
+        build_profile_cache(opts.profile_cache_directory, cache_version, name_to_hmm)
     
     
     
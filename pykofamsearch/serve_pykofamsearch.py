@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+import sys, os, io, time, json, queue, argparse, threading, warnings
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from pyhmmer.easel import SequenceFile, Alphabet, DigitalSequenceBlock
+from pyhmmer import hmmsearch
+from . import __version__
+from .pykofamsearch import load_database, filter_hmmsearch_threshold, INCLUSION_EVALUE
+from .resources import parse_n_jobs, get_available_cpus
+
+__program__ = os.path.split(sys.argv[0])[-1]
+
+HEADER = ["id_protein", "id_ko", "threshold", "score", "e-value", "definition", "enzyme_commission"]
+
+class SearchRequest(object):
+    """
+    Proteome submitted to the server.  Results are set on `future` as a list of TSV lines.
+    """
+    def __init__(self, proteins, threshold_scale:float, all_hits:bool):
+        self.proteins = proteins
+        self.threshold_scale = threshold_scale
+        self.all_hits = all_hits
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+class Metrics(object):
+    """
+    Thread-safe counters for queue depth, batching, and latency
+    """
+    def __init__(self, window:int=1000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.sequences = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def update_batch(self, requests:list, duration:float):
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.sequences += sum(len(request.proteins) for request in requests)
+            self.batch_sizes.append(len(requests))
+            now = time.monotonic()
+            for request in requests:
+                self.latencies.append(now - request.submitted)
+
+    def to_dict(self, queue_depth:int):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            def percentile(q):
+                if not latencies:
+                    return None
+                return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+            return OrderedDict([
+                ("uptime", time.time() - self.started),
+                ("queue_depth", queue_depth),
+                ("requests", self.requests),
+                ("sequences", self.sequences),
+                ("batches", self.batches),
+                ("errors", self.errors),
+                ("mean_requests_per_batch", sum(self.batch_sizes)/len(self.batch_sizes) if self.batch_sizes else None),
+                ("latency_mean", sum(latencies)/len(latencies) if latencies else None),
+                ("latency_p50", percentile(0.5)),
+                ("latency_p95", percentile(0.95)),
+                ("latency_max", latencies[-1] if latencies else None),
+            ])
+
+class KOfamSearchServer(object):
+    """
+    Keeps the KOfam database resident and batches concurrent requests into a single hmmsearch pass
+    """
+    def __init__(
+        self,
+        ko_to_data:dict,
+        name_to_hmm:dict,
+        n_jobs:int=1,
+        evalue:float=0.1,
+        batch_window:float=0.1,
+        max_batch_sequences:int=10000,
+        ):
+        self.ko_to_data = ko_to_data
+        self.name_to_hmm = name_to_hmm
+        self.n_jobs = n_jobs
+        self.evalue = evalue
+        self.batch_window = batch_window
+        self.max_batch_sequences = max_batch_sequences
+        self.alphabet = Alphabet.amino()
+        self.queue = queue.Queue()
+        self.metrics = Metrics()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, proteins, threshold_scale:float=1.0, all_hits:bool=False):
+        request = SearchRequest(proteins, threshold_scale=threshold_scale, all_hits=all_hits)
+        self.queue.put(request)
+        return request.future
+
+    def _next_batch(self):
+        # Block for the first request then collect others that arrive within the batch window
+        requests = [self.queue.get()]
+        number_of_sequences = len(requests[0].proteins)
+        deadline = time.monotonic() + self.batch_window
+        while number_of_sequences < self.max_batch_sequences:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            number_of_sequences += len(request.proteins)
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            t0 = time.monotonic()
+            try:
+                results = self.search_batch(requests)
+            except Exception as e:
+                with self.metrics.lock:
+                    self.metrics.errors += len(requests)
+                for request in requests:
+                    request.future.set_exception(e)
+                continue
+            for request, lines in zip(requests, results):
+                request.future.set_result(lines)
+            self.metrics.update_batch(requests, time.monotonic() - t0)
+
+    def search_batch(self, requests:list):
+        """
+        Search all requests in one hmmsearch pass.  Sequence names are prefixed with the request
+        index and E-values are recomputed from P-values with each request's number of sequences.
+        """
+        block = DigitalSequenceBlock(self.alphabet)
+        for i, request in enumerate(requests):
+            for sequence in request.proteins:
+                sequence = sequence.copy()
+                sequence.name = "{}|".format(i).encode() + sequence.name
+                block.append(sequence)
+        results = [list() for request in requests]
+        if not len(block):
+            return results
+
+        evalue_threshold = min(self.evalue, INCLUSION_EVALUE)
+        for hits in hmmsearch(self.name_to_hmm.values(), block, cpus=self.n_jobs, E=self.evalue):
+            id_ko = hits.query.name.decode()
+            data = self.ko_to_data[id_ko]
+            for hit in hits:
+                i, id_protein = hit.name.decode().split("|", 1)
+                request = requests[int(i)]
+                evalue = hit.pvalue * len(request.proteins)
+                if evalue <= evalue_threshold:
+                    result = filter_hmmsearch_threshold(hit, data["threshold"], request.threshold_scale, data["score_type"], return_failed_threshold=request.all_hits, evalue=evalue)
+                    if result:
+                        scaled_threshold, score, evalue = result
+                        if request.all_hits:
+                            scaled_threshold = "" if scaled_threshold is None else scaled_threshold
+                        results[int(i)].append("\t".join(map(str, [
+                            id_protein,
+                            id_ko,
+                            scaled_threshold,
+                            "{:0.3f}".format(score),
+                            "{:0.5e}".format(evalue),
+                            data["definition"],
+                            data["enzyme_commission"],
+                        ])))
+        return results
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /search with a fasta body (optional query parameters: threshold_scale, all_hits, no_header)
+    GET /metrics for queue depth and latency
+    GET /health
+    """
+    server_version = "PyKOfamSearch/{}".format(__version__)
+
+    def address_string(self):
+        # Unix sockets do not have a client address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return "unix"
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, indent=4).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        searcher = self.server.searcher
+        if self.path.startswith("/metrics"):
+            self._send_json(searcher.metrics.to_dict(searcher.queue.qsize()))
+        elif self.path.startswith("/health"):
+            self._send_json({"status":"ok", "number_of_kofams":len(searcher.name_to_hmm)})
+        else:
+            self._send_json({"error":"Unknown path: {}".format(self.path)}, status=404)
+
+    def do_POST(self):
+        from urllib.parse import urlparse, parse_qs
+
+        url = urlparse(self.path)
+        if url.path != "/search":
+            self._send_json({"error":"Unknown path: {}".format(url.path)}, status=404)
+            return
+        params = {k:v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            threshold_scale = float(params.get("threshold_scale", self.server.threshold_scale))
+            all_hits = params.get("all_hits", "false").lower() in {"1", "true", "yes"}
+            no_header = params.get("no_header", "false").lower() in {"1", "true", "yes"}
+            length = int(self.headers.get("Content-Length", 0))
+            with SequenceFile(io.BytesIO(self.rfile.read(length)), format="fasta", digital=True, alphabet=self.server.searcher.alphabet) as f:
+                proteins = f.read_block()
+        except Exception as e:
+            self._send_json({"error":str(e)}, status=400)
+            return
+
+        try:
+            lines = self.server.searcher.submit(proteins, threshold_scale=threshold_scale, all_hits=all_hits).result()
+        except Exception as e:
+            self._send_json({"error":str(e)}, status=500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/tab-separated-values")
+        self.end_headers()
+        if not no_header:
+            self.wfile.write(("\t".join(HEADER) + "\n").encode())
+        for line in lines:
+            self.wfile.write((line + "\n").encode())
+
+    def log_message(self, format, *args):
+        if self.server.verbosity > 1:
+            super().log_message(format, *args)
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        return request, ("unix", 0)
+
+def main(args=None):
+    # Options
+    # =======
+    # Path info
+    script_directory  =  os.path.dirname(os.path.abspath( __file__ ))
+    script_filename = __program__
+    description = """
+    Running: {} v{} via Python v{} | {}""".format(__program__, __version__, sys.version.split(" ")[0], sys.executable)
+    usage = "{} -b <database.pkl.gz> --port 8000 | --unix_socket <path/to/pykofamsearch.sock>".format(__program__)
+    epilog = "PyKOfamSearch"
+
+    # Parser
+    parser = argparse.ArgumentParser(description=description, usage=usage, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
+
+    # Pipeline
+    parser.add_argument("--verbosity", type=int, default=1, help="Verbosity of requests [Default: 1]")
+    parser.add_argument('-v', '--version', action='version', version=__version__)
+
+    parser_server = parser.add_argument_group('Server arguments')
+    parser_server.add_argument("--host", type=str, default="127.0.0.1", help = "Host to bind [Default: 127.0.0.1]")
+    parser_server.add_argument("--port", type=int, default=8000, help = "Port to bind [Default: 8000]")
+    parser_server.add_argument("--unix_socket", type=str, help = "path/to/pykofamsearch.sock to listen on a local Unix socket instead of --host/--port")
+    parser_server.add_argument("--batch_window", type=float, default=0.1, help = "Seconds to wait for concurrent requests to batch into one hmmsearch pass [Default: 0.1]")
+    parser_server.add_argument("--max_batch_sequences", type=int, default=10000, help = "Maximum number of sequences in a batch [Default: 10000]")
+
+    parser_utility = parser.add_argument_group('Utility arguments')
+    parser_utility.add_argument("-p","--n_jobs", type=parse_n_jobs, default=1,  help = "Number of threads to use.  `auto` (or -1) uses the CPUs available to the process (CPU affinity limited by the cgroup CPU quota) [Default: 1]")
+
+    parser_hmmsearch = parser.add_argument_group('HMMSearch arguments')
+    parser_hmmsearch.add_argument("-e","--evalue", type=float, default=0.1,  help = "E-value threshold [Default: 0.1]")
+    parser_hmmsearch.add_argument("-t","--threshold_scale", type=float, default=1.0, help = "Default multiplier for the curated thresholds which can be changed per request [Default: 1.0]")
+
+    parser_database = parser.add_argument_group('Database arguments')
+    parser_database.add_argument("-d", "--database_directory", type=str, help="path/to/kofam_database_directory/ cannot be used with -b/-serialized_database")
+    parser_database.add_argument("-b", "--serialized_database", type=str, help="path/to/database.pkl[.gz] or path/to/database.kofamdb (indexed) cannot be used with -d/--database_directory")
+    parser_database.add_argument("-s", "--subset", type=str, help = "path/to/identifiers.list where HMM identifiers are on a separate line used to subset the database")
+    parser_database.add_argument("--profile_cache_directory", type=str, help="path/to/profile_cache/ of pre-optimized (hmmpress) profiles keyed by the checksum of the (subset) models")
+
+    opts = parser.parse_args(args)
+    opts.script_directory  = script_directory
+    opts.script_filename = script_filename
+
+    # Threads
+    # =======
+    cpus_available = get_available_cpus()
+    if opts.n_jobs == "auto":
+        opts.n_jobs = cpus_available
+    if opts.n_jobs > cpus_available:
+        warnings.warn("--n_jobs {} but only {} cpus are available. Adjusting --n_jobs to {}".format(opts.n_jobs, cpus_available, cpus_available))
+        opts.n_jobs = cpus_available
+
+    # Database
+    # ========
+    if not any([opts.serialized_database, opts.database_directory]):
+        try:
+            opts.database_directory = os.environ["KOFAM_DATABASE"]
+        except KeyError:
+            print("Must either provide -d/--database_directory, -b/--serialized_database or set `KOFAM_DATABASE` environment variable")
+            sys.exit(1)
+    ko_to_data, name_to_hmm, missing_kos = load_database(
+        database_directory=opts.database_directory,
+        serialized_database=opts.serialized_database,
+        profile_cache_directory=opts.profile_cache_directory,
+        subset=opts.subset,
+    )
+    # Decode all HMMs once so requests never pay for it
+    name_to_hmm = {id_ko:hmm for id_ko, hmm in name_to_hmm.items()}
+    print("Number of missing KOfams: {}".format(len(missing_kos)), file=sys.stderr)
+
+    # Server
+    # ======
+    searcher = KOfamSearchServer(
+        ko_to_data=ko_to_data,
+        name_to_hmm=name_to_hmm,
+        n_jobs=opts.n_jobs,
+        evalue=opts.evalue,
+        batch_window=opts.batch_window,
+        max_batch_sequences=opts.max_batch_sequences,
+    )
+    if opts.unix_socket:
+        if os.path.exists(opts.unix_socket):
+            os.remove(opts.unix_socket)
+        server = ThreadingUnixHTTPServer(opts.unix_socket, SearchRequestHandler)
+        address = opts.unix_socket
+    else:
+        server = ThreadingHTTPServer((opts.host, opts.port), SearchRequestHandler)
+        address = "http://{}:{}".format(opts.host, opts.port)
+    server.searcher = searcher
+    server.threshold_scale = opts.threshold_scale
+    server.verbosity = opts.verbosity
+    print("Serving {} KOfams on {}".format(len(name_to_hmm), address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if opts.unix_socket and os.path.exists(opts.unix_socket):
+            os.remove(opts.unix_socket)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+import sys, os, json, time, heapq, argparse, subprocess
+from . import __version__
+from .pykofamsearch import load_database
+from .database import get_model_lengths
+
+__program__ = os.path.split(sys.argv[0])[-1]
+
+HEADER = ["id_protein", "id_ko", "threshold", "score", "e-value", "definition", "enzyme_commission"]
+
+def partition_by_length(name_to_length:dict, n_shards:int):
+    """
+    Partition KOfams into shards balanced by HMM length (M) using longest-processing-time-first
+
+    Parameters
+    ----------
+    name_to_length : dict
+        Dictionary of KOfam identifiers to HMM length
+    n_shards : int
+        Number of shards
+
+    Returns
+    -------
+    shards : list
+        List of lists of KOfam identifiers.  Partitioning is deterministic for the same input.
+    """
+    shards = [list() for i in range(n_shards)]
+    loads = [0]*n_shards
+    for id_ko, length in sorted(name_to_length.items(), key=lambda x: (-x[1], x[0])):
+        i = min(range(n_shards), key=lambda i: (loads[i], i))
+        shards[i].append(id_ko)
+        loads[i] += length
+    return shards
+
+# Queue
+# =====
+# queue_directory/
+#     queue.json              Arguments, number of shards, and KOfam order of the database
+#     shard_{i}.list          KOfam identifiers for shard i (used as pykofamsearch --subset)
+#     shard_{i}.claimed       Created atomically by the worker that claims shard i (hostname, pid, and time) and touched as a heartbeat
+#     shard_{i}.tsv           Results for shard i (renamed from shard_{i}.{hostname}.{pid}.tmp when complete)
+
+# Seconds between heartbeats of a running shard and seconds without a heartbeat before a claim is stale
+HEARTBEAT_INTERVAL = 30
+STALE_CLAIM_TIMEOUT = 600
+
+def get_shard_filepath(queue_directory:str, i:int, extension:str):
+    return os.path.join(queue_directory, "shard_{}.{}".format(i, extension))
+
+def initialize_queue(
+    queue_directory:str,
+    n_shards:int,
+    pykofamsearch_arguments:list,
+    database_directory:str=None,
+    serialized_database:str=None,
+    subset:str=None,
+    ):
+    ko_to_data, name_to_hmm, missing_kos = load_database(
+        database_directory=database_directory,
+        serialized_database=serialized_database,
+        subset=subset,
+    )
+    # Lengths are read from the metadata so HMMs of indexed databases are not decoded
+    name_to_length = get_model_lengths(ko_to_data, name_to_hmm)
+    shards = partition_by_length(name_to_length, n_shards)
+
+    os.makedirs(queue_directory, exist_ok=True)
+    for i, shard in enumerate(shards):
+        with open(get_shard_filepath(queue_directory, i, "list"), "w") as f:
+            for id_ko in shard:
+                print(id_ko, file=f)
+    with open(os.path.join(queue_directory, "queue.json"), "w") as f:
+        json.dump({
+            "n_shards":n_shards,
+            "arguments":pykofamsearch_arguments,
+            "kos":[id_ko for id_ko in name_to_hmm],
+            "lengths":[sum(name_to_length[id_ko] for id_ko in shard) for shard in shards],
+        }, f, indent=4)
+    return shards
+
+def get_claim_token():
+    return "{}\t{}".format(os.uname().nodename, os.getpid())
+
+def is_stale_claim(filepath:str, stale_claim_timeout:float=STALE_CLAIM_TIMEOUT):
+    """
+    Check if a claim was left by a worker that is no longer running.  Claims of dead processes on the same host
+    are stale immediately and claims from any host are stale without a heartbeat for stale_claim_timeout seconds
+    (e.g., the node was killed, preempted, or ran out of memory).
+    """
+    try:
+        with open(filepath, "r") as f:
+            hostname, pid = f.read().split("\t")[:2]
+        modification_time = os.path.getmtime(filepath)
+    except (OSError, ValueError):
+        return False
+    if hostname == os.uname().nodename:
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            pass
+    return time.time() - modification_time > stale_claim_timeout
+
+def claim_shard(queue_directory:str, n_shards:int, stale_claim_timeout:float=STALE_CLAIM_TIMEOUT):
+    """
+    Claim the next unclaimed shard by atomically creating its claim file (safe across nodes on a shared filesystem).
+    Stale claims (see `is_stale_claim`) are moved aside atomically so usually only one worker reclaims the shard.  If two
+    workers race, the shard is run twice and the identical results of the later worker replace the earlier.
+    """
+    for i in range(n_shards):
+        if os.path.exists(get_shard_filepath(queue_directory, i, "tsv")):
+            continue
+        filepath = get_shard_filepath(queue_directory, i, "claimed")
+        if is_stale_claim(filepath, stale_claim_timeout=stale_claim_timeout):
+            filepath_stale = "{}.{}.{}.stale".format(filepath, os.uname().nodename, os.getpid())
+            try:
+                os.rename(filepath, filepath_stale)
+            except FileNotFoundError:
+                continue
+            # Partial output of the stale worker is removed
+            with open(filepath_stale, "r") as f:
+                hostname, pid = f.read().split("\t")[:2]
+            filepath_tmp = get_shard_filepath(queue_directory, i, "{}.{}.tmp".format(hostname, pid))
+            if os.path.exists(filepath_tmp):
+                os.remove(filepath_tmp)
+            os.remove(filepath_stale)
+            print("Reclaiming stale shard {} from {} (pid {})".format(i, hostname, pid), file=sys.stderr)
+        try:
+            fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(fd, "w") as f:
+            print("{}\t{}".format(get_claim_token(), time.time()), file=f)
+        return i
+
+def release_shard(queue_directory:str, i:int):
+    """
+    Remove the claim of a shard if it is still held by this worker so another worker can retry the shard
+    """
+    filepath = get_shard_filepath(queue_directory, i, "claimed")
+    try:
+        with open(filepath, "r") as f:
+            if not f.read().startswith(get_claim_token() + "\t"):
+                return
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+def run_worker(queue_directory:str, n_jobs:int=1, stale_claim_timeout:float=STALE_CLAIM_TIMEOUT):
+    """
+    Claim and run shards until the queue is empty.  The claim file is touched every HEARTBEAT_INTERVAL
+    seconds while a shard runs so other workers do not reclaim it.
+    """
+    with open(os.path.join(queue_directory, "queue.json"), "r") as f:
+        queue = json.load(f)
+    while True:
+        i = claim_shard(queue_directory, queue["n_shards"], stale_claim_timeout=stale_claim_timeout)
+        if i is None:
+            break
+        # Temporary output is unique to the worker in case a slow worker's claim was reclaimed
+        filepath_tmp = get_shard_filepath(queue_directory, i, "{}.{}.tmp".format(os.uname().nodename, os.getpid()))
+        cmd = [
+            sys.executable, "-m", "pykofamsearch.pykofamsearch",
+            *queue["arguments"],
+            "--subset", get_shard_filepath(queue_directory, i, "list"),
+            "--output", filepath_tmp,
+            "--no_header",
+            "--n_jobs", str(n_jobs),
+            "--verbosity", "0",
+        ]
+        print("Running shard {}: {}".format(i, " ".join(cmd)), file=sys.stderr)
+        process = subprocess.Popen(cmd)
+        try:
+            while True:
+                try:
+                    process.wait(timeout=HEARTBEAT_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    try:
+                        os.utime(get_shard_filepath(queue_directory, i, "claimed"))
+                    except FileNotFoundError:
+                        pass
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+        except (subprocess.CalledProcessError, KeyboardInterrupt):
+            # Release the claim so another worker can retry the shard
+            if process.poll() is None:
+                process.kill()
+            release_shard(queue_directory, i)
+            if os.path.exists(filepath_tmp):
+                os.remove(filepath_tmp)
+            raise
+        os.rename(filepath_tmp, get_shard_filepath(queue_directory, i, "tsv"))
+
+def merge_shards(queue_directory:str, f_output, no_header:bool=False):
+    """
+    Merge shard results into the same ordering as a single run (KOfams in database order)
+    """
+    with open(os.path.join(queue_directory, "queue.json"), "r") as f:
+        queue = json.load(f)
+    incomplete = [i for i in range(queue["n_shards"]) if not os.path.exists(get_shard_filepath(queue_directory, i, "tsv"))]
+    if incomplete:
+        raise FileNotFoundError("Shards have not completed: {}.  Run `worker` to run unclaimed shards and reclaim stale claims (see --stale_claim_timeout)".format(", ".join(map(str, incomplete))))
+
+    ko_to_rank = {id_ko:i for i, id_ko in enumerate(queue["kos"])}
+    files = [open(get_shard_filepath(queue_directory, i, "tsv"), "r") for i in range(queue["n_shards"])]
+    if not no_header:
+        print(*HEADER, sep="\t", file=f_output)
+    # Each KOfam is in exactly one shard and each shard is written in database order
+    for line in heapq.merge(*files, key=lambda line: ko_to_rank[line.split("\t", 2)[1]]):
+        f_output.write(line)
+    for f in files:
+        f.close()
+
+def main(args=None):
+    # Options
+    # =======
+    # Path info
+    script_directory  =  os.path.dirname(os.path.abspath( __file__ ))
+    script_filename = __program__
+    description = """
+    Running: {} v{} via Python v{} | {}""".format(__program__, __version__, sys.version.split(" ")[0], sys.executable)
+    usage = "{} {{init,worker,merge,run}} -q <queue_directory> ...".format(__program__)
+    epilog = "PyKOfamSearch"
+
+    # Parser
+    parser = argparse.ArgumentParser(description=description, usage=usage, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-v', '--version', action='version', version=__version__)
+    parser.add_argument("mode", type=str, choices=["init", "worker", "merge", "run"], help="init: partition the database into shards\nworker: claim and run shards (run one per process or node)\nmerge: merge shard results\nrun: init, run --n_workers local workers, and merge")
+    parser.add_argument("-q", "--queue_directory", type=str, required=True, help="path/to/queue_directory/ on a filesystem shared by all workers")
+
+    parser_init = parser.add_argument_group('Init arguments')
+    parser_init.add_argument("-n", "--n_shards", type=int, default=8, help="Number of shards balanced by HMM length [Default: 8]")
+    parser_init.add_argument("-i","--proteins", type=str, help = "path/to/proteins.fasta")
+    parser_init.add_argument("-d", "--database_directory", type=str, help="path/to/kofam_database_directory/ cannot be used with -b/-serialized_database")
+    parser_init.add_argument("-b", "--serialized_database", type=str, help="path/to/database.pkl[.gz] or path/to/database.kofamdb (indexed) cannot be used with -d/--database_directory")
+    parser_init.add_argument("-s", "--subset", type=str, help = "path/to/identifiers.list used to subset the database before sharding")
+    parser_init.add_argument("-e","--evalue", type=float, default=0.1,  help = "E-value threshold [Default: 0.1]")
+    parser_init.add_argument("-a", "--all_hits", action="store_true", help="Return all hits and do not use curated threshold")
+    parser_init.add_argument("-t","--threshold_scale", type=float, default=1.0, help = "Multiplier for the curated thresholds [Default: 1.0]")
+    parser_init.add_argument("--profile_cache_directory", type=str, help="path/to/profile_cache/ of pre-optimized (hmmpress) profiles")
+
+    parser_worker = parser.add_argument_group('Worker arguments')
+    parser_worker.add_argument("-p","--n_jobs", type=int, default=1,  help = "Number of threads per worker [Default: 1]")
+    parser_worker.add_argument("-w","--n_workers", type=int, default=1,  help = "Number of local worker processes for `run` [Default: 1]")
+    parser_worker.add_argument("--stale_claim_timeout", type=float, default=STALE_CLAIM_TIMEOUT,  help = "Seconds without a heartbeat before the claim of a shard is stale and the shard is run by another worker.  Claims of dead processes on the same host are reclaimed immediately [Default: {}]".format(STALE_CLAIM_TIMEOUT))
+
+    parser_merge = parser.add_argument_group('Merge arguments')
+    parser_merge.add_argument("-o","--output", type=str, default="stdout", help = "path/to/output.tsv [Default: stdout]")
+    parser_merge.add_argument("--no_header", action="store_true", help = "No header")
+
+    opts = parser.parse_args(args)
+    opts.script_directory  = script_directory
+    opts.script_filename = script_filename
+
+    if opts.mode in {"init", "run"}:
+        if not opts.proteins:
+            raise ValueError("-i/--proteins is required for `{}`".format(opts.mode))
+        if not any([opts.serialized_database, opts.database_directory]):
+            raise ValueError("Must either provide -d/--database_directory or -b/--serialized_database")
+        # Arguments are stored as absolute paths so workers can run from any directory
+        pykofamsearch_arguments = ["--proteins", os.path.abspath(opts.proteins), "--evalue", str(opts.evalue), "--threshold_scale", str(opts.threshold_scale)]
+        if opts.serialized_database:
+            pykofamsearch_arguments += ["--serialized_database", os.path.abspath(opts.serialized_database)]
+        else:
+            pykofamsearch_arguments += ["--database_directory", os.path.abspath(opts.database_directory)]
+        if opts.profile_cache_directory:
+            pykofamsearch_arguments += ["--profile_cache_directory", os.path.abspath(opts.profile_cache_directory)]
+        if opts.all_hits:
+            pykofamsearch_arguments += ["--all_hits"]
+        shards = initialize_queue(
+            opts.queue_directory,
+            n_shards=opts.n_shards,
+            pykofamsearch_arguments=pykofamsearch_arguments,
+            database_directory=opts.database_directory,
+            serialized_database=opts.serialized_database,
+            subset=opts.subset,
+        )
+        print("Initialized {} shards in {}".format(len(shards), opts.queue_directory), file=sys.stderr)
+
+    if opts.mode == "worker":
+        run_worker(opts.queue_directory, n_jobs=opts.n_jobs, stale_claim_timeout=opts.stale_claim_timeout)
+
+    if opts.mode == "run":
+        cmd = [sys.executable, "-m", "pykofamsearch.shard_pykofamsearch", "worker", "--queue_directory", opts.queue_directory, "--n_jobs", str(opts.n_jobs), "--stale_claim_timeout", str(opts.stale_claim_timeout)]
+        processes = [subprocess.Popen(cmd) for i in range(opts.n_workers)]
+        returncodes = [process.wait() for process in processes]
+        if any(returncodes):
+            raise RuntimeError("Workers failed with return codes: {}".format(returncodes))
+
+    if opts.mode in {"merge", "run"}:
+        if opts.output == "stdout":
+            f_output = sys.stdout
+        else:
+            f_output = open(opts.output, "w")
+        merge_shards(opts.queue_directory, f_output, no_header=opts.no_header)
+        if f_output != sys.stdout:
+            f_output.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
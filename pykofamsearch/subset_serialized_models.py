@@ -1,9 +1,11 @@
 #!/usr/bin/env python
-import sys, os, glob, gzip, warnings, argparse, pickle
+import sys, os, glob, warnings, argparse, pickle
 from collections import defaultdict
 from tqdm import tqdm
 from pyhmmer.plan7 import HMMFile
 from . import __version__
+from .database import is_indexed_database, IndexedDatabase, IndexedDatabaseWriter, load_serialized_database
+from .compression import open_file
 
 __program__ = os.path.split(sys.argv[0])[-1]
 
@@ -27,8 +29,8 @@ def main(args=None):
     # Pipeline
     parser_database = parser.add_argument_group('Database arguments')
     parser_database.add_argument("-i", "--identifiers", default="stdin", type=str, help="path/to/identifiers.list where HMM identifiers are on a separate line")
-    parser_database.add_argument("-b", "--serialized_database", required=True, type=str, help="path/to/database.pkl[.gz] will be tuple where first item is threshold dictionary and second item is dictionary of HMM models")
-    parser_database.add_argument("-s", "--subset_serialized_database", required=True, type=str, help="path/to/subset-database.pkl[.gz] will be tuple where first item is threshold dictionary and second item is dictionary of HMM models")
+    parser_database.add_argument("-b", "--serialized_database", required=True, type=str, help="path/to/database.pkl[.gz] will be tuple where first item is dictionary of KOfam metadata (thresholds, score types, definitions, and enzyme commissions) and second item is dictionary of HMM models.  Indexed databases (path/to/database.kofamdb) are also supported")
+    parser_database.add_argument("-s", "--subset_serialized_database", required=True, type=str, help="path/to/subset-database.pkl[.gz] will be tuple where first item is dictionary of KOfam metadata (thresholds, score types, definitions, and enzyme commissions) and second item is dictionary of HMM models.  Written in the same format as --serialized_database")
 
     opts = parser.parse_args()
     opts.script_directory  = script_directory
@@ -39,10 +41,7 @@ def main(args=None):
     if opts.identifiers == "stdin":
         f_identifiers = sys.stdin
     else:
-        if opts.identifiers.endswith(".gz"):
-            f_identifiers = gzip.open(opts.identifiers, "rt")
-        else:
-            f_identifiers = open(opts.identifiers, "r")
+        f_identifiers = open_file(opts.identifiers, "rt")
             
     identifiers = set()
     for line in f_identifiers:
@@ -55,21 +54,26 @@ def main(args=None):
     
     # ======
     # Read serialized database
-    if opts.serialized_database.endswith((".gz", ".pgz")):
-        f_database = gzip.open(opts.serialized_database, "rb")
+    indexed = is_indexed_database(opts.serialized_database)
+    if indexed:
+        name_to_hmm = IndexedDatabase(opts.serialized_database)
+        ko_to_data = name_to_hmm.ko_to_data
     else:
-        f_database = open(opts.serialized_database, "rb")
-    ko_to_data, name_to_hmm = pickle.load(f_database)
+        ko_to_data, name_to_hmm = load_serialized_database(opts.serialized_database)
     
     ko_to_data__subset = dict()
     name_to_hmm__subset = dict()
     missing_kos = set()
     for id_ko in identifiers:
-        try:
+        if (id_ko in ko_to_data) and (id_ko in name_to_hmm):
             ko_to_data__subset[id_ko] = ko_to_data[id_ko]
-            name_to_hmm__subset[id_ko] = name_to_hmm[id_ko]
-        except KeyError:
+            # Indexed databases are subset by copying the binary HMMs without decoding them
+            name_to_hmm__subset[id_ko] = name_to_hmm.get_blob(id_ko) if indexed else name_to_hmm[id_ko]
+        else:
             missing_kos.add(id_ko)
+    # Keep the database order
+    ko_to_data__subset = ko_to_data.subset(ko_to_data__subset)
+    name_to_hmm__subset = {id_ko:name_to_hmm__subset[id_ko] for id_ko in ko_to_data__subset}
 
     # Verbosity
     # =========
@@ -95,12 +99,15 @@ def main(args=None):
         raise KeyError("No identifiers from were in serialized database")
         
     # Write serialized database
-    if opts.subset_serialized_database.endswith((".gz", ".pgz")):
-        f_out = gzip.open(opts.subset_serialized_database, "wb")
+    if indexed:
+        with IndexedDatabaseWriter(opts.subset_serialized_database, ko_to_data__subset, metadata=name_to_hmm.metadata) as writer:
+            for id_ko in ko_to_data:
+                if id_ko in name_to_hmm__subset:
+                    writer.add_blob(id_ko, name_to_hmm__subset[id_ko])
+        name_to_hmm.close()
     else:
-        f_out = open(opts.subset_serialized_database, "wb")
-    pickle.dump((ko_to_data__subset, name_to_hmm__subset), f_out)
-    f_out.close()
+        with open_file(opts.subset_serialized_database, "wb") as f_out:
+            pickle.dump((ko_to_data__subset.to_dict(), name_to_hmm__subset), f_out)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
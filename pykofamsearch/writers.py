@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+import sys, heapq
+from .compression import open_file
+
+COLUMNS = ["id_protein", "id_ko", "threshold", "score", "e-value", "definition", "enzyme_commission"]
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("Parquet and Arrow formats require `pyarrow`.  Please install with `pip install pyarrow`")
+    return pyarrow
+
+def get_arrow_schema():
+    pa = import_pyarrow()
+    return pa.schema([
+        ("id_protein", pa.string()),
+        ("id_ko", pa.string()),
+        ("threshold", pa.float64()),
+        ("score", pa.float64()),
+        ("e-value", pa.float64()),
+        ("definition", pa.string()),
+        ("enzyme_commission", pa.list_(pa.string())),
+    ])
+
+class HitWriter(object):
+    """
+    Collect hits into columnar buffers and write them in bulk as tsv, parquet, or arrow (IPC file)
+
+    Usage:
+        writer = HitWriter("output.parquet", format="parquet")
+        writer.write_columns(id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions)
+        writer.close()
+    """
+    def __init__(self, output:str="stdout", format:str="tsv", header:bool=True, buffer_size:int=100000, threads:int=1):
+        if format not in {"tsv", "parquet", "arrow"}:
+            raise ValueError("format must be either `tsv`, `parquet`, or `arrow`")
+        self.output = output
+        self.format = format
+        self.header = header
+        self.buffer_size = buffer_size
+        self.number_of_hits = 0
+        self.columns = [list() for column in COLUMNS]
+        self._writer = None
+
+        if format == "tsv":
+            if output == "stdout":
+                self._f = sys.stdout
+            else:
+                # .gz (BGZF) and .zst outputs are compressed on threads
+                self._f = open_file(output, "wt", threads=threads)
+            if header:
+                self._f.write("\t".join(COLUMNS) + "\n")
+        else:
+            if output.endswith((".gz", ".bgz", ".zst")):
+                raise ValueError("{} output is compressed internally and cannot end with .gz, .bgz, or .zst".format(format))
+            pa = import_pyarrow()
+            self.schema = get_arrow_schema()
+            self._f = sys.stdout.buffer if output == "stdout" else open(output, "wb")
+            if format == "parquet":
+                self._writer = pa.parquet.ParquetWriter(self._f, self.schema)
+            else:
+                self._writer = pa.ipc.new_file(self._f, self.schema)
+
+    def write_columns(self, id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions):
+        for buffer, values in zip(self.columns, [id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions]):
+            buffer.extend(values)
+        if len(self.columns[0]) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions = self.columns
+        if id_proteins:
+            if self.format == "tsv":
+                thresholds = ["" if threshold is None else str(threshold) for threshold in thresholds]
+                scores = map("{:0.3f}".format, scores)
+                evalues = map("{:0.5e}".format, evalues)
+                definitions = map(str, definitions)
+                enzyme_commissions = map(str, enzyme_commissions)
+                lines = map("\t".join, zip(id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions))
+                self._f.write("\n".join(lines) + "\n")
+            else:
+                pa = import_pyarrow()
+                enzyme_commissions = [sorted(ecs) if ecs else [] for ecs in enzyme_commissions]
+                batch = pa.record_batch([id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions], schema=self.schema)
+                if self.format == "parquet":
+                    self._writer.write_table(pa.Table.from_batches([batch]))
+                else:
+                    self._writer.write_batch(batch)
+            self.number_of_hits += len(id_proteins)
+            self.columns = [list() for column in COLUMNS]
+        self._f.flush()
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+        if self._f not in {sys.stdout, sys.stdout.buffer}:
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TopHitsPerProteinWriter(object):
+    """
+    Keep only the best max_hits_per_protein hits of each protein and write them to a HitWriter on `flush` (e.g.,
+    after each block because every protein is in a single block) in the order they were received.  Hits are kept in
+    a bounded heap per protein so memory scales with proteins x max_hits_per_protein instead of proteins x KOfams.
+
+    Hits are ranked by `score` or by `threshold_ratio` (score / curated threshold with hits of KOfams without a
+    threshold ranked last) and ties are broken by score and then by the first hit received which is how
+    `reformat_pykofamsearch --best_hits_only` selects the best hit.
+
+    Usage:
+        writer = TopHitsPerProteinWriter(HitWriter("output.tsv"), max_hits_per_protein=5)
+        writer.write_columns(id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions)
+        writer.close()
+    """
+    def __init__(self, writer, max_hits_per_protein:int, ranking:str="score"):
+        if max_hits_per_protein < 1:
+            raise ValueError("max_hits_per_protein must be at least 1")
+        if ranking not in {"score", "threshold_ratio"}:
+            raise ValueError("ranking must be either `score` or `threshold_ratio`")
+        self.writer = writer
+        self.max_hits_per_protein = max_hits_per_protein
+        self.ranking = ranking
+        self.protein_to_heap = dict()
+        self._index = 0
+
+    def write_columns(self, id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions):
+        for row in zip(id_proteins, id_kos, thresholds, scores, evalues, definitions, enzyme_commissions):
+            id_protein, id_ko, threshold, score, evalue, definition, enzyme_commission = row
+            if self.ranking == "score":
+                rank = (score,)
+            else:
+                rank = (score/threshold if threshold else float("-inf"), score)
+            # Earlier hits win ties and the index keeps the output in the order the hits were received
+            item = (rank, -self._index, row)
+            self._index += 1
+            heap = self.protein_to_heap.get(id_protein)
+            if heap is None:
+                heap = self.protein_to_heap[id_protein] = list()
+            if len(heap) < self.max_hits_per_protein:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+    def flush(self):
+        if self.protein_to_heap:
+            items = sorted((item for heap in self.protein_to_heap.values() for item in heap), key=lambda item: -item[1])
+            self.protein_to_heap = dict()
+            if items:
+                self.writer.write_columns(*map(list, zip(*(item[2] for item in items))))
+        self.writer.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_columnar_hits(filepath:str):
+    """
+    Read a parquet or arrow output from pykofamsearch as a pyarrow Table
+    """
+    pa = import_pyarrow()
+    if filepath.endswith(".parquet"):
+        return pa.parquet.read_table(filepath)
+    return pa.ipc.open_file(pa.memory_map(filepath, "r")).read_all()
@@ -23,6 +23,9 @@ setup(name='pykofamsearch',
             'reformat_pykofamsearch=pykofamsearch.reformat_pykofamsearch:main',  # Executes reformat_pykofamsearch.main()
             'serialize_kofam_models=pykofamsearch.serialize_kofam_models:main',  # Executes serialize_kofam_models.main()
             'subset_serialized_models=pykofamsearch.subset_serialized_models:main',  # Executes subset_serialized_models.main()
+            'serve_pykofamsearch=pykofamsearch.serve_pykofamsearch:main',  # Executes serve_pykofamsearch.main()
+            'shard_pykofamsearch=pykofamsearch.shard_pykofamsearch:main',  # Executes shard_pykofamsearch.main()
+            'benchmark_pykofamsearch=pykofamsearch.benchmark_pykofamsearch:main',  # Executes benchmark_pykofamsearch.main()
             # 'reformat_enzymes=pykofamsearch.reformat_enzymes:main',  # Executes reformat_enzymes.main()
         ],
     },
@@ -1,5 +1,8 @@
 # PyKofamSearch
 # =============
+# Machine-readable benchmark (JSON) across thread counts
+benchmark_pykofamsearch -b ~/Databases/KOFAM/database.pkl.gz -i data/test.faa -n 1000,10000 -p 1,12 -o benchmark.json
+
 # Full database
 echo "PyKofamSearch | Full database"
 time pykofamsearch.py -i data/test.faa.gz  -o pykofamsearch.cpu_12.tsv -b ~/Databases/KOFAM/database.pkl.gz -p=12
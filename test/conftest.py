@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import os, sys, tarfile, subprocess
+import pytest
+from pyhmmer.easel import SequenceFile, Alphabet
+from pyhmmer.plan7 import Builder, Background
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(TEST_DIRECTORY)
+PROTEINS = os.path.join(TEST_DIRECTORY, "test.faa")
+EXPECTED_DIRECTORY = os.path.join(TEST_DIRECTORY, "expected")
+
+# Synthetic KOfams built from single sequences of test.faa (see build_kofam_fixture)
+NUMBER_OF_KOFAMS = 24
+SEQUENCE_STEP = 197
+THRESHOLDS = [40.0, 80.0, 150.0, 300.0, 600.0]
+KO_LIST_FIELDS = ["knum", "threshold", "score_type", "profile_type", "F-measure", "nseq", "nseq_used", "alen", "mlen", "eff_nseq", "re/pos", "definition"]
+
+def build_kofam_fixture(directory:str):
+    """
+    Write a ko_list, a profiles directory, and profiles.tar.gz of KOfams built from every SEQUENCE_STEP sequence of test.faa.
+    Score types cycle through domain and full, thresholds cycle through THRESHOLDS, and every 8th KOfam has no threshold.
+    """
+    alphabet = Alphabet.amino()
+    background = Background(alphabet)
+    builder = Builder(alphabet)
+    with SequenceFile(PROTEINS, digital=True, alphabet=alphabet) as f:
+        sequences = list(f)
+    profiles_directory = os.path.join(directory, "profiles")
+    os.makedirs(profiles_directory, exist_ok=True)
+    with open(os.path.join(directory, "ko_list"), "w") as f_ko_list:
+        print(*KO_LIST_FIELDS, sep="\t", file=f_ko_list)
+        for i in range(NUMBER_OF_KOFAMS):
+            id_ko = "K{:05d}".format(i + 1)
+            sequence = sequences[i*SEQUENCE_STEP].copy()
+            sequence.name = id_ko.encode()
+            hmm, _, _ = builder.build(sequence, background)
+            with open(os.path.join(profiles_directory, "{}.hmm".format(id_ko)), "wb") as f_hmm:
+                hmm.write(f_hmm)
+            if i % 8 == 7:
+                threshold, score_type = "-", "-"
+            else:
+                threshold = "{:0.2f}".format(THRESHOLDS[i % len(THRESHOLDS)])
+                score_type = "domain" if i % 3 == 0 else "full"
+            definition = "synthetic protein {}".format(i)
+            if i % 2 == 0:
+                definition += " [EC:1.1.1.{}]".format(i)
+            print(id_ko, threshold, score_type, "all", "0.9", "1", "1", len(sequence), hmm.M, "1.0", "0.5", definition, sep="\t", file=f_ko_list)
+    with tarfile.open(os.path.join(directory, "profiles.tar.gz"), "w:gz") as tar:
+        tar.add(profiles_directory, arcname="profiles")
+    return directory
+
+def run_module(module:str, *args, check:bool=True, **kwargs):
+    """
+    Run a command line module of the package (e.g., `pykofamsearch`) from the repository
+    """
+    return subprocess.run([sys.executable, "-m", "pykofamsearch.{}".format(module), *map(str, args)], cwd=REPOSITORY_DIRECTORY, check=check, capture_output=True, **kwargs)
+
+def read_rows(filepath:str, sort:bool=False):
+    """
+    Read the lines of an output table (header first)
+    """
+    with open(filepath, "r") as f:
+        header, *rows = f.read().splitlines()
+    if sort:
+        rows = sorted(rows)
+    return [header] + rows
+
+@pytest.fixture(scope="session")
+def kofam_directory(tmp_path_factory):
+    return build_kofam_fixture(str(tmp_path_factory.mktemp("kofams")))
+
+@pytest.fixture(scope="session")
+def serialized_database(kofam_directory):
+    filepath = os.path.join(kofam_directory, "database.pkl.gz")
+    run_module("serialize_kofam_models", "-k", os.path.join(kofam_directory, "ko_list"), "-d", os.path.join(kofam_directory, "profiles.tar.gz"), "-b", filepath)
+    return filepath
+
+@pytest.fixture(scope="session")
+def indexed_database(kofam_directory):
+    filepath = os.path.join(kofam_directory, "database.kofamdb")
+    run_module("serialize_kofam_models", "-k", os.path.join(kofam_directory, "ko_list"), "-d", os.path.join(kofam_directory, "profiles"), "-b", filepath, "-f", "indexed")
+    return filepath
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import os, json
+import pytest
+from pykofamsearch.checkpoint import SearchCheckpoint, HitRecorder, get_file_signature
+from conftest import PROTEINS, EXPECTED_DIRECTORY, run_module, read_rows
+
+ROWS = [[None, ["p1", "p2"], [100.0, 100.0], [150.25, 0.1 + 0.2], [1e-50, 2.5e-10]]]
+
+def test_get_file_signature(tmp_path):
+    filepath = tmp_path/"proteins.faa"
+    filepath.write_text(">p1\nMKV\n")
+    signature = get_file_signature(str(filepath))
+    assert signature[:2] == [str(filepath), 8]
+    filepath.write_text(">p1\nMKVL\n")
+    assert get_file_signature(str(filepath)) != signature
+    # stdin and missing files are recorded by name
+    assert get_file_signature("stdin") == "stdin"
+    assert get_file_signature(None) is None
+
+def test_search_checkpoint(tmp_path):
+    directory = str(tmp_path/"checkpoint")
+    checkpoint = SearchCheckpoint(directory, parameters={"evalue":10.0, "proteins":["proteins.faa", 8, 1]})
+    assert checkpoint.load_block(1) == dict()
+    checkpoint.open_block(1)
+    checkpoint.record("K00001", ROWS)
+    checkpoint.record("K00002", [])
+    checkpoint.close_block()
+    # Floats are replayed exactly
+    checkpoint = SearchCheckpoint(directory, parameters={"evalue":10.0, "proteins":("proteins.faa", 8, 1)})
+    assert checkpoint.load_block(1) == {"K00001":ROWS, "K00002":[]}
+    assert checkpoint.load_block(2) == dict()
+
+def test_partial_line(tmp_path):
+    # A partial last line (interrupted write) is removed so new records start on a new line
+    directory = str(tmp_path/"checkpoint")
+    checkpoint = SearchCheckpoint(directory, parameters=dict())
+    checkpoint.open_block(1)
+    checkpoint.record("K00001", ROWS)
+    checkpoint.close_block()
+    with open(checkpoint.get_block_filepath(1), "a") as f:
+        f.write('["K00002", [[null, ["p')
+    assert list(checkpoint.load_block(1)) == ["K00001"]
+    checkpoint.open_block(1)
+    checkpoint.record("K00003", [])
+    checkpoint.close_block()
+    assert list(checkpoint.load_block(1)) == ["K00001", "K00003"]
+
+def test_changed_parameters(tmp_path):
+    directory = str(tmp_path/"checkpoint")
+    SearchCheckpoint(directory, parameters={"evalue":10.0, "threshold_scale":1.0})
+    with pytest.raises(ValueError, match="threshold_scale"):
+        SearchCheckpoint(directory, parameters={"evalue":10.0, "threshold_scale":0.5})
+
+def test_hit_recorder():
+    class RowCollector(object):
+        def __init__(self):
+            self.rows = list()
+        def write_columns(self, *columns):
+            self.rows.extend(zip(*columns))
+    collector = RowCollector()
+    recorder = HitRecorder(collector, sample="a")
+    recorder.write_columns(["p1"], ["K00001"], [100.0], [150.25], [1e-50], ["synthetic protein 0"], [None])
+    assert collector.rows == [("p1", "K00001", 100.0, 150.25, 1e-50, "synthetic protein 0", None)]
+    assert recorder.rows == [["a", ["p1"], [100.0], [150.25], [1e-50]]]
+
+def test_resume(indexed_database, tmp_path):
+    # An interrupted run (journal of some KOfams and a partial line) resumes with the same output
+    checkpoint_directory = tmp_path/"checkpoint"
+    arguments = ["-b", indexed_database, "-i", PROTEINS, "-o", tmp_path/"output.tsv", "--checkpoint_directory", checkpoint_directory]
+    run_module("pykofamsearch", *arguments)
+    filepath = checkpoint_directory/"block_1.jsonl"
+    lines = filepath.read_text().splitlines(keepends=True)
+    assert len(lines) > 4
+    filepath.write_text("".join(lines[:len(lines)//2]) + lines[len(lines)//2][:10])
+    os.remove(tmp_path/"output.tsv")
+    run_module("pykofamsearch", *arguments)
+    assert read_rows(tmp_path/"output.tsv") == read_rows(os.path.join(EXPECTED_DIRECTORY, "test.kofams.tsv"))
+    # Only the remaining KOfams were searched and journaled
+    assert sorted(json.loads(line)[0] for line in filepath.read_text().splitlines()) == sorted(json.loads(line)[0] for line in lines)
+    # Options that change the output cannot resume the checkpoint
+    process = run_module("pykofamsearch", *arguments, "-t", "0.5", check=False)
+    assert process.returncode != 0
+    assert b"different options or inputs" in process.stderr
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import io, gzip
+import pytest
+from pykofamsearch.compression import (
+    open_file,
+    get_compression,
+    detect_compression,
+    get_bgzf_index,
+    BgzfReader,
+    BGZF_BLOCK_SIZE,
+    BGZF_EOF,
+)
+
+# Several BGZF blocks of text
+DATA = "".join(">protein_{}\nMKVLAAGHSTPCEDNQKRH\n".format(i) for i in range(10000))
+
+@pytest.mark.parametrize("filename,compression", [("data.txt", None), ("data.txt.gz", "bgzf"), ("data.txt.bgz", "bgzf")])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_round_trip(tmp_path, filename, compression, threads):
+    filepath = str(tmp_path/filename)
+    with open_file(filepath, "wt", threads=threads) as f:
+        f.write(DATA)
+    assert get_compression(filepath, "wb") == compression
+    assert get_compression(filepath, "rb") == compression
+    with open_file(filepath, "rt", threads=threads) as f:
+        assert f.read() == DATA
+
+def test_bgzf(tmp_path):
+    # BGZF files are valid gzip files ending with the empty EOF block
+    filepath = str(tmp_path/"data.txt.gz")
+    with open_file(filepath, "wb") as f:
+        f.write(DATA.encode())
+    with gzip.open(filepath, "rt") as f:
+        assert f.read() == DATA
+    with open(filepath, "rb") as f:
+        assert f.read().endswith(BGZF_EOF)
+
+def test_gzip(tmp_path):
+    filepath = str(tmp_path/"data.txt.gz")
+    with gzip.open(filepath, "wt") as f:
+        f.write(DATA)
+    assert get_compression(filepath) == "gzip"
+    with open_file(filepath, "rt") as f:
+        assert f.read() == DATA
+
+def test_file_object(tmp_path):
+    # Pipes (e.g., sys.stdin.buffer) are read without seeking
+    filepath = str(tmp_path/"data.txt.gz")
+    with open_file(filepath, "wb") as f:
+        f.write(DATA.encode())
+    with open(filepath, "rb") as f_raw:
+        with open_file(io.BufferedReader(f_raw), "rt") as f:
+            assert f.read() == DATA
+
+def test_get_bgzf_index(tmp_path):
+    filepath = str(tmp_path/"data.txt.gz")
+    data = DATA.encode()
+    with open_file(filepath, "wb") as f:
+        f.write(data)
+    index = get_bgzf_index(filepath)
+    assert [uncompressed_offset for _, uncompressed_offset in index] == list(range(0, len(data), BGZF_BLOCK_SIZE))
+    # Blocks are decompressed independently from any compressed offset
+    compressed_offset, uncompressed_offset = index[2]
+    with io.BufferedReader(BgzfReader(filepath, offset=compressed_offset)) as f:
+        assert f.read() == data[uncompressed_offset:]
+
+def test_detect_compression():
+    assert detect_compression(b">protein_1\nMKV") is None
+    assert detect_compression(gzip.compress(b"MKV")) == "gzip"
+    assert detect_compression(BGZF_EOF) == "bgzf"
+    assert detect_compression(bytes.fromhex("28b52ffd") + b"\x00" * 14) == "zstd"
+
+def test_invalid_mode(tmp_path):
+    with pytest.raises(ValueError):
+        open_file(str(tmp_path/"data.txt"), "ab")
+
+def test_zstd(tmp_path):
+    pytest.importorskip("zstandard")
+    filepath = str(tmp_path/"data.txt.zst")
+    with open_file(filepath, "wt", threads=2) as f:
+        f.write(DATA)
+    assert get_compression(filepath) == "zstd"
+    with open_file(filepath, "rt") as f:
+        assert f.read() == DATA
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import os, gzip, pickle
+import pytest
+from pyhmmer.plan7 import HMMFile
+from pykofamsearch.database import (
+    IndexedDatabaseWriter,
+    IndexedDatabase,
+    is_indexed_database,
+    load_serialized_database,
+    get_model_checksums,
+    get_model_lengths,
+    get_database_version,
+    serialize_hmm,
+    get_hmm_checksum,
+)
+from pykofamsearch.metadata import KOfamMetadata, parse_ko_list
+
+@pytest.fixture
+def ko_to_data(kofam_directory):
+    return parse_ko_list(os.path.join(kofam_directory, "ko_list"))
+
+@pytest.fixture
+def name_to_hmm(kofam_directory, ko_to_data):
+    name_to_hmm = dict()
+    for id_ko in ko_to_data:
+        with HMMFile(os.path.join(kofam_directory, "profiles", "{}.hmm".format(id_ko))) as f:
+            name_to_hmm[id_ko] = f.read()
+    return name_to_hmm
+
+def test_indexed_database(tmp_path, ko_to_data, name_to_hmm):
+    filepath = str(tmp_path/"database.kofamdb")
+    # Models are indexed in the order of ko_to_data regardless of the order they are written
+    with IndexedDatabaseWriter(filepath, ko_to_data, metadata={"version":"test"}) as writer:
+        for id_ko in reversed(list(name_to_hmm)):
+            writer.add_hmm(id_ko, name_to_hmm[id_ko])
+    assert is_indexed_database(filepath)
+
+    database = IndexedDatabase(filepath)
+    assert list(database) == list(name_to_hmm)
+    assert database.metadata["version"] == "test"
+    # Metadata is read without decoding HMMs
+    assert get_model_lengths(database.ko_to_data, database) == {id_ko:hmm.M for id_ko, hmm in name_to_hmm.items()}
+    assert get_model_checksums(database.ko_to_data, database) == {id_ko:get_hmm_checksum(hmm) for id_ko, hmm in name_to_hmm.items()}
+    assert len(database._hmms) == 0
+    assert serialize_hmm(database["K00002"]) == serialize_hmm(name_to_hmm["K00002"])
+    assert list(database._hmms) == ["K00002"]
+    # The database version only depends on the models
+    assert database.metadata["checksum"] == get_database_version(database.ko_to_data, database) == get_database_version(KOfamMetadata.from_dict({id_ko:dict() for id_ko in name_to_hmm}), name_to_hmm)
+    database.close()
+
+def test_incomplete_indexed_database(tmp_path, ko_to_data, name_to_hmm):
+    filepath = str(tmp_path/"database.kofamdb")
+    writer = IndexedDatabaseWriter(filepath, ko_to_data, checkpoint=True)
+    writer.add_hmm("K00001", name_to_hmm["K00001"])
+    writer.abort()
+    with pytest.raises(ValueError, match="Incomplete"):
+        IndexedDatabase(filepath)
+
+def test_checkpoint_resume(tmp_path, ko_to_data, name_to_hmm):
+    filepath = str(tmp_path/"database.kofamdb")
+    inputs = {"ko_list":{"size":1, "checksum":"a"}}
+    writer = IndexedDatabaseWriter(filepath, ko_to_data, checkpoint=True, inputs=inputs)
+    for id_ko in ["K00001", "K00002"]:
+        writer.add_hmm(id_ko, name_to_hmm[id_ko])
+    writer.abort()
+    # A partial journal line (interrupted while writing) is ignored
+    with open(filepath + ".checkpoint", "a") as f:
+        f.write("K00003\t10")
+
+    with pytest.raises(ValueError, match="Inputs changed"):
+        IndexedDatabaseWriter(filepath, ko_to_data, checkpoint=True, inputs={"ko_list":{"size":2, "checksum":"b"}})
+
+    with IndexedDatabaseWriter(filepath, ko_to_data, checkpoint=True, inputs=inputs) as writer:
+        assert list(writer.models) == ["K00001", "K00002"]
+        for id_ko, hmm in name_to_hmm.items():
+            if id_ko not in writer.models:
+                writer.add_hmm(id_ko, hmm)
+    assert not os.path.exists(filepath + ".checkpoint")
+    database = IndexedDatabase(filepath)
+    assert list(database) == list(name_to_hmm)
+    assert all(serialize_hmm(database[id_ko]) == serialize_hmm(hmm) for id_ko, hmm in name_to_hmm.items())
+    assert all(database.ko_to_data[id_ko]["model_length"] == hmm.M for id_ko, hmm in name_to_hmm.items())
+
+def test_load_serialized_database(tmp_path, ko_to_data, name_to_hmm, serialized_database):
+    # Pickle databases store the metadata as a dictionary of dictionaries so earlier versions can load them
+    with gzip.open(serialized_database, "rb") as f:
+        metadata, models = pickle.load(f)
+    assert isinstance(metadata, dict)
+    assert metadata["K00002"]["threshold"] == ko_to_data["K00002"]["threshold"]
+
+    loaded_ko_to_data, loaded_name_to_hmm = load_serialized_database(serialized_database)
+    assert isinstance(loaded_ko_to_data, KOfamMetadata)
+    assert list(loaded_name_to_hmm) == list(name_to_hmm)
+
+    filepath = tmp_path/"invalid.pkl"
+    with open(filepath, "wb") as f:
+        pickle.dump(name_to_hmm, f)
+    with pytest.raises(ValueError, match="Unrecognized serialized database format"):
+        load_serialized_database(str(filepath))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import os
+import numpy as np
+import pytest
+import pyhmmer
+from pyhmmer.easel import SequenceFile, Alphabet
+from pyhmmer.plan7 import HMMFile
+from pykofamsearch.metadata import parse_ko_list
+from pykofamsearch.prefilter import (
+    get_kmers,
+    get_consensus_seeds,
+    PrefilterIndex,
+    load_prefilter_index,
+    iterate_prefiltered_hits,
+    TEXT_REDUCTION_TABLE,
+    REDUCED_ALPHABET,
+)
+from conftest import PROTEINS, SEQUENCE_STEP
+
+@pytest.fixture(scope="module")
+def name_to_hmm(kofam_directory):
+    name_to_hmm = dict()
+    for id_ko in parse_ko_list(os.path.join(kofam_directory, "ko_list")):
+        with HMMFile(os.path.join(kofam_directory, "profiles", "{}.hmm".format(id_ko))) as f:
+            name_to_hmm[id_ko] = f.read()
+    return name_to_hmm
+
+@pytest.fixture(scope="module")
+def proteins():
+    with SequenceFile(PROTEINS, digital=True, alphabet=Alphabet.amino()) as f:
+        return f.read_block()
+
+def reduce(sequence:str):
+    return TEXT_REDUCTION_TABLE[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+
+def test_get_kmers():
+    # Conservative substitutions (L/I, K/R) have the same reduced k-mers
+    assert np.array_equal(get_kmers(reduce("MKLVAGHST")), get_kmers(reduce("mrivaghts")))
+    assert len(get_kmers(reduce("MKLVAGHST"))) == 4
+    # k-mers with degenerate residues are skipped
+    assert len(get_kmers(reduce("MKLVAXGHSTPC"))) == 1
+    assert len(get_kmers(reduce("MKLVA"))) == 0
+    assert get_kmers(reduce("HHHHHHHH"), k=6).tolist() == [int("9"*6, len(REDUCED_ALPHABET))]
+
+def test_get_consensus_seeds(name_to_hmm):
+    hmm = name_to_hmm["K00001"]
+    assert np.array_equal(get_consensus_seeds(hmm), get_kmers(reduce(hmm.consensus)))
+    assert len(get_consensus_seeds(hmm)) > 0
+
+def test_candidates(name_to_hmm, proteins):
+    index = load_prefilter_index({id_ko:dict() for id_ko in name_to_hmm}, name_to_hmm)
+    candidates = index.get_candidates(proteins, min_seeds=1)
+    # Each KOfam was built from a single sequence of test.faa which is always a candidate
+    for i, id_ko in enumerate(name_to_hmm):
+        assert i*SEQUENCE_STEP in candidates[id_ko]
+    # Fewer pairs are searched with fewer shared seeds
+    strict_candidates = index.get_candidates(proteins, min_seeds=3)
+    assert all(set(strict_candidates[id_ko]) <= set(candidates[id_ko]) for id_ko in strict_candidates)
+    assert sum(map(len, strict_candidates.values())) < sum(map(len, candidates.values())) < len(name_to_hmm) * len(proteins)
+
+def test_exhaustive_candidates(name_to_hmm, proteins):
+    # KOfams without seeds are searched against every sequence
+    index = PrefilterIndex({"K00001":get_consensus_seeds(name_to_hmm["K00001"]), "K00002":None})
+    assert index.exhaustive == ["K00002"]
+    candidates = index.get_candidates(proteins)
+    assert candidates["K00002"].tolist() == list(range(len(proteins)))
+    assert 0 in candidates["K00001"]
+    candidates = index.get_candidates([])
+    assert list(candidates) == ["K00002"] and len(candidates["K00002"]) == 0
+
+def test_iterate_prefiltered_hits(name_to_hmm, proteins):
+    queries = list(name_to_hmm.values())[:6]
+    with pytest.raises(ValueError):
+        list(iterate_prefiltered_hits(queries, proteins))
+    Z = len(proteins)
+    expected = [[(hit.name, hit.score, hit.evalue) for hit in hits] for hits in pyhmmer.hmmsearch(queries, proteins, cpus=1, Z=Z)]
+    # Without candidates every query is searched against all sequences like hmmsearch
+    timings = dict()
+    hits = [[(hit.name, hit.score, hit.evalue) for hit in hits] for hits in iterate_prefiltered_hits(queries, proteins, n_jobs=2, timings=timings, Z=Z)]
+    assert hits == expected
+    assert set(timings) == {query.name.decode() for query in queries}
+    # Queries without candidates are skipped and E-values do not depend on the number of candidates
+    candidates = {"K00001":np.asarray([0, 1, 2]), "K00003":np.arange(Z)}
+    top_hits = list(iterate_prefiltered_hits(queries, proteins, candidates=candidates, Z=Z))
+    assert [hits.query.name.decode() for hits in top_hits] == ["K00001", "K00003"]
+    assert [(hit.name, hit.score, hit.evalue) for hit in top_hits[1]] == expected[2]
+    assert [hit.name for hit in top_hits[0]] == [proteins[0].name]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Regression tests of the command line tools against the output of the original implementation.
+
+The expected outputs in test/expected/ were written by the baseline `pykofamsearch` (before blocks, indexed
+databases, threshold pruning, pipelining, etc.) for test.faa against the synthetic KOfams of `build_kofam_fixture`.
+Every mode must write the same hits in the same order unless noted (blocks are written block by block).
+"""
+import os, gzip, shutil
+import pytest
+from conftest import PROTEINS, EXPECTED_DIRECTORY, run_module, read_rows
+
+EXPECTED = {
+    "default":os.path.join(EXPECTED_DIRECTORY, "test.kofams.tsv"),
+    "all_hits":os.path.join(EXPECTED_DIRECTORY, "test.kofams.all_hits.tsv"),
+    "threshold_scale":os.path.join(EXPECTED_DIRECTORY, "test.kofams.t-0.5.e-0.01.tsv"),
+}
+EXPECTED_ARGUMENTS = {
+    "default":[],
+    "all_hits":["-a"],
+    "threshold_scale":["-t", "0.5", "-e", "0.01"],
+}
+MODES = {
+    "default":[],
+    "schedule_database":["--schedule", "database"],
+    "threads":["-p", "2"],
+    "no_pipelining":["--no_pipelining"],
+    "no_deduplication":["--no_deduplication"],
+    "no_threshold_pruning":["--no_threshold_pruning"],
+    "profile":["--profile"],
+    "hmmscan":["--engine", "hmmscan"],
+    "max_block_memory":["--max_block_memory", "64K"],
+}
+
+def run_pykofamsearch(database, output, *args, **kwargs):
+    run_module("pykofamsearch", "-b", database, "-o", output, *args, **kwargs)
+    return output
+
+@pytest.mark.parametrize("expected", list(EXPECTED))
+@pytest.mark.parametrize("database", ["serialized_database", "indexed_database"])
+def test_databases(request, tmp_path, database, expected):
+    output = run_pykofamsearch(request.getfixturevalue(database), tmp_path/"output.tsv", "-i", PROTEINS, *EXPECTED_ARGUMENTS[expected])
+    assert read_rows(output) == read_rows(EXPECTED[expected])
+
+@pytest.mark.parametrize("expected", list(EXPECTED))
+@pytest.mark.parametrize("mode", list(MODES))
+def test_modes(indexed_database, tmp_path, mode, expected):
+    output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv", "-i", PROTEINS, *MODES[mode], *EXPECTED_ARGUMENTS[expected])
+    rows = read_rows(output, sort=mode == "max_block_memory")
+    assert rows == read_rows(EXPECTED[expected], sort=mode == "max_block_memory")
+
+@pytest.mark.parametrize("expected", list(EXPECTED))
+def test_blocks(indexed_database, tmp_path, expected):
+    # Hits are written block by block so only the set of rows is the same
+    output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv", "-i", PROTEINS, "--sequences_per_block", 1000, *EXPECTED_ARGUMENTS[expected])
+    assert read_rows(output, sort=True) == read_rows(EXPECTED[expected], sort=True)
+
+def test_profile_cache(indexed_database, serialized_database, tmp_path):
+    # The cache is keyed by the models so both database formats share the same pre-optimized profiles
+    cache_directory = tmp_path/"cache"
+    for database in [indexed_database, serialized_database]:
+        output = run_pykofamsearch(database, tmp_path/"output.tsv", "-i", PROTEINS, "--profile_cache_directory", cache_directory)
+        assert read_rows(output) == read_rows(EXPECTED["default"])
+    assert len(os.listdir(cache_directory)) == 1
+
+def test_subset(kofam_directory, serialized_database, tmp_path):
+    subset = tmp_path/"subset.list"
+    id_kos = ["K00001", "K00002", "K00005", "K00009"]
+    subset.write_text("\n".join(id_kos) + "\n")
+    output = run_pykofamsearch(serialized_database, tmp_path/"output.tsv", "-i", PROTEINS, "-s", subset)
+    header, *rows = read_rows(EXPECTED["default"])
+    assert read_rows(output) == [header] + [row for row in rows if row.split("\t")[1] in id_kos]
+
+def test_stdin(indexed_database, tmp_path):
+    with open(PROTEINS, "rb") as f:
+        output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv", "-i", "stdin", stdin=f)
+    assert read_rows(output) == read_rows(EXPECTED["default"])
+    with open(PROTEINS, "rb") as f:
+        output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv", "-i", "stdin", "--sequences_per_block", 1000, "-Z", 4977, stdin=f)
+    assert read_rows(output, sort=True) == read_rows(EXPECTED["default"], sort=True)
+
+def test_compressed(indexed_database, tmp_path):
+    proteins = tmp_path/"test.faa.gz"
+    with open(PROTEINS, "rb") as f_in, gzip.open(proteins, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv.gz", "-i", proteins)
+    with gzip.open(output, "rt") as f:
+        assert f.read().splitlines() == read_rows(EXPECTED["default"])
+
+def test_prefilter(indexed_database, tmp_path):
+    # Pairs without shared seeds are not searched so the prefilter output is a subset in the same order
+    output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv", "-i", PROTEINS, "--prefilter", "--sensitivity", "high")
+    header, *rows = read_rows(output)
+    expected = read_rows(EXPECTED["default"])
+    assert header == expected[0]
+    assert set(rows) <= set(expected[1:])
+    assert rows == [row for row in expected[1:] if row in set(rows)]
+
+def test_checkpoint(indexed_database, tmp_path):
+    checkpoint_directory = tmp_path/"checkpoint"
+    for _ in range(2):
+        # The second run resumes from the journal of the completed run
+        output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv", "-i", PROTEINS, "--checkpoint_directory", checkpoint_directory)
+        assert read_rows(output) == read_rows(EXPECTED["default"])
+
+def test_result_store(indexed_database, tmp_path):
+    result_store = tmp_path/"results.sqlite"
+    for _ in range(2):
+        # The second run writes the stored hits without searching
+        output = run_pykofamsearch(indexed_database, tmp_path/"output.tsv", "-i", PROTEINS, "--result_store", result_store)
+        assert read_rows(output) == read_rows(EXPECTED["default"])
+
+def test_multiple_proteomes(indexed_database, tmp_path):
+    # E-values use the size of each proteome so each output is the same as searching the proteome by itself
+    directory = tmp_path/"proteomes"
+    directory.mkdir()
+    with open(PROTEINS, "r") as f:
+        records = [">" + record for record in f.read().split(">")[1:]]
+    (directory/"a.faa").write_text("".join(records[:2000]))
+    (directory/"b.faa").write_text("".join(records[2000:]))
+    run_pykofamsearch(indexed_database, tmp_path/"output", "-i", directory)
+    for id_sample in ["a", "b"]:
+        expected = run_pykofamsearch(indexed_database, tmp_path/"{}.tsv".format(id_sample), "-i", directory/"{}.faa".format(id_sample))
+        assert read_rows(tmp_path/"output"/"{}.tsv".format(id_sample)) == read_rows(expected)
+
+def test_parquet(indexed_database, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    output = run_pykofamsearch(indexed_database, tmp_path/"output.parquet", "-i", PROTEINS, "--format", "parquet")
+    table = pq.read_table(output).to_pydict()
+    header, *rows = read_rows(EXPECTED["default"])
+    rows = [row.split("\t") for row in rows]
+    assert table["id_protein"] == [row[0] for row in rows]
+    assert table["id_ko"] == [row[1] for row in rows]
+    assert [round(score, 1) for score in table["score"]] == [round(float(row[3]), 1) for row in rows]
+
+def test_shard(indexed_database, tmp_path):
+    output = tmp_path/"output.tsv"
+    run_module("shard_pykofamsearch", "run", "-q", tmp_path/"queue", "-n", 3, "-w", 2, "-i", PROTEINS, "-b", indexed_database, "-o", output)
+    assert read_rows(output) == read_rows(EXPECTED["default"])
+
+def test_subset_serialized_models(serialized_database, indexed_database, tmp_path):
+    subset = tmp_path/"subset.list"
+    subset.write_text("K00001\nK00003\nK00004\n")
+    header, *rows = read_rows(EXPECTED["default"])
+    expected = [header] + [row for row in rows if row.split("\t")[1] in {"K00001", "K00003", "K00004"}]
+    for database, subset_database in [(serialized_database, tmp_path/"subset.pkl.gz"), (indexed_database, tmp_path/"subset.kofamdb")]:
+        run_module("subset_serialized_models", "-i", subset, "-b", database, "-s", subset_database)
+        output = run_pykofamsearch(subset_database, tmp_path/"output.tsv", "-i", PROTEINS)
+        assert read_rows(output) == expected
+
+def test_searcher(indexed_database):
+    from pykofamsearch import KOfamSearcher
+    searcher = KOfamSearcher.from_database(serialized_database=indexed_database, n_jobs=2)
+    hits = searcher.search(PROTEINS)
+    header, *rows = read_rows(EXPECTED["default"])
+    assert [(hit.id_protein, hit.id_ko) for hit in hits] == [tuple(row.split("\t")[:2]) for row in rows]
+    assert [hit for kofam_hits in searcher.iter_search(PROTEINS) for hit in kofam_hits] == hits
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import argparse
+import pytest
+from pykofamsearch import resources
+from pykofamsearch.resources import (
+    parse_n_jobs,
+    plan_memory,
+    format_bytes,
+    get_cgroup_cpu_quota,
+    get_cgroup_memory_limit,
+    get_available_cpus,
+    THREAD_MEMORY,
+    MIN_RESIDUES_PER_BLOCK,
+)
+
+@pytest.mark.parametrize("value,n_jobs", [("auto", "auto"), ("AUTO", "auto"), ("-1", "auto"), (-1, "auto"), ("3", 3), (1, 1)])
+def test_parse_n_jobs(value, n_jobs):
+    assert parse_n_jobs(value) == n_jobs
+
+@pytest.mark.parametrize("value", ["0", "-2", "x", "1.5"])
+def test_parse_n_jobs_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_n_jobs(value)
+
+def write_cgroup(directory, **files):
+    directory.mkdir(parents=True, exist_ok=True)
+    for filename, value in files.items():
+        (directory/filename.replace("_", ".", 1)).write_text(value + "\n")
+    return str(directory)
+
+def test_cgroup_v2(tmp_path, monkeypatch):
+    # The lowest limit of the cgroup and its parents applies
+    directories = [
+        write_cgroup(tmp_path/"parent"/"child", cpu_max="250000 100000", memory_max="max"),
+        write_cgroup(tmp_path/"parent", cpu_max="max 100000", memory_max=str(2 * 1024**3)),
+    ]
+    monkeypatch.setattr(resources, "get_cgroup_directories", lambda controller: directories)
+    monkeypatch.setattr(resources, "get_affinity_cpus", lambda: 8)
+    assert get_cgroup_cpu_quota() == 2.5
+    assert get_cgroup_memory_limit() == 2 * 1024**3
+    assert get_available_cpus() == 2
+
+def test_cgroup_v1(tmp_path, monkeypatch):
+    directories = [write_cgroup(tmp_path/"v1", cpu_cfs_quota_us="50000", cpu_cfs_period_us="100000", memory_limit_in_bytes=str(2**63 - 4096))]
+    monkeypatch.setattr(resources, "get_cgroup_directories", lambda controller: directories)
+    monkeypatch.setattr(resources, "get_affinity_cpus", lambda: 4)
+    assert get_cgroup_cpu_quota() == 0.5
+    # Unlimited memory is a page-aligned maximum integer
+    assert get_cgroup_memory_limit() is None
+    # At least 1 CPU
+    assert get_available_cpus() == 1
+
+def test_no_cgroup(monkeypatch):
+    monkeypatch.setattr(resources, "get_cgroup_directories", lambda controller: [])
+    monkeypatch.setattr(resources, "get_affinity_cpus", lambda: 4)
+    assert get_cgroup_cpu_quota() is None
+    assert get_cgroup_memory_limit() is None
+    assert get_available_cpus() == 4
+
+def test_plan_memory():
+    memory_limit = 16 * 1024**3
+    n_jobs, residues_per_block = plan_memory(memory_limit, 1024**3, 8)
+    assert n_jobs == 8
+    # Residues per block are a power of 2 that fit in the budget
+    assert residues_per_block & (residues_per_block - 1) == 0
+    assert 3 * 4 * residues_per_block + 8 * THREAD_MEMORY + 1024**3 <= 0.8 * memory_limit
+    assert 3 * 4 * 2 * residues_per_block + 8 * THREAD_MEMORY + 1024**3 > 0.8 * memory_limit
+    # Threads are reduced when their memory does not fit and blocks have a minimum size
+    n_jobs, residues_per_block = plan_memory(512 * 1024**2, 256 * 1024**2, 8)
+    assert n_jobs == 2
+    assert residues_per_block >= MIN_RESIDUES_PER_BLOCK
+    assert plan_memory(0, 1024**3, 4) == (1, MIN_RESIDUES_PER_BLOCK)
+
+def test_format_bytes():
+    assert format_bytes(512) == "512.0B"
+    assert format_bytes(1536) == "1.5K"
+    assert format_bytes(3 * 1024**3) == "3.0G"
+    assert format_bytes(2 * 1024**4) == "2.0T"
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import os
+import pytest
+from pykofamsearch.result_store import ResultStore, get_sequence_hash
+from conftest import PROTEINS, EXPECTED_DIRECTORY, run_module, read_rows
+
+def test_get_sequence_hash():
+    assert get_sequence_hash("MKV") == get_sequence_hash("mkv")
+    assert get_sequence_hash("MKV") != get_sequence_hash("MKVL")
+
+def test_result_store(tmp_path):
+    filepath = str(tmp_path/"results.sqlite")
+    hash_to_sequence = {get_sequence_hash(sequence):sequence for sequence in ["MKV", "MKVL", "MKVLA"]}
+    hashes = list(hash_to_sequence)
+    with ResultStore(filepath) as store:
+        store.add_sequences(hash_to_sequence)
+        store.add_models({"a":"K00001", "b":"K00002"})
+        store.add_hits([(hashes[0], "a", 50.0, 40.0, 1e-5), (hashes[1], "a", 100.0, 90.0, 1e-10), (hashes[2], "b", 10.0, 10.0, 0.1)])
+    # Changes are committed on exit
+    with ResultStore(filepath) as store:
+        assert store.get_models() == {"a", "b"}
+        assert store.get_sequence_hashes() == set(hashes)
+        assert store.get_number_of_sequences() == 3
+        assert sorted(row for rows in store.iterate_sequences(batch_size=2) for row in rows) == sorted(hash_to_sequence.items())
+        # Hits are sorted by P-value
+        assert store.get_hits("a") == [(hashes[1], 100.0, 90.0, 1e-10), (hashes[0], 50.0, 40.0, 1e-5)]
+        store.remove_models({"a"})
+        assert store.get_models() == {"b"}
+        assert store.get_hits("a") == []
+
+def test_result_store_rollback(tmp_path):
+    filepath = str(tmp_path/"results.sqlite")
+    with pytest.raises(RuntimeError):
+        with ResultStore(filepath) as store:
+            store.add_models({"a":"K00001"})
+            raise RuntimeError
+    with ResultStore(filepath) as store:
+        assert store.get_models() == set()
+
+def test_incremental_search(indexed_database, tmp_path):
+    # Sequences added after the first run are searched against the stored models and E-values use every input sequence
+    result_store = tmp_path/"results.sqlite"
+    with open(PROTEINS, "r") as f:
+        records = [">" + record for record in f.read().split(">")[1:]]
+    proteins = tmp_path/"proteins.faa"
+    proteins.write_text("".join(records[:1000]))
+    run_module("pykofamsearch", "-b", indexed_database, "-i", proteins, "-o", tmp_path/"output.tsv", "--result_store", result_store)
+    with ResultStore(str(result_store)) as store:
+        assert store.get_number_of_sequences() == len({get_sequence_hash("".join(record.splitlines()[1:])) for record in records[:1000]})
+    run_module("pykofamsearch", "-b", indexed_database, "-i", PROTEINS, "-o", tmp_path/"output.tsv", "--result_store", result_store)
+    assert read_rows(tmp_path/"output.tsv") == read_rows(os.path.join(EXPECTED_DIRECTORY, "test.kofams.tsv"))
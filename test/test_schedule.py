@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import random
+from types import SimpleNamespace
+import pytest
+from pykofamsearch.pykofamsearch import (
+    schedule_queries,
+    reorder_results,
+    SCHEDULE_CHUNK_SIZE,
+    SCHEDULE_KOFAMS_PER_THREAD,
+)
+
+def get_models(number_of_models:int, seed:int=0):
+    rng = random.Random(seed)
+    return {"K{:05d}".format(i + 1):SimpleNamespace(name="K{:05d}".format(i + 1), M=rng.randint(50, 1000)) for i in range(number_of_models)}
+
+def test_schedule_queries():
+    name_to_hmm = get_models(2*SCHEDULE_CHUNK_SIZE + 10)
+    ids = list(name_to_hmm)
+    queries = schedule_queries(name_to_hmm, schedule="length")
+    assert sorted(query.name for query in queries) == ids
+    # Longest models first within each chunk of the database order
+    for start in range(0, len(ids), SCHEDULE_CHUNK_SIZE):
+        chunk = queries[start:start + SCHEDULE_CHUNK_SIZE]
+        assert {query.name for query in chunk} == set(ids[start:start + SCHEDULE_CHUNK_SIZE])
+        assert [query.M for query in chunk] == sorted((query.M for query in chunk), reverse=True)
+
+def test_schedule_queries_chunk_size():
+    # Chunks have at least SCHEDULE_KOFAMS_PER_THREAD KOfams per thread
+    n_jobs = SCHEDULE_CHUNK_SIZE // SCHEDULE_KOFAMS_PER_THREAD * 2
+    chunk_size = SCHEDULE_KOFAMS_PER_THREAD * n_jobs
+    name_to_hmm = get_models(chunk_size)
+    queries = schedule_queries(name_to_hmm, schedule="length", n_jobs=n_jobs)
+    assert [query.M for query in queries] == sorted((hmm.M for hmm in name_to_hmm.values()), reverse=True)
+
+def test_schedule_queries_metadata():
+    # Model lengths recorded in the metadata are used instead of the HMMs
+    name_to_hmm = get_models(3)
+    ko_to_data = {"K00001":{"model_length":1}, "K00002":{"model_length":3}, "K00003":{"model_length":2}}
+    assert [query.name for query in schedule_queries(name_to_hmm, ko_to_data=ko_to_data)] == ["K00002", "K00003", "K00001"]
+
+def test_schedule_queries_database():
+    name_to_hmm = get_models(10)
+    assert schedule_queries(name_to_hmm, schedule="database") == list(name_to_hmm.values())
+    with pytest.raises(ValueError):
+        schedule_queries(name_to_hmm, schedule="random")
+
+def test_reorder_results():
+    order = ["K{:05d}".format(i + 1) for i in range(20)]
+    items = [(id_ko, id_ko.lower()) for id_ko in order]
+    random.Random(0).shuffle(items)
+    assert list(reorder_results(items, order)) == [(id_ko, id_ko.lower()) for id_ko in order]
+
+def test_reorder_results_missing():
+    # KOfams that never arrive are passed over when the results are exhausted
+    order = ["K00001", "K00002", "K00003", "K00004", "K00005"]
+    items = [("K00005", 5), ("K00003", 3), ("K00001", 1)]
+    assert list(reorder_results(items, order)) == [("K00001", 1), ("K00003", 3), ("K00005", 5)]
+
+def test_reorder_results_buffering():
+    # Results are yielded as soon as every earlier KOfam is available
+    order = ["K00001", "K00002", "K00003", "K00004"]
+    consumed = list()
+    def iterate_items():
+        for item in [("K00002", 2), ("K00001", 1), ("K00004", 4), ("K00003", 3)]:
+            consumed.append(item[0])
+            yield item
+    results = reorder_results(iterate_items(), order)
+    assert next(results) == ("K00001", 1)
+    assert consumed == ["K00002", "K00001"]
+    assert next(results) == ("K00002", 2)
+    assert consumed == ["K00002", "K00001"]
+    assert list(results) == [("K00003", 3), ("K00004", 4)]
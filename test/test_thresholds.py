@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import os, math
+import pytest
+import pyhmmer
+from pyhmmer.easel import SequenceFile, Alphabet
+from pyhmmer.plan7 import HMMFile
+from pykofamsearch.metadata import parse_ko_list
+from pykofamsearch.pykofamsearch import (
+    get_evalue_cutoff,
+    prepare_threshold_queries,
+    set_threshold_cutoffs,
+    write_hits,
+    INCLUSION_EVALUE,
+)
+from conftest import PROTEINS
+
+class RowCollector(object):
+    def __init__(self):
+        self.rows = list()
+    def write_columns(self, *columns):
+        self.rows.extend(zip(*columns))
+
+@pytest.fixture(scope="module")
+def ko_to_data(kofam_directory):
+    return parse_ko_list(os.path.join(kofam_directory, "ko_list"))
+
+@pytest.fixture(scope="module")
+def queries(kofam_directory, ko_to_data):
+    queries = list()
+    for id_ko in ko_to_data:
+        with HMMFile(os.path.join(kofam_directory, "profiles", "{}.hmm".format(id_ko))) as f:
+            queries.append(f.read())
+    return queries
+
+@pytest.fixture(scope="module")
+def proteins():
+    with SequenceFile(PROTEINS, digital=True, alphabet=Alphabet.amino()) as f:
+        return f.read_block()
+
+def test_get_evalue_cutoff(queries):
+    query = queries[0]
+    cutoff = get_evalue_cutoff(query, 0.01, 5000)
+    # The E-value at the cutoff (without the margin) is the E-value threshold
+    p_value = math.exp(-query.evalue_parameters.f_lambda * (cutoff - query.evalue_parameters.f_tau))
+    assert p_value * 5000 == pytest.approx(0.01, rel=0.01)
+    assert get_evalue_cutoff(query, 0.01, 50000) > cutoff
+    # Every hit can pass when the E-value threshold is at least the number of sequences
+    assert get_evalue_cutoff(query, 10, 10) == float("-inf")
+    assert get_evalue_cutoff(query, 10, None) == float("-inf")
+
+def test_prepare_threshold_queries(ko_to_data, queries):
+    threshold_queries = prepare_threshold_queries(queries, ko_to_data, 0.5, evalue_threshold=0.01, number_of_sequences=5000)
+    # KOfams without a score_type are not searched
+    assert [query.name.decode() for query in threshold_queries] == [id_ko for id_ko in ko_to_data if ko_to_data[id_ko]["score_type"]]
+    # Queries are copied
+    assert all(query.cutoffs.trusted is None for query in queries)
+    for query in threshold_queries:
+        data = ko_to_data[query.name.decode()]
+        evalue_cutoff = get_evalue_cutoff(query, 0.01, 5000)
+        sequence_cutoff, domain_cutoff = query.cutoffs.trusted
+        assert domain_cutoff == float("-inf")
+        if data["score_type"] == "domain":
+            assert sequence_cutoff == pytest.approx(evalue_cutoff, abs=1e-3)
+        else:
+            assert sequence_cutoff == pytest.approx(max(evalue_cutoff, round(data["threshold"] * 0.5, 2)), abs=1e-3)
+
+def test_set_threshold_cutoffs(ko_to_data, queries):
+    # E-value cutoffs are updated in place when the number of sequences changes
+    threshold_queries = prepare_threshold_queries(queries, ko_to_data, 0.0, evalue_threshold=0.01, number_of_sequences=100)
+    cutoffs = [query.cutoffs.trusted[0] for query in threshold_queries]
+    assert set_threshold_cutoffs(threshold_queries, ko_to_data, 0.0, evalue_threshold=0.01, number_of_sequences=100000) is threshold_queries
+    assert all(query.cutoffs.trusted[0] > cutoff for query, cutoff in zip(threshold_queries, cutoffs))
+
+@pytest.mark.parametrize("threshold_scale,evalue", [(1.0, 10.0), (0.5, 0.01), (0.0, 1e-20)])
+def test_threshold_pruning(ko_to_data, queries, proteins, threshold_scale, evalue):
+    # Searching with the cutoffs writes the same hits as searching with E-values and filtering
+    number_of_sequences = len(proteins)
+    expected = RowCollector()
+    for hits in pyhmmer.hmmsearch(queries, proteins, cpus=1, E=evalue, Z=number_of_sequences):
+        write_hits(hits, ko_to_data, threshold_scale, False, expected)
+    evalue_threshold = min(evalue, INCLUSION_EVALUE)
+    threshold_queries = prepare_threshold_queries(queries, ko_to_data, threshold_scale, evalue_threshold=evalue_threshold, number_of_sequences=number_of_sequences)
+    pruned = RowCollector()
+    for hits in pyhmmer.hmmsearch(threshold_queries, proteins, cpus=1, E=evalue, Z=number_of_sequences, bit_cutoffs="trusted"):
+        write_hits(hits, ko_to_data, threshold_scale, False, pruned, evalue_threshold=evalue_threshold)
+    assert expected.rows
+    assert pruned.rows == expected.rows
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import gzip
+import pytest
+from pykofamsearch.writers import HitWriter, TopHitsPerProteinWriter, read_columnar_hits, COLUMNS
+
+HITS = [
+    ["p1", "p2", "p3"],
+    ["K00001", "K00001", "K00002"],
+    [100.0, 100.0, None],
+    [150.25, 101.0, 20.0],
+    [1e-50, 2.5e-10, 0.001],
+    ["synthetic protein 0", "synthetic protein 0", "synthetic protein 1"],
+    [["1.1.1.2", "1.1.1.1"], ["1.1.1.2", "1.1.1.1"], None],
+]
+
+def test_tsv(tmp_path):
+    output = str(tmp_path/"output.tsv")
+    with HitWriter(output, buffer_size=2) as writer:
+        writer.write_columns(*[column[:2] for column in HITS])
+        writer.write_columns(*[column[2:] for column in HITS])
+    assert writer.number_of_hits == 3
+    with open(output, "r") as f:
+        assert f.read().splitlines() == [
+            "\t".join(COLUMNS),
+            "p1\tK00001\t100.0\t150.250\t1.00000e-50\tsynthetic protein 0\t['1.1.1.2', '1.1.1.1']",
+            "p2\tK00001\t100.0\t101.000\t2.50000e-10\tsynthetic protein 0\t['1.1.1.2', '1.1.1.1']",
+            "p3\tK00002\t\t20.000\t1.00000e-03\tsynthetic protein 1\tNone",
+        ]
+
+def test_tsv_compressed(tmp_path):
+    output = str(tmp_path/"output.tsv.gz")
+    with HitWriter(output, header=False) as writer:
+        writer.write_columns(*HITS)
+    with gzip.open(output, "rt") as f:
+        assert [line.split("\t")[0] for line in f.read().splitlines()] == HITS[0]
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_columnar(tmp_path, format):
+    pytest.importorskip("pyarrow")
+    output = str(tmp_path/"output.{}".format(format))
+    with HitWriter(output, format=format, buffer_size=2) as writer:
+        writer.write_columns(*HITS)
+        writer.write_columns(*HITS)
+    table = read_columnar_hits(output).to_pydict()
+    assert list(table) == COLUMNS
+    assert table["id_protein"] == HITS[0] * 2
+    assert table["threshold"] == HITS[2] * 2
+    assert table["score"] == HITS[3] * 2
+    # Enzyme commissions are sorted lists
+    assert table["enzyme_commission"] == [["1.1.1.1", "1.1.1.2"], ["1.1.1.1", "1.1.1.2"], []] * 2
+
+def test_invalid(tmp_path):
+    with pytest.raises(ValueError):
+        HitWriter(str(tmp_path/"output.csv"), format="csv")
+    with pytest.raises(ValueError):
+        HitWriter(str(tmp_path/"output.parquet.gz"), format="parquet")
+
+class RowCollector(object):
+    def __init__(self):
+        self.rows = list()
+    def write_columns(self, *columns):
+        self.rows.extend(zip(*columns))
+    def flush(self):
+        pass
+    def close(self):
+        pass
+
+def write_top_hits(rows, **kwargs):
+    collector = RowCollector()
+    with TopHitsPerProteinWriter(collector, **kwargs) as writer:
+        writer.write_columns(*map(list, zip(*rows)))
+    return [row[:2] for row in collector.rows]
+
+TOP_HITS = [
+    # id_protein, id_ko, threshold, score, e-value, definition, enzyme_commission
+    ("p1", "K00001", 100.0, 150.0, 1e-50, "", None),
+    ("p2", "K00001", 100.0, 120.0, 1e-40, "", None),
+    ("p1", "K00002", 300.0, 350.0, 1e-90, "", None),
+    ("p1", "K00003", None, 400.0, 1e-99, "", None),
+    ("p2", "K00004", 50.0, 120.0, 1e-40, "", None),
+]
+
+def test_top_hits_per_protein():
+    # Hits are written in the order they were received
+    assert write_top_hits(TOP_HITS, max_hits_per_protein=1) == [("p2", "K00001"), ("p1", "K00003")]
+    assert write_top_hits(TOP_HITS, max_hits_per_protein=2) == [("p2", "K00001"), ("p1", "K00002"), ("p1", "K00003"), ("p2", "K00004")]
+    assert write_top_hits(TOP_HITS, max_hits_per_protein=5) == [row[:2] for row in TOP_HITS]
+
+def test_top_hits_per_protein_threshold_ratio():
+    # KOfams without a threshold are ranked last and ties are broken by score and then by the first hit
+    assert write_top_hits(TOP_HITS, max_hits_per_protein=1, ranking="threshold_ratio") == [("p1", "K00001"), ("p2", "K00004")]
+    assert write_top_hits(TOP_HITS, max_hits_per_protein=2, ranking="threshold_ratio") == [("p1", "K00001"), ("p2", "K00001"), ("p1", "K00002"), ("p2", "K00004")]
+
+def test_top_hits_per_protein_flush():
+    # Each flush writes the best hits received since the previous flush
+    collector = RowCollector()
+    writer = TopHitsPerProteinWriter(collector, max_hits_per_protein=1)
+    writer.write_columns(*map(list, zip(*TOP_HITS[:2])))
+    writer.flush()
+    writer.write_columns(*map(list, zip(*TOP_HITS[2:])))
+    writer.close()
+    assert [row[:2] for row in collector.rows] == [("p1", "K00001"), ("p2", "K00001"), ("p1", "K00003"), ("p2", "K00004")]
+    with pytest.raises(ValueError):
+        TopHitsPerProteinWriter(collector, max_hits_per_protein=0)
+    with pytest.raises(ValueError):
+        TopHitsPerProteinWriter(collector, max_hits_per_protein=1, ranking="evalue")